@@ -15,5 +15,6 @@ setup(name="vlab-dataiq-api",
       package_files={'vlab_dataiq_api' : ['app.ini']},
       description="dataiq",
       install_requires=['flask', 'ldap3', 'pyjwt', 'uwsgi', 'vlab-api-common',
-                        'ujson', 'cryptography', 'vlab-inf-common', 'celery']
+                        'ujson', 'cryptography', 'vlab-inf-common', 'celery',
+                        'prometheus_client']
       )
@@ -0,0 +1,117 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in admission.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_dataiq_api.lib.worker import admission
+
+
+def _entry(ticket, username='alice', datastore='ds1'):
+    """Make a queue entry"""
+    return {'ticket' : ticket, 'username' : username, 'datastore' : datastore, 'pid' : os.getpid()}
+
+
+class TestAdmission(unittest.TestCase):
+    """A set of test cases for admission.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.cache_dir = tempfile.mkdtemp()
+        self.patchers = [patch.object(admission, 'const'), patch.object(admission, 'file_lock')]
+        fake_const, _ = [x.start() for x in self.patchers]
+        fake_const.VLAB_DATAIQ_CACHE_DIR = self.cache_dir
+        fake_const.VLAB_DATAIQ_MAX_DEPLOYS = 2
+        fake_const.VLAB_DATAIQ_MAX_DEPLOYS_PER_DATASTORE = 0
+        fake_const.VLAB_DATAIQ_MAX_DEPLOYS_PER_USER = 0
+
+    def tearDown(self):
+        """Runs after every test case"""
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_admitted(self):
+        """``admitted`` holds a slot while the deploy runs, and frees it afterwards"""
+        with admission.admitted('alice', 'ds1'):
+            running = admission._load()['running']
+        after = admission._load()
+
+        self.assertEqual([x['username'] for x in running], ['alice'])
+        self.assertEqual(after, {'waiting': [], 'running': []})
+
+    @patch.object(admission.time, 'sleep')
+    def test_admitted_waits(self, fake_sleep):
+        """``admitted`` reports the queue position while it waits for a slot"""
+        admission._save({'waiting': [], 'running': [_entry('a'), _entry('b')]})
+        fake_on_wait = MagicMock()
+        # Free a slot the first time the waiting deploy sleeps
+        fake_sleep.side_effect = lambda x: admission._save({'waiting': admission._load()['waiting'],
+                                                            'running': [_entry('a')]})
+
+        with admission.admitted('bob', 'ds1', on_wait=fake_on_wait):
+            pass
+
+        fake_on_wait.assert_called_once_with(1)
+
+    def test_admitted_disabled(self):
+        """``admitted`` doesn't touch the queue when every limit is off"""
+        admission.const.VLAB_DATAIQ_MAX_DEPLOYS = 0
+
+        with admission.admitted('alice', 'ds1'):
+            pass
+
+        self.assertFalse(os.path.exists(admission._path()))
+
+    def test_position(self):
+        """``_position`` counts the waiting deploys ahead in the queue"""
+        queue = {'running': [_entry('a'), _entry('b')],
+                 'waiting': [_entry('c'), _entry('d'), _entry('e')]}
+
+        output = admission._position(queue, 'e')
+
+        self.assertEqual(output, 3)
+
+    def test_position_admit(self):
+        """``_position`` is zero once a deploy can start"""
+        queue = {'running': [_entry('a')], 'waiting': [_entry('b')]}
+
+        output = admission._position(queue, 'b')
+
+        self.assertEqual(output, 0)
+
+    def test_position_skip_blocked(self):
+        """``_position`` doesn't let a deploy blocked by its own limit hold up the ones behind it"""
+        admission.const.VLAB_DATAIQ_MAX_DEPLOYS = 0
+        admission.const.VLAB_DATAIQ_MAX_DEPLOYS_PER_DATASTORE = 1
+        queue = {'running': [_entry('a', datastore='ds1')],
+                 'waiting': [_entry('b', datastore='ds1'), _entry('c', datastore='ds2')]}
+
+        output = admission._position(queue, 'c')
+
+        self.assertEqual(output, 0)
+
+    def test_fits_per_user(self):
+        """``_fits`` enforces the per-user limit"""
+        admission.const.VLAB_DATAIQ_MAX_DEPLOYS = 0
+        admission.const.VLAB_DATAIQ_MAX_DEPLOYS_PER_USER = 1
+
+        self.assertFalse(admission._fits(_entry('b'), [_entry('a')]))
+        self.assertTrue(admission._fits(_entry('b', username='bob'), [_entry('a')]))
+
+    @patch.object(admission, 'process_alive')
+    def test_load_dead(self, fake_process_alive):
+        """``_load`` drops deploys of processes that are gone"""
+        admission._save({'waiting': [_entry('a')], 'running': [_entry('b')]})
+        fake_process_alive.return_value = False
+
+        output = admission._load()
+
+        self.assertEqual(output, {'waiting': [], 'running': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,7 @@ A suite of tests for the HTTP API schemas
 """
 import unittest
 
-from jsonschema import Draft4Validator, validate, ValidationError
+from jsonschema import Draft4Validator
 from vlab_dataiq_api.lib.views import dataiq
 
 
@@ -32,6 +32,16 @@ class TestDataIQViewSchema(unittest.TestCase):
 
         self.assertTrue(schema_valid)
 
+    def test_get_args_schema(self):
+        """The schema defined for GET args is valid"""
+        try:
+            Draft4Validator.check_schema(dataiq.DataIQView.GET_ARGS_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
     def test_delete_schema(self):
         """The schema defined for DELETE on is valid"""
         try:
@@ -52,6 +62,27 @@ class TestDataIQViewSchema(unittest.TestCase):
 
         self.assertTrue(schema_valid)
 
+    def test_bulk_schema(self):
+        """The schema defined for POST on /bulk is valid"""
+        try:
+            Draft4Validator.check_schema(dataiq.DataIQView.BULK_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
+
+    def test_bulk_delete_schema(self):
+        """The schema defined for DELETE on /bulk is valid"""
+        try:
+            Draft4Validator.check_schema(dataiq.DataIQView.BULK_DELETE_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,82 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in cache.py
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_dataiq_api.lib.worker import cache
+
+
+class TestCache(unittest.TestCase):
+    """A set of test cases for cache.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.cache_dir = tempfile.mkdtemp()
+        self.patcher = patch.object(cache, 'const')
+        fake_const = self.patcher.start()
+        fake_const.VLAB_DATAIQ_CACHE_DIR = self.cache_dir
+        fake_const.VLAB_DATAIQ_SHOW_CACHE_TTL = 30
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_miss(self):
+        """``get`` returns None when nothing is cached for the user"""
+        self.assertTrue(cache.get('alice') is None)
+
+    def test_put_get(self):
+        """``get`` returns what ``put`` cached"""
+        cache.put('alice', {'myDataIQ': {}}, time.time())
+
+        self.assertEqual(cache.get('alice'), {'myDataIQ': {}})
+
+    def test_get_expired(self):
+        """``get`` returns None once the entry is older than the TTL"""
+        cache.put('alice', {'myDataIQ': {}}, time.time())
+        old = time.time() - 31
+        os.utime(cache._entry_path('alice'), (old, old))
+
+        self.assertTrue(cache.get('alice') is None)
+
+    def test_get_disabled(self):
+        """``get`` returns None when the TTL is zero"""
+        cache.put('alice', {'myDataIQ': {}}, time.time())
+        cache.const.VLAB_DATAIQ_SHOW_CACHE_TTL = 0
+
+        self.assertTrue(cache.get('alice') is None)
+
+    def test_invalidate(self):
+        """``invalidate`` discards the user's cached inventory"""
+        cache.put('alice', {'myDataIQ': {}}, time.time())
+
+        cache.invalidate('alice')
+
+        self.assertTrue(cache.get('alice') is None)
+
+    def test_invalidate_other_users(self):
+        """``invalidate`` only discards the inventory of the supplied user"""
+        cache.put('alice', {'myDataIQ': {}}, time.time())
+
+        cache.invalidate('bob')
+
+        self.assertEqual(cache.get('alice'), {'myDataIQ': {}})
+
+    def test_put_after_invalidate(self):
+        """``put`` doesn't cache an inventory that was scanned before an invalidation"""
+        started = time.time() - 5
+        cache.invalidate('alice')
+
+        cache.put('alice', {'myDataIQ': {}}, started)
+
+        self.assertTrue(cache.get('alice') is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
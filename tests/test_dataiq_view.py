@@ -5,9 +5,7 @@ A suite of tests for the dataiq object
 import unittest
 from unittest.mock import patch, MagicMock
 
-import ujson
 from flask import Flask
-from vlab_api_common import flask_common
 from vlab_api_common.http_auth import generate_v2_test_token
 
 
@@ -64,6 +62,15 @@ class TestDataIQView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    def test_get_fresh(self):
+        """DataIQView - GET on /api/2/inf/dataiq supports bypassing the cached inventory"""
+        self.app.get('/api/2/inf/dataiq?fresh=true',
+                     headers={'X-Auth': self.token})
+
+        fresh = self.app.application.celery_app.send_task.call_args[0][1][-1]
+
+        self.assertTrue(fresh)
+
     def test_post_task(self):
         """DataIQView - POST on /api/2/inf/dataiq returns a task-id"""
         resp = self.app.post('/api/2/inf/dataiq',
@@ -142,8 +149,10 @@ class TestDataIQView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
-    def test_image(self):
+    @patch.object(dataiq.images, 'available')
+    def test_image(self, fake_available):
         """DataIQView - GET on the ./image end point returns the a task-id"""
+        fake_available.return_value = False
         resp = self.app.get('/api/2/inf/dataiq/image',
                             headers={'X-Auth': self.token})
 
@@ -152,8 +161,10 @@ class TestDataIQView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
-    def test_image(self):
+    @patch.object(dataiq.images, 'available')
+    def test_image_link(self, fake_available):
         """DataIQView - GET on the ./image end point sets the Link header"""
+        fake_available.return_value = False
         resp = self.app.get('/api/2/inf/dataiq/image',
                             headers={'X-Auth': self.token})
 
@@ -162,6 +173,305 @@ class TestDataIQView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    @patch.object(dataiq.images, 'listing')
+    @patch.object(dataiq.images, 'available')
+    def test_image_sync(self, fake_available, fake_listing):
+        """DataIQView - GET on the ./image end point lists the images directly, if the images are mounted"""
+        fake_available.return_value = True
+        fake_listing.return_value = {'1.0.0' : {'version' : '1.0.0', 'size' : 1, 'mtime' : 1}}
+        resp = self.app.get('/api/2/inf/dataiq/image',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['content'], {'image' : ['1.0.0']})
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    @patch.object(dataiq.images, 'listing')
+    @patch.object(dataiq.images, 'available')
+    def test_image_sync_filters(self, fake_available, fake_listing):
+        """DataIQView - GET on the ./image end point supports the version and latest filters"""
+        fake_available.return_value = True
+        fake_listing.return_value = {'1.9.0' : {'version' : '1.9.0', 'size' : 1, 'mtime' : 1},
+                                      '1.10.0' : {'version' : '1.10.0', 'size' : 1, 'mtime' : 1},
+                                      '2.0.0' : {'version' : '2.0.0', 'size' : 1, 'mtime' : 1}}
+        resp = self.app.get('/api/2/inf/dataiq/image?version=1&latest=true',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.json['content'], {'image' : ['1.10.0']})
+
+    @patch.object(dataiq.images, 'manifest')
+    @patch.object(dataiq.images, 'listing')
+    @patch.object(dataiq.images, 'available')
+    def test_image_sync_no_manifest(self, fake_available, fake_listing, fake_manifest):
+        """DataIQView - GET on the ./image end point never reads the OVAs to build the manifest"""
+        fake_available.return_value = True
+        fake_listing.return_value = {}
+        self.app.get('/api/2/inf/dataiq/image',
+                     headers={'X-Auth': self.token})
+
+        self.assertFalse(fake_manifest.called)
+
+    @patch.object(dataiq.images, 'available')
+    def test_image_filters(self, fake_available):
+        """DataIQView - GET on the ./image end point sends the filters to the dataiq.image task"""
+        fake_available.return_value = False
+        self.app.get('/api/2/inf/dataiq/image?version=1.2&latest=true',
+                     headers={'X-Auth': self.token})
+
+        args = self.app.application.celery_app.send_task.call_args[0]
+        expected = ('dataiq.image', ['noId', '1.2', True])
+
+        self.assertEqual(args, expected)
+
+    @patch.object(dataiq.images, 'listing')
+    @patch.object(dataiq.images, 'available')
+    def test_image_etag(self, fake_available, fake_listing):
+        """DataIQView - GET on the ./image end point returns HTTP 304 if the images haven't changed"""
+        fake_available.return_value = True
+        fake_listing.return_value = {'1.0.0' : {'version' : '1.0.0', 'size' : 1, 'mtime' : 1}}
+        first = self.app.get('/api/2/inf/dataiq/image',
+                             headers={'X-Auth': self.token})
+
+        resp = self.app.get('/api/2/inf/dataiq/image',
+                            headers={'X-Auth': self.token, 'If-None-Match' : first.headers['ETag']})
+
+        self.assertEqual(resp.status_code, 304)
+
+    @patch.object(dataiq.images, 'listing')
+    @patch.object(dataiq.images, 'available')
+    def test_image_etag_changed(self, fake_available, fake_listing):
+        """DataIQView - GET on the ./image end point returns the images if they changed since the ETag"""
+        fake_available.return_value = True
+        fake_listing.return_value = {'1.0.0' : {'version' : '1.0.0', 'size' : 1, 'mtime' : 1}}
+        first = self.app.get('/api/2/inf/dataiq/image',
+                             headers={'X-Auth': self.token})
+        fake_listing.return_value = {'1.0.0' : {'version' : '1.0.0', 'size' : 1, 'mtime' : 2}}
+
+        resp = self.app.get('/api/2/inf/dataiq/image',
+                            headers={'X-Auth': self.token, 'If-None-Match' : first.headers['ETag']})
+
+        self.assertEqual(resp.status_code, 200)
+
+
+    def test_resume(self):
+        """DataIQView - POST on the ./resume end point returns a task-id"""
+        resp = self.app.post('/api/2/inf/dataiq/resume',
+                             headers={'X-Auth': self.token},
+                             json={'name' : 'myDataIQBox'})
+
+        task_id = resp.json['content']['task-id']
+        expected = 'asdf-asdf-asdf'
+
+        self.assertEqual(task_id, expected)
+
+    def test_resume_task_name(self):
+        """DataIQView - POST on the ./resume end point sends the dataiq.resume task"""
+        self.app.post('/api/2/inf/dataiq/resume',
+                      headers={'X-Auth': self.token},
+                      json={'name' : 'myDataIQBox'})
+
+        sent = self.app.application.celery_app.send_task.call_args[0]
+        expected = ('dataiq.resume', ['bob', 'myDataIQBox', 'noId'])
+
+        self.assertEqual(sent, expected)
+
+    def test_resume_requires_name(self):
+        """DataIQView - POST on the ./resume end point requires the name of the DataIQ instance"""
+        resp = self.app.post('/api/2/inf/dataiq/resume',
+                             headers={'X-Auth': self.token},
+                             json={})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_task_progress(self):
+        """DataIQView - GET on /api/2/inf/dataiq/task returns the progress of a running create"""
+        self.app.application.celery_app.AsyncResult.return_value.status = 'PROGRESS'
+        self.app.application.celery_app.AsyncResult.return_value.info = {'stage': 'gui', 'stage_number': 4, 'stages': 6}
+        resp = self.app.get('/api/2/inf/dataiq/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['progress'], {'stage': 'gui', 'stage_number': 4, 'stages': 6})
+
+    def test_task_success(self):
+        """DataIQView - GET on /api/2/inf/dataiq/task returns the result of a finished task"""
+        self.app.application.celery_app.AsyncResult.return_value.status = 'SUCCESS'
+        self.app.application.celery_app.AsyncResult.return_value.result = {'content': {}, 'error': None, 'params': {}}
+        resp = self.app.get('/api/2/inf/dataiq/task/asdf-asdf-asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+
+    def test_task_id_twice(self):
+        """DataIQView - GET on /api/2/inf/dataiq/task returns HTTP 400 if the task id is supplied twice"""
+        resp = self.app.get('/api/2/inf/dataiq/task/asdf-asdf-asdf?task-id=asdf',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk(self):
+        """DataIQView - POST on the ./bulk end point returns a task-id"""
+        resp = self.app.post('/api/2/inf/dataiq/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'image': '1.0.0',
+                                   'network': 'someLAN',
+                                   'machines': [{'name': 'box-1', 'static-ip': '192.168.1.2'}]})
+
+        task_id = resp.json['content']['task-id']
+        expected = 'asdf-asdf-asdf'
+
+        self.assertEqual(task_id, expected)
+
+    def test_bulk_ip_range(self):
+        """DataIQView - POST on the ./bulk end point supports a range of IPs"""
+        self.app.post('/api/2/inf/dataiq/bulk',
+                      headers={'X-Auth': self.token},
+                      json={'image': '1.0.0',
+                            'network': 'someLAN',
+                            'ip-range': {'name-prefix': 'class', 'start-ip': '192.168.1.10', 'count': 3}})
+
+        machines = self.app.application.celery_app.send_task.call_args[0][1][1]
+        expected = [('class-1', '192.168.1.10'), ('class-2', '192.168.1.11'), ('class-3', '192.168.1.12')]
+
+        self.assertEqual(machines, expected)
+
+    def test_bulk_ip_range_overflow(self):
+        """DataIQView - POST on the ./bulk end point returns HTTP 400 if the range of IPs runs past 255.255.255.255"""
+        resp = self.app.post('/api/2/inf/dataiq/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'image': '1.0.0',
+                                   'network': 'someLAN',
+                                   'ip-range': {'name-prefix': 'class', 'start-ip': '255.255.255.254', 'count': 3}})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertTrue('Cannot fit 3 IPs' in resp.json['error'])
+
+    def test_bulk_bad_config(self):
+        """DataIQView - POST on the ./bulk end point returns HTTP 400 if any machine has a bad IP"""
+        resp = self.app.post('/api/2/inf/dataiq/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'image': '1.0.0',
+                                   'network': 'someLAN',
+                                   'machines': [{'name': 'box-1', 'static-ip': '192.168.1.2'},
+                                                {'name': 'box-2', 'static-ip': '10.1.1.2'}]})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_duplicate_names(self):
+        """DataIQView - POST on the ./bulk end point returns HTTP 400 if names aren't unique"""
+        resp = self.app.post('/api/2/inf/dataiq/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'image': '1.0.0',
+                                   'network': 'someLAN',
+                                   'machines': [{'name': 'box-1', 'static-ip': '192.168.1.2'},
+                                                {'name': 'box-1', 'static-ip': '192.168.1.3'}]})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_requires_machines(self):
+        """DataIQView - POST on the ./bulk end point requires a list of machines or a range of IPs"""
+        resp = self.app.post('/api/2/inf/dataiq/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'image': '1.0.0', 'network': 'someLAN'})
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_link(self):
+        """DataIQView - POST on the ./bulk end point links to the progress of the whole bulk create"""
+        resp = self.app.post('/api/2/inf/dataiq/bulk',
+                             headers={'X-Auth': self.token},
+                             json={'image': '1.0.0',
+                                   'network': 'someLAN',
+                                   'machines': [{'name': 'box-1', 'static-ip': '192.168.1.2'}]})
+
+        self.assertTrue(resp.headers['Link'].endswith('/api/2/inf/dataiq/bulk/asdf-asdf-asdf>; rel=status'))
+
+    def _fake_bulk(self, *children):
+        """Make AsyncResult return a finished bulk create task, and the given create tasks"""
+        bulk = MagicMock()
+        bulk.status = 'SUCCESS'
+        bulk.result = {'content': {'tasks': {'box-{}'.format(x): 'task-{}'.format(x) for x in range(len(children))}},
+                       'error': None,
+                       'params': {}}
+        results = {'bulk-task': bulk}
+        for idx, (status, result) in enumerate(children):
+            results['task-{}'.format(idx)] = MagicMock(status=status, result=result)
+        self.app.application.celery_app.AsyncResult.side_effect = lambda x: results[x]
+
+    def test_bulk_status_running(self):
+        """DataIQView - GET on ./bulk/<task-id> returns HTTP 202 and the progress of every machine while any are running"""
+        self._fake_bulk(('SUCCESS', {'content': {'box-0': {}}, 'error': None, 'params': {}}),
+                        ('PROGRESS', {'stage': 'gui'}),
+                        ('PENDING', None))
+        resp = self.app.get('/api/2/inf/dataiq/bulk/bulk-task',
+                            headers={'X-Auth': self.token})
+        progress = resp.json['content']['progress']
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual((progress['total'], progress['done'], progress['failed'], progress['running']), (3, 1, 0, 2))
+        self.assertEqual(progress['tasks'], {'box-0': 'SUCCESS', 'box-1': 'PROGRESS', 'box-2': 'PENDING'})
+
+    def test_bulk_status_done(self):
+        """DataIQView - GET on ./bulk/<task-id> returns HTTP 200 and every machine once they're all created"""
+        self._fake_bulk(('SUCCESS', {'content': {'box-0': {'ips': ['10.7.7.2']}}, 'error': None, 'params': {}}),
+                        ('SUCCESS', {'content': {'box-1': {'ips': ['10.7.7.3']}}, 'error': None, 'params': {}}))
+        resp = self.app.get('/api/2/inf/dataiq/bulk/bulk-task',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(sorted(resp.json['content']['machines'].keys()), ['box-0', 'box-1'])
+
+    def test_bulk_status_failed(self):
+        """DataIQView - GET on ./bulk/<task-id> returns HTTP 400 if any machine failed, once they've all finished"""
+        self._fake_bulk(('SUCCESS', {'content': {'box-0': {}}, 'error': None, 'params': {}}),
+                        ('SUCCESS', {'content': {}, 'error': 'testing', 'params': {}}),
+                        ('FAILURE', RuntimeError('boom')))
+        resp = self.app.get('/api/2/inf/dataiq/bulk/bulk-task',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json['content']['progress']['failed'], 2)
+        self.assertEqual(resp.json['error'], 'Failed to create 2 of 3 machines: box-1: testing; box-2: boom')
+
+    def test_bulk_status_dispatching(self):
+        """DataIQView - GET on ./bulk/<task-id> returns HTTP 202 until the creates are dispatched"""
+        self.app.application.celery_app.AsyncResult.return_value.status = 'PENDING'
+        resp = self.app.get('/api/2/inf/dataiq/bulk/bulk-task',
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+
+    def test_bulk_delete(self):
+        """DataIQView - DELETE on the ./bulk end point returns a task-id"""
+        resp = self.app.delete('/api/2/inf/dataiq/bulk',
+                               headers={'X-Auth': self.token},
+                               json={'names': ['box-1', 'box-2']})
+
+        task_id = resp.json['content']['task-id']
+        sent = self.app.application.celery_app.send_task.call_args[0]
+
+        self.assertEqual(task_id, 'asdf-asdf-asdf')
+        self.assertEqual(sent[0], 'dataiq.bulk_delete')
+        self.assertEqual(sent[1][1], ['box-1', 'box-2'])
+
+    def test_bulk_delete_all(self):
+        """DataIQView - DELETE on the ./bulk end point can delete every DataIQ the user owns"""
+        self.app.delete('/api/2/inf/dataiq/bulk',
+                        headers={'X-Auth': self.token},
+                        json={'all': True})
+
+        machine_names = self.app.application.celery_app.send_task.call_args[0][1][1]
+
+        self.assertTrue(machine_names is None)
+
+    def test_bulk_delete_requires_names(self):
+        """DataIQView - DELETE on the ./bulk end point requires a list of names, or all"""
+        resp = self.app.delete('/api/2/inf/dataiq/bulk',
+                               headers={'X-Auth': self.token},
+                               json={})
+
+        self.assertEqual(resp.status_code, 400)
+
 
 if __name__ == '__main__':
     unittest.main()
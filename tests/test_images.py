@@ -0,0 +1,324 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in images.py
+"""
+import io
+import os
+import shutil
+import tarfile
+import hashlib
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_dataiq_api.lib import images
+
+OVF = """<Envelope><NetworkSection><Network ovf:name="VM Network"></Network></NetworkSection>
+<VirtualHardwareSection>
+<Item><rasd:ResourceType>3</rasd:ResourceType><rasd:VirtualQuantity>4</rasd:VirtualQuantity></Item>
+<Item><rasd:ResourceType>4</rasd:ResourceType><rasd:VirtualQuantity>16384</rasd:VirtualQuantity></Item>
+</VirtualHardwareSection></Envelope>"""
+
+
+class TestImages(unittest.TestCase):
+    """A set of test cases for images.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.cache_dir = tempfile.mkdtemp()
+        self.images_dir = tempfile.mkdtemp()
+        self.patcher = patch.object(images, 'const')
+        self.lock_patcher = patch.object(images, 'file_lock')
+        fake_const = self.patcher.start()
+        self.fake_file_lock = self.lock_patcher.start()
+        fake_const.VLAB_DATAIQ_CACHE_DIR = self.cache_dir
+        fake_const.VLAB_DATAIQ_IMAGES_DIR = self.images_dir
+        fake_const.VLAB_DATAIQ_IMAGE_MANIFEST_TTL = 60
+        self.ova_path = os.path.join(self.images_dir, 'dataiq-1.0.0.ova')
+        self._make_ova(self.ova_path)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        self.lock_patcher.stop()
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.images_dir)
+
+    def _make_ova(self, ova_path, disks=1):
+        """Create a tiny OVA"""
+        files = [('dataiq.ovf', OVF.encode())]
+        files += [('dataiq-disk{}.vmdk'.format(x), b'some disk data') for x in range(disks)]
+        with tarfile.open(ova_path, 'w') as the_tar:
+            for name, data in files:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                the_tar.addfile(info, io.BytesIO(data))
+
+    def test_manifest(self):
+        """``manifest`` describes every OVA in the images directory"""
+        output = images.manifest()
+
+        self.assertEqual(list(output.keys()), ['1.0.0'])
+        self.assertEqual(output['1.0.0']['file'], 'dataiq-1.0.0.ova')
+
+    def test_manifest_networks(self):
+        """``manifest`` records the networks in the OVF descriptor"""
+        output = images.manifest()
+
+        self.assertEqual(output['1.0.0']['networks'], ['VM Network'])
+
+    def test_manifest_disks(self):
+        """``manifest`` records how many disks an OVA has"""
+        self._make_ova(os.path.join(self.images_dir, 'dataiq-2.0.0.ova'), disks=2)
+
+        output = images.manifest()
+
+        self.assertEqual(output['2.0.0']['disks'], 2)
+
+    def test_manifest_sizing(self):
+        """``manifest`` records the default CPU and RAM (in GB) of an image"""
+        output = images.manifest()
+
+        self.assertEqual(output['1.0.0']['cpu_count'], 4)
+        self.assertEqual(output['1.0.0']['ram'], 16)
+
+    def test_manifest_checksum(self):
+        """``manifest`` records the SHA256 of the whole OVA"""
+        with open(self.ova_path, 'rb') as the_file:
+            expected = hashlib.sha256(the_file.read()).hexdigest()
+
+        output = images.manifest()
+
+        self.assertEqual(output['1.0.0']['sha256'], expected)
+
+    def test_manifest_only_ova(self):
+        """``manifest`` ignores the meta data of baked images, and OVAs still being written"""
+        with open(os.path.join(self.images_dir, 'dataiq-1.0.0-gui.json'), 'w') as the_file:
+            the_file.write('{}')
+        self._make_ova(os.path.join(self.images_dir, '.dataiq-2.0.0.ova'))
+
+        output = images.manifest()
+
+        self.assertEqual(list(output.keys()), ['1.0.0'])
+
+    def test_manifest_cached(self):
+        """``manifest`` doesn't scan the images directory while it's unchanged"""
+        images.manifest()
+
+        with patch.object(images, '_refresh') as fake_refresh:
+            images.manifest()
+
+        self.assertFalse(fake_refresh.called)
+
+    def test_manifest_locked(self):
+        """``manifest`` only refreshes while holding the images lock"""
+        images.manifest()
+
+        self.fake_file_lock.assert_called_with('images')
+
+    def test_manifest_refreshed_while_waiting(self):
+        """``manifest`` doesn't refresh again if another process did while it waited for the lock"""
+        images.manifest()
+        images.const.VLAB_DATAIQ_IMAGE_MANIFEST_TTL = 0
+        manifest_path = os.path.join(self.cache_dir, 'images.json')
+
+        def other_process_refreshed(name):
+            images.const.VLAB_DATAIQ_IMAGE_MANIFEST_TTL = 60
+            os.utime(manifest_path)
+            return MagicMock()
+        self.fake_file_lock.side_effect = other_process_refreshed
+
+        with patch.object(images, '_refresh') as fake_refresh:
+            output = images.manifest()
+
+        self.assertFalse(fake_refresh.called)
+        self.assertEqual(list(output.keys()), ['1.0.0'])
+
+    def test_manifest_expired(self):
+        """``manifest`` scans the images directory again once the TTL expires"""
+        images.manifest()
+        images.const.VLAB_DATAIQ_IMAGE_MANIFEST_TTL = 0
+
+        with patch.object(images, '_refresh') as fake_refresh:
+            fake_refresh.return_value = {}
+            images.manifest()
+
+        self.assertTrue(fake_refresh.called)
+
+    def test_manifest_new_image(self):
+        """``manifest`` picks up a new OVA"""
+        images.manifest()
+        self._make_ova(os.path.join(self.images_dir, 'dataiq-2.0.0.ova'))
+        # Don't rely on the resolution of the mtime of the directory
+        images.const.VLAB_DATAIQ_IMAGE_MANIFEST_TTL = 0
+
+        output = images.manifest()
+
+        self.assertEqual(set(output.keys()), {'1.0.0', '2.0.0'})
+
+    def test_manifest_incremental(self):
+        """``manifest`` only reads the OVAs that changed"""
+        images.manifest()
+        self._make_ova(os.path.join(self.images_dir, 'dataiq-2.0.0.ova'))
+        images.const.VLAB_DATAIQ_IMAGE_MANIFEST_TTL = 0
+
+        with patch.object(images, '_describe_ova', wraps=images._describe_ova) as fake_describe_ova:
+            images.manifest()
+
+        described = [os.path.basename(x[0][0]) for x in fake_describe_ova.call_args_list]
+        self.assertEqual(described, ['dataiq-2.0.0.ova'])
+
+    def test_manifest_corrupt(self):
+        """``manifest`` lists an OVA it can't read, but without any details"""
+        with open(os.path.join(self.images_dir, 'dataiq-2.0.0.ova'), 'wb') as the_file:
+            the_file.write(b'not a tar file')
+
+        output = images.manifest()
+
+        self.assertEqual(output['2.0.0']['networks'], [])
+        self.assertTrue(output['2.0.0']['sha256'] is None)
+
+    def test_manifest_no_images_dir(self):
+        """``manifest`` is empty if the images directory doesn't exist"""
+        shutil.rmtree(self.images_dir)
+
+        output = images.manifest()
+
+        self.assertEqual(output, {})
+        os.makedirs(self.images_dir)
+
+    def test_listing(self):
+        """``listing`` has the version, file, size and mtime of every OVA"""
+        info = os.stat(self.ova_path)
+
+        output = images.listing()
+        expected = {'1.0.0': {'version': '1.0.0', 'file': 'dataiq-1.0.0.ova',
+                              'size': info.st_size, 'mtime': int(info.st_mtime)}}
+
+        self.assertEqual(output, expected)
+
+    def test_listing_no_read(self):
+        """``listing`` doesn't read the OVAs"""
+        with patch.object(images, '_describe_ova') as fake_describe_ova:
+            images.listing()
+
+        self.assertFalse(fake_describe_ova.called)
+
+    def test_listing_etag(self):
+        """``listing`` and ``manifest`` have the same ETag"""
+        self.assertEqual(images.etag(images.listing()), images.etag(images.manifest()))
+
+    def test_saved(self):
+        """``saved`` returns the manifest as it was last written"""
+        images.manifest()
+
+        output = images.saved()
+
+        self.assertEqual(output['1.0.0']['networks'], ['VM Network'])
+
+    def test_saved_no_refresh(self):
+        """``saved`` doesn't read the OVAs, even if the manifest is out of date"""
+        with patch.object(images, '_describe_ova') as fake_describe_ova:
+            output = images.saved()
+
+        self.assertEqual(output, {})
+        self.assertFalse(fake_describe_ova.called)
+
+    def test_available(self):
+        """``available`` is True when the images directory exists"""
+        self.assertTrue(images.available())
+
+    def test_available_not_mounted(self):
+        """``available`` is False when the images directory doesn't exist"""
+        images.const.VLAB_DATAIQ_IMAGES_DIR = os.path.join(self.images_dir, 'nope')
+
+        self.assertFalse(images.available())
+
+    def test_etag(self):
+        """``etag`` is the same for the same images"""
+        self.assertEqual(images.etag(images.manifest()), images.etag(images.manifest()))
+
+    def test_etag_changed(self):
+        """``etag`` changes when an image is added"""
+        before = images.etag(images.manifest())
+        self._make_ova(os.path.join(self.images_dir, 'dataiq-2.0.0.ova'))
+        images.const.VLAB_DATAIQ_IMAGE_MANIFEST_TTL = 0
+
+        after = images.etag(images.manifest())
+
+        self.assertNotEqual(before, after)
+
+    def test_version_key(self):
+        """``version_key`` compares the components of a version as numbers"""
+        self.assertTrue(images.version_key('1.10.0') > images.version_key('1.9.0'))
+
+    def test_version_key_baked(self):
+        """``version_key`` sorts a baked image just after the image it was made from"""
+        ordered = sorted(['1.1.0', '1.0.0-gui', '1.0.0'], key=images.version_key)
+
+        self.assertEqual(ordered, ['1.0.0', '1.0.0-gui', '1.1.0'])
+
+    def test_version_key_words(self):
+        """``version_key`` doesn't choke on a component that isn't a number"""
+        ordered = sorted(['1.0.beta', '1.0.1'], key=images.version_key)
+
+        self.assertEqual(ordered, ['1.0.1', '1.0.beta'])
+
+    def test_select(self):
+        """``select`` sorts versions oldest first"""
+        output = images.select(['2.0.0', '1.10.0', '1.9.0'])
+
+        self.assertEqual(output, ['1.9.0', '1.10.0', '2.0.0'])
+
+    def test_select_prefix(self):
+        """``select`` only keeps versions whose components start with the prefix"""
+        output = images.select(['1.2.0', '1.2.1-gui', '1.20.0', '2.0.0'], prefix='1.2')
+
+        self.assertEqual(output, ['1.2.0', '1.2.1-gui'])
+
+    def test_select_latest(self):
+        """``select`` can keep only the newest version"""
+        output = images.select(['1.10.0', '1.9.0'], latest=True)
+
+        self.assertEqual(output, ['1.10.0'])
+
+    def test_select_latest_empty(self):
+        """``select`` returns an empty list for latest if there are no versions"""
+        output = images.select([], latest=True)
+
+        self.assertEqual(output, [])
+
+    def test_resolve(self):
+        """``resolve`` returns a specific version as is"""
+        self.assertEqual(images.resolve('1.0.0'), '1.0.0')
+
+    def test_resolve_latest(self):
+        """``resolve`` converts 'latest' to the newest image"""
+        self._make_ova(os.path.join(self.images_dir, 'dataiq-1.10.0.ova'))
+
+        self.assertEqual(images.resolve('latest'), '1.10.0')
+
+    def test_resolve_no_read(self):
+        """``resolve`` doesn't read the OVAs"""
+        with patch.object(images, '_describe_ova') as fake_describe_ova:
+            images.resolve('latest')
+
+        self.assertFalse(fake_describe_ova.called)
+
+    def test_resolve_no_images(self):
+        """``resolve`` raises ValueError for 'latest' when there are no images"""
+        os.remove(self.ova_path)
+
+        with self.assertRaises(ValueError):
+            images.resolve('latest')
+
+    def test_to_version(self):
+        """``to_version`` converts the name of an OVA to a version"""
+        self.assertEqual(images.to_version('dataiq-1.0.0-gui.ova'), '1.0.0-gui')
+
+    def test_to_file_name(self):
+        """``to_file_name`` converts a version to the name of an OVA"""
+        self.assertEqual(images.to_file_name('1.0.0'), 'dataiq-1.0.0.ova')
+
+
+if __name__ == '__main__':
+    unittest.main()
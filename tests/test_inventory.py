@@ -0,0 +1,141 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in inventory.py
+"""
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_dataiq_api.lib.worker import inventory
+
+
+def _make_update(obj, kind, changes):
+    """Build a fake ``WaitForUpdatesEx`` response for a single object"""
+    obj_update = MagicMock()
+    obj_update.obj = obj
+    obj_update.kind = kind
+    obj_update.changeSet = [inventory.vim.PropertyChange(name=x, op='assign', val=y) for x, y in changes.items()]
+    filter_update = MagicMock()
+    filter_update.objectSet = [obj_update]
+    update = MagicMock()
+    update.filterSet = [filter_update]
+    return update
+
+
+class TestLiveInventory(unittest.TestCase):
+    """A set of test cases for the LiveInventory object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.live = inventory.LiveInventory(wait=30)
+        folder = inventory.vim.Folder('group-1')
+        self.live._apply(_make_update(folder, 'enter', {'name': 'alice'}))
+        vm = inventory.vim.VirtualMachine('vm-1')
+        self.live._apply(_make_update(vm, 'enter', {'name': 'myDataIQ',
+                                                    'parent': folder,
+                                                    'config.annotation': '{"component": "DataIQ"}'}))
+        other_vm = inventory.vim.VirtualMachine('vm-2')
+        self.live._apply(_make_update(other_vm, 'enter', {'name': 'myOneFS',
+                                                          'parent': folder,
+                                                          'config.annotation': '{"component": "OneFS"}'}))
+
+    def test_dataiq_vms(self):
+        """``LiveInventory`` - ``dataiq_vms`` only returns the user's DataIQ machines"""
+        output = self.live.dataiq_vms('alice')
+        expected = {'myDataIQ': 'vm-1'}
+
+        self.assertEqual(output, expected)
+
+    def test_dataiq_vms_other_user(self):
+        """``LiveInventory`` - ``dataiq_vms`` doesn't return VMs owned by other users"""
+        output = self.live.dataiq_vms('bob')
+
+        self.assertEqual(output, {})
+
+    def test_find(self):
+        """``LiveInventory`` - ``find`` returns the moId of a VM"""
+        output = self.live.find('alice', 'myDataIQ')
+
+        self.assertEqual(output, 'vm-1')
+
+    def test_modify(self):
+        """``LiveInventory`` - Renaming a VM updates the index"""
+        vm = inventory.vim.VirtualMachine('vm-1')
+        self.live._apply(_make_update(vm, 'modify', {'name': 'newName'}))
+
+        output = self.live.find('alice', 'newName')
+
+        self.assertEqual(output, 'vm-1')
+
+    def test_leave(self):
+        """``LiveInventory`` - Deleted VMs are removed from the index"""
+        vm = inventory.vim.VirtualMachine('vm-1')
+        self.live._apply(_make_update(vm, 'leave', {}))
+
+        output = self.live.dataiq_vms('alice')
+
+        self.assertEqual(output, {})
+
+    def test_not_healthy_before_sync(self):
+        """``LiveInventory`` - Not healthy until the initial sync is done"""
+        self.live.is_alive = lambda: True
+        self.live._heartbeat = time.time()
+
+        self.assertFalse(self.live.healthy)
+
+    def test_healthy(self):
+        """``LiveInventory`` - Healthy when synced and recently heard from vCenter"""
+        self.live.is_alive = lambda: True
+        self.live._heartbeat = time.time()
+        self.live._synced = True
+
+        self.assertTrue(self.live.healthy)
+
+    def test_not_healthy_stale(self):
+        """``LiveInventory`` - Not healthy when vCenter hasn't been heard from in a while"""
+        self.live.is_alive = lambda: True
+        self.live._heartbeat = time.time() - 61
+        self.live._synced = True
+
+        self.assertFalse(self.live.healthy)
+
+
+class TestInventory(unittest.TestCase):
+    """A set of test cases for the module functions in inventory.py"""
+    def tearDown(self):
+        """Runs after every test case"""
+        inventory._INVENTORY = None
+
+    def test_is_dataiq(self):
+        """``_is_dataiq`` returns False for VMs without meta data"""
+        self.assertFalse(inventory._is_dataiq(None))
+
+    @patch.object(inventory, 'LiveInventory')
+    @patch.object(inventory, 'const')
+    def test_start_disabled(self, fake_const, fake_LiveInventory):
+        """``start`` doesn't follow the feed unless enabled"""
+        fake_const.VLAB_DATAIQ_LIVE_INVENTORY = False
+
+        inventory.start()
+
+        self.assertFalse(fake_LiveInventory.called)
+
+    @patch.object(inventory, 'LiveInventory')
+    @patch.object(inventory, 'const')
+    def test_start(self, fake_const, fake_LiveInventory):
+        """``start`` follows the feed in a background thread when enabled"""
+        fake_const.VLAB_DATAIQ_LIVE_INVENTORY = True
+
+        inventory.start()
+
+        self.assertTrue(fake_LiveInventory.return_value.start.called)
+
+    def test_get_inventory_unhealthy(self):
+        """``get_inventory`` returns None when the feed is unhealthy"""
+        inventory._INVENTORY = MagicMock()
+        inventory._INVENTORY.healthy = False
+
+        self.assertTrue(inventory.get_inventory() is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
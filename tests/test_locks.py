@@ -0,0 +1,73 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in locks.py
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_dataiq_api.lib import locks
+
+
+class TestLocks(unittest.TestCase):
+    """A set of test cases for locks.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.cache_dir = tempfile.mkdtemp()
+        self.patcher = patch.object(locks, 'const')
+        fake_const = self.patcher.start()
+        fake_const.VLAB_DATAIQ_CACHE_DIR = self.cache_dir
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.patcher.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_file_lock(self):
+        """``file_lock`` creates the lock file in the cache directory"""
+        with locks.file_lock('someName'):
+            lock_files = os.listdir(os.path.join(self.cache_dir, 'locks'))
+
+        self.assertEqual(len(lock_files), 1)
+
+    def test_file_lock_releases(self):
+        """``file_lock`` can be obtained again once released"""
+        with locks.file_lock('someName'):
+            pass
+        with locks.file_lock('someName'):
+            obtained = True
+
+        self.assertTrue(obtained)
+
+    def test_file_lock_non_blocking(self):
+        """``file_lock`` doesn't wait for a lock that's already held when blocking=False"""
+        with locks.file_lock('someName'):
+            # flock locks belong to the open file, so a second open contends like another process would
+            with locks.file_lock('someName', blocking=False) as obtained:
+                pass
+
+        self.assertFalse(obtained)
+
+    def test_file_lock_non_blocking_free(self):
+        """``file_lock`` obtains a free lock when blocking=False"""
+        with locks.file_lock('someName', blocking=False) as obtained:
+            pass
+
+        self.assertTrue(obtained)
+
+    def test_process_alive(self):
+        """``process_alive`` returns True for a running process"""
+        self.assertTrue(locks.process_alive(os.getpid()))
+
+    @patch.object(locks.os, 'kill')
+    def test_process_alive_gone(self, fake_kill):
+        """``process_alive`` returns False for a process that's exited"""
+        fake_kill.side_effect = ProcessLookupError()
+
+        self.assertFalse(locks.process_alive(1234))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in lookups.py
+"""
+import unittest
+from unittest.mock import MagicMock
+
+from vlab_dataiq_api.lib.worker import lookups
+
+
+def _make_networks(*names):
+    """Build the fake networks that ``vCenter.get_by_type`` returns"""
+    networks = []
+    for name in names:
+        network = MagicMock()
+        network.name = name
+        networks.append(network)
+    return networks
+
+
+class TestLookups(unittest.TestCase):
+    """A set of test cases for lookups.py"""
+    def test_folder(self):
+        """``folder`` only searches vCenter the first time a name is looked up"""
+        fake_vcenter = MagicMock()
+
+        first = lookups.folder(fake_vcenter, 'alice')
+        second = lookups.folder(fake_vcenter, 'alice')
+
+        self.assertTrue(first is second)
+        self.assertEqual(fake_vcenter.get_by_name.call_count, 1)
+
+    def test_folder_missing(self):
+        """``folder`` raises ValueError, and doesn't index a folder that doesn't exist"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.get_by_name.side_effect = [ValueError('testing'), MagicMock()]
+
+        with self.assertRaises(ValueError):
+            lookups.folder(fake_vcenter, 'alice')
+        lookups.folder(fake_vcenter, 'alice')
+
+        self.assertEqual(fake_vcenter.get_by_name.call_count, 2)
+
+    def test_folder_per_session(self):
+        """``folder`` keeps a separate index for every session"""
+        vcenter1, vcenter2 = MagicMock(), MagicMock()
+
+        lookups.folder(vcenter1, 'alice')
+        lookups.folder(vcenter2, 'alice')
+
+        self.assertTrue(vcenter2.get_by_name.called)
+
+    def test_network(self):
+        """``network`` indexes every network from a single scan"""
+        fake_vcenter = MagicMock()
+        lan, wan = _make_networks('alice_lan', 'alice_wan')
+        fake_vcenter.get_by_type.return_value = [lan, wan]
+
+        lookups.network(fake_vcenter, 'alice_lan')
+        output = lookups.network(fake_vcenter, 'alice_wan')
+
+        self.assertTrue(output is wan)
+        self.assertEqual(fake_vcenter.get_by_type.call_count, 1)
+
+    def test_network_miss(self):
+        """``network`` scans again when a name isn't indexed, to find new networks"""
+        fake_vcenter = MagicMock()
+        lan, new = _make_networks('alice_lan', 'alice_new')
+        fake_vcenter.get_by_type.return_value = [lan]
+        lookups.network(fake_vcenter, 'alice_lan')
+        fake_vcenter.get_by_type.return_value = [lan, new]
+
+        output = lookups.network(fake_vcenter, 'alice_new')
+
+        self.assertTrue(output is new)
+
+    def test_network_own_cache(self):
+        """``network`` doesn't use (or reset) the network cache of the vCenter object"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.get_by_type.return_value = _make_networks('alice_lan')
+
+        lookups.network(fake_vcenter, 'alice_lan')
+
+        self.assertFalse('_net_cache' in vars(fake_vcenter))
+
+    def test_network_missing(self):
+        """``network`` raises ValueError when there's no such network"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.get_by_type.return_value = []
+
+        with self.assertRaises(ValueError):
+            lookups.network(fake_vcenter, 'alice_lan')
+
+    def test_forget(self):
+        """``forget`` makes the next lookup search vCenter again"""
+        fake_vcenter = MagicMock()
+        lookups.folder(fake_vcenter, 'alice')
+
+        lookups.forget(fake_vcenter)
+        lookups.folder(fake_vcenter, 'alice')
+
+        self.assertEqual(fake_vcenter.get_by_name.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in metrics.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from flask import Flask
+
+from vlab_dataiq_api.lib import metrics
+from vlab_dataiq_api.lib.views import MetricsView
+
+
+class TestMetrics(unittest.TestCase):
+    """A set of test cases for metrics.py"""
+    def test_stamp_sent_time(self):
+        """``stamp_sent_time`` adds when the task was sent to the message headers"""
+        headers = {}
+
+        metrics.stamp_sent_time(headers=headers)
+
+        self.assertTrue(isinstance(headers['sent_at'], float))
+
+    def test_stamp_sent_time_no_headers(self):
+        """``stamp_sent_time`` doesn't fail when the message has no headers"""
+        metrics.stamp_sent_time(headers=None)
+
+    def test_multiprocess_mode(self):
+        """Importing metrics puts prometheus_client in multiprocess mode"""
+        # Only imported here; importing it before metrics is the bug being tested
+        from prometheus_client import values
+
+        self.assertEqual(values.ValueClass.__name__, 'MmapedValue')
+
+    @patch.object(metrics.os, 'remove')
+    @patch.object(metrics.os, 'listdir')
+    @patch.dict(metrics.os.environ, {'PROMETHEUS_MULTIPROC_DIR': '/some/dir'})
+    def test_setup(self, fake_listdir, fake_remove):
+        """``setup`` discards the samples of processes that ran before this one"""
+        fake_listdir.return_value = ['counter_1234.db']
+
+        metrics.setup()
+
+        fake_remove.assert_called_with('/some/dir/counter_1234.db')
+
+    @patch.object(metrics, 'VCENTER_CALLS')
+    @patch.object(metrics.SoapStubAdapter, 'InvokeMethod')
+    def test_count_vcenter_calls(self, fake_invoke_method, fake_vcenter_calls):
+        """``count_vcenter_calls`` counts every SOAP call the pyVmomi stub makes, by name"""
+        info = MagicMock()
+        info.wsdlName = 'PowerOnVM_Task'
+
+        metrics.count_vcenter_calls()
+        metrics.SoapStubAdapter.InvokeMethod('stub', 'mo', info, ())
+
+        fake_vcenter_calls.labels.assert_called_with(name='PowerOnVM_Task')
+        fake_invoke_method.assert_called_with('stub', 'mo', info, (), None)
+
+    @patch.object(metrics, 'VCENTER_CALLS')
+    @patch.object(metrics.SoapStubAdapter, 'InvokeMethod')
+    def test_count_vcenter_calls_once(self, fake_invoke_method, fake_vcenter_calls):
+        """``count_vcenter_calls`` doesn't count a call twice when it's called again"""
+        metrics.count_vcenter_calls()
+        metrics.count_vcenter_calls()
+        metrics.SoapStubAdapter.InvokeMethod('stub', 'mo', MagicMock(), ())
+
+        self.assertEqual(fake_vcenter_calls.labels.call_count, 1)
+
+    @patch.object(metrics, 'start_http_server')
+    def test_start_exporter_disabled(self, fake_start_http_server):
+        """``start_exporter`` does nothing when the port is zero"""
+        metrics.start_exporter(0)
+
+        self.assertFalse(fake_start_http_server.called)
+
+    @patch.object(metrics, 'REQUEST_SECONDS')
+    def test_time_requests(self, fake_request_seconds):
+        """``time_requests`` labels the latency by the route, not the URL"""
+        app = Flask(__name__)
+        app.add_url_rule('/thing/<name>', 'thing', lambda name: 'ok')
+        metrics.time_requests(app)
+
+        app.test_client().get('/thing/foo')
+
+        fake_request_seconds.labels.assert_called_with(route='/thing/<name>', method='GET', status=200)
+
+
+class TestMetricsView(unittest.TestCase):
+    """A set of test cases for the MetricsView object"""
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        app = Flask(__name__)
+        MetricsView.register(app)
+        app.config['TESTING'] = True
+        cls.app = app.test_client()
+
+    @patch.object(metrics, 'collect')
+    def test_get(self, fake_collect):
+        """GET on /metrics returns the Prometheus text format"""
+        fake_collect.return_value = (b'dataiq_task_seconds_count 1.0\n', 'text/plain; version=0.0.4; charset=utf-8')
+
+        resp = self.app.get('/metrics')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b'dataiq_task_seconds_count 1.0\n')
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in ova_cache.py
+"""
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_dataiq_api.lib.worker import ova_cache
+
+OVF = '<Envelope><NetworkSection><Network ovf:name="VM Network"></Network></NetworkSection></Envelope>'
+
+
+class TestOvaCache(unittest.TestCase):
+    """A set of test cases for ova_cache.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.cache_dir = tempfile.mkdtemp()
+        self.images_dir = tempfile.mkdtemp()
+        self.patchers = [patch.object(ova_cache, 'const'), patch.object(ova_cache, 'file_lock'),
+                         patch.object(ova_cache.images, 'saved')]
+        fake_const, _, self.fake_saved = [x.start() for x in self.patchers]
+        self.fake_saved.return_value = {}
+        fake_const.VLAB_DATAIQ_CACHE_DIR = self.cache_dir
+        fake_const.VLAB_DATAIQ_UPLOAD_PARALLEL = 2
+        self.ova_path = os.path.join(self.images_dir, 'dataiq-1.0.0.ova')
+        self._make_ova(self.ova_path, b'some disk data')
+
+    def tearDown(self):
+        """Runs after every test case"""
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.images_dir)
+
+    def _make_ova(self, ova_path, disk_data, more_disks=None):
+        """Create a tiny OVA"""
+        files = [('dataiq.ovf', OVF.encode()), ('dataiq-disk1.vmdk', disk_data)] + (more_disks or [])
+        with tarfile.open(ova_path, 'w') as the_tar:
+            for name, data in files:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                the_tar.addfile(info, io.BytesIO(data))
+
+    def test_open_ova(self):
+        """``open_ova`` extracts the OVF descriptor and disks"""
+        ova = ova_cache.open_ova(self.ova_path)
+
+        self.assertEqual(ova.ovf, OVF)
+        self.assertEqual(ova.vmdks, ['dataiq-disk1.vmdk'])
+
+    def test_open_ova_networks(self):
+        """``open_ova`` parses the network names out of the OVF descriptor"""
+        ova = ova_cache.open_ova(self.ova_path)
+
+        self.assertEqual(ova.networks, ['VM Network'])
+
+    def test_open_ova_checksum(self):
+        """``open_ova`` records the checksum of the OVA, from the image manifest, as it was last written"""
+        info = os.stat(self.ova_path)
+        self.fake_saved.return_value = {'1.0.0': {'mtime': int(info.st_mtime),
+                                                  'size': info.st_size,
+                                                  'sha256': 'abc123'}}
+
+        ova = ova_cache.open_ova(self.ova_path)
+
+        self.assertEqual(ova.manifest['sha256'], 'abc123')
+
+    def test_open_ova_checksum_changed(self):
+        """``open_ova`` doesn't record the checksum of a different copy of the OVA"""
+        self.fake_saved.return_value = {'1.0.0': {'mtime': 1, 'size': 2, 'sha256': 'abc123'}}
+
+        ova = ova_cache.open_ova(self.ova_path)
+
+        self.assertTrue(ova.manifest['sha256'] is None)
+
+    @patch.object(ova_cache.images, 'manifest')
+    def test_open_ova_no_hashing(self, fake_manifest):
+        """``open_ova`` doesn't refresh the image manifest, which would hash every changed OVA"""
+        ova_cache.open_ova(self.ova_path)
+
+        self.assertFalse(fake_manifest.called)
+
+    def test_open_ova_reuse(self):
+        """``open_ova`` doesn't extract an OVA a second time"""
+        ova_cache.open_ova(self.ova_path)
+
+        with patch.object(ova_cache, '_extract') as fake_extract:
+            ova_cache.open_ova(self.ova_path)
+
+        self.assertFalse(fake_extract.called)
+
+    def test_open_ova_changed(self):
+        """``open_ova`` replaces the extract once the OVA changes"""
+        ova_cache.open_ova(self.ova_path)
+        self._make_ova(self.ova_path, b'some new, longer, disk data')
+        os.utime(self.ova_path, (1, 1))
+
+        ova = ova_cache.open_ova(self.ova_path)
+
+        self.assertEqual(ova.manifest['disks']['dataiq-disk1.vmdk'], 27)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, 'ova'))), 1)
+
+    def test_open_ova_missing(self):
+        """``open_ova`` raises ValueError if the image doesn't exist"""
+        with self.assertRaises(ValueError):
+            ova_cache.open_ova(os.path.join(self.images_dir, 'dataiq-2.0.0.ova'))
+
+    @patch.object(ova_cache, 'urlopen')
+    def test_deploy(self, fake_urlopen):
+        """``CachedOva.deploy`` uploads every disk, then completes the lease"""
+        uploaded = []
+        fake_urlopen.side_effect = lambda req, context: uploaded.append(b''.join(bytes(x) for x in req.data))
+        fake_lease = MagicMock()
+        fake_lease.info.deviceUrl = [MagicMock(importKey='disk1', url='https://esxi/disk1')]
+        fake_spec = MagicMock()
+        fake_spec.fileItem = [MagicMock(path='dataiq-disk1.vmdk', deviceId='disk1')]
+        ova = ova_cache.open_ova(self.ova_path)
+
+        ova.deploy(fake_spec, fake_lease, 'esxi')
+
+        self.assertEqual(uploaded, [b'some disk data'])
+        self.assertTrue(fake_lease.Complete.called)
+
+    @patch.object(ova_cache, 'urlopen')
+    def test_deploy_many_disks(self, fake_urlopen):
+        """``CachedOva.deploy`` uploads every disk of a multi-disk OVA"""
+        self._make_ova(self.ova_path, b'some disk data', more_disks=[('dataiq-disk2.vmdk', b'more data')])
+        uploaded = {}
+        fake_urlopen.side_effect = lambda req, context: uploaded.update({req.full_url: b''.join(bytes(x) for x in req.data)})
+        fake_lease = MagicMock()
+        fake_lease.info.deviceUrl = [MagicMock(importKey='disk1', url='https://esxi/disk1'),
+                                     MagicMock(importKey='disk2', url='https://esxi/disk2')]
+        fake_spec = MagicMock()
+        fake_spec.fileItem = [MagicMock(path='dataiq-disk1.vmdk', deviceId='disk1'),
+                              MagicMock(path='dataiq-disk2.vmdk', deviceId='disk2')]
+        ova = ova_cache.open_ova(self.ova_path)
+
+        ova.deploy(fake_spec, fake_lease, 'esxi')
+        expected = {'https://esxi/disk1': b'some disk data', 'https://esxi/disk2': b'more data'}
+
+        self.assertEqual(uploaded, expected)
+
+    @patch.object(ova_cache, 'urlopen')
+    def test_deploy_stats(self, fake_urlopen):
+        """``CachedOva.deploy`` records the throughput of every disk"""
+        fake_urlopen.side_effect = lambda req, context: [x for x in req.data]
+        fake_lease = MagicMock()
+        fake_lease.info.deviceUrl = [MagicMock(importKey='disk1', url='https://esxi/disk1')]
+        fake_spec = MagicMock()
+        fake_spec.fileItem = [MagicMock(path='dataiq-disk1.vmdk', deviceId='disk1')]
+        ova = ova_cache.open_ova(self.ova_path)
+        fake_logger = MagicMock()
+
+        ova.deploy(fake_spec, fake_lease, 'esxi')
+        ova.log_upload_stats(fake_logger)
+
+        self.assertEqual(ova.upload_stats['dataiq-disk1.vmdk']['bytes'], 14)
+        self.assertEqual(ova.upload_stats['dataiq-disk1.vmdk']['host'], 'esxi')
+        self.assertTrue(fake_logger.info.called)
+
+    def test_progress(self):
+        """``_Progress`` reports the bytes sent across every disk to the lease"""
+        fake_lease = MagicMock()
+        progress = ova_cache._Progress(fake_lease, 200)
+        progress.add('disk1', 50)
+        progress.add('disk2', 50)
+
+        with patch.object(progress, 'start'):
+            progress._chime()
+
+        fake_lease.Progress.assert_called_with(50)
+
+    def test_progress_callback(self):
+        """``_Progress`` passes the percent uploaded along to the callback"""
+        fake_on_progress = MagicMock()
+        progress = ova_cache._Progress(MagicMock(), 200, fake_on_progress)
+        progress.add('disk1', 50)
+
+        with patch.object(progress, 'start'):
+            progress._chime()
+
+        fake_on_progress.assert_called_with(25)
+
+    def test_progress_callback_error(self):
+        """``_Progress`` keeps the lease alive even if the callback fails"""
+        fake_on_progress = MagicMock()
+        fake_on_progress.side_effect = RuntimeError('testing')
+        progress = ova_cache._Progress(MagicMock(), 200, fake_on_progress)
+
+        with patch.object(progress, 'start') as fake_start:
+            progress._chime()
+
+        self.assertTrue(fake_start.called)
+
+    @patch.object(ova_cache, 'urlopen')
+    def test_deploy_error(self, fake_urlopen):
+        """``CachedOva.deploy`` aborts the lease if an upload fails"""
+        fake_urlopen.side_effect = RuntimeError('testing')
+        fake_lease = MagicMock()
+        fake_lease.info.deviceUrl = [MagicMock(importKey='disk1', url='https://esxi/disk1')]
+        fake_spec = MagicMock()
+        fake_spec.fileItem = [MagicMock(path='dataiq-disk1.vmdk', deviceId='disk1')]
+        ova = ova_cache.open_ova(self.ova_path)
+
+        with self.assertRaises(RuntimeError):
+            ova.deploy(fake_spec, fake_lease, 'esxi')
+
+        self.assertTrue(fake_lease.Abort.called)
+
+    def test_device_url_missing(self):
+        """``_device_url`` raises RuntimeError when the lease has no URL for the disk"""
+        fake_lease = MagicMock()
+        fake_lease.info.deviceUrl = []
+
+        with self.assertRaises(RuntimeError):
+            ova_cache._device_url(fake_lease, MagicMock())
+
+
+if __name__ == '__main__':
+    unittest.main()
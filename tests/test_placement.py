@@ -0,0 +1,163 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in placement.py
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_dataiq_api.lib.worker import placement
+
+GB = placement.GB
+
+
+def _snapshot():
+    """A capacity snapshot with two datastores and two hosts"""
+    return {'datastores' : {'ds1' : {'capacity' : 1000 * GB, 'free' : 800 * GB, 'uncommitted' : 0, 'hosts' : ['esxi1', 'esxi2']},
+                            'ds2' : {'capacity' : 1000 * GB, 'free' : 400 * GB, 'uncommitted' : 0, 'hosts' : ['esxi1', 'esxi2']}},
+            'hosts' : {'esxi1' : {'usable' : True, 'memory_used' : 0.5},
+                       'esxi2' : {'usable' : True, 'memory_used' : 0.2}}}
+
+
+class TestPlacement(unittest.TestCase):
+    """A set of test cases for placement.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.cache_dir = tempfile.mkdtemp()
+        self.patchers = [patch.object(placement, 'const'), patch.object(placement, 'file_lock')]
+        fake_const, _ = [x.start() for x in self.patchers]
+        fake_const.VLAB_DATAIQ_CACHE_DIR = self.cache_dir
+        fake_const.VLAB_DATAIQ_DATASTORES = ['ds1', 'ds2']
+        fake_const.VLAB_DATAIQ_MAX_PROVISIONED = 4.0
+        fake_const.VLAB_DATAIQ_PLACEMENT_TTL = 60
+
+    def tearDown(self):
+        """Runs after every test case"""
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_choose(self):
+        """``choose`` picks the datastore with the most room, and the host with the most free RAM"""
+        output = placement.choose(_snapshot(), {}, 100 * GB)
+
+        self.assertEqual(output['datastore'], 'ds1')
+        self.assertEqual(output['host'], 'esxi2')
+        self.assertEqual(output['free_gb'], 700)
+
+    def test_choose_running_deploys(self):
+        """``choose`` avoids a datastore and host that already have deploys running"""
+        deploys = {'a' : {'datastore' : 'ds1', 'host' : 'esxi2', 'bytes' : 10 * GB},
+                   'b' : {'datastore' : 'ds1', 'host' : 'esxi2', 'bytes' : 10 * GB}}
+        snapshot = _snapshot()
+        snapshot['datastores']['ds2']['free'] = 700 * GB
+
+        output = placement.choose(snapshot, deploys, 10 * GB)
+
+        self.assertEqual(output['datastore'], 'ds2')
+        self.assertEqual(output['host'], 'esxi1')
+
+    def test_choose_full(self):
+        """``choose`` skips a datastore the new VM would fill"""
+        output = placement.choose(_snapshot(), {}, 500 * GB)
+
+        self.assertEqual(output['datastore'], 'ds1')
+
+    def test_choose_overcommitted(self):
+        """``choose`` skips a datastore that's provisioned past ``VLAB_DATAIQ_MAX_PROVISIONED``"""
+        snapshot = _snapshot()
+        snapshot['datastores']['ds1']['uncommitted'] = 5000 * GB
+
+        output = placement.choose(snapshot, {}, 10 * GB)
+
+        self.assertEqual(output['datastore'], 'ds2')
+
+    def test_choose_unusable_hosts(self):
+        """``choose`` skips a datastore that's only mounted by hosts in maintenance mode"""
+        snapshot = _snapshot()
+        snapshot['datastores']['ds1']['hosts'] = ['esxi3']
+        snapshot['hosts']['esxi3'] = {'usable' : False, 'memory_used' : 0}
+
+        output = placement.choose(snapshot, {}, 10 * GB)
+
+        self.assertEqual(output['datastore'], 'ds2')
+
+    def test_choose_no_room(self):
+        """``choose`` raises RuntimeError when no datastore has room"""
+        with self.assertRaises(RuntimeError):
+            placement.choose(_snapshot(), {}, 5000 * GB)
+
+    @patch.object(placement, '_snapshot')
+    def test_placed(self, fake_snapshot):
+        """``placed`` counts the deploy against the datastore until it's done"""
+        fake_snapshot.return_value = _snapshot()
+
+        with placement.placed(MagicMock(), 100, MagicMock()) as location:
+            running = placement._load_deploys()
+        after = placement._load_deploys()
+
+        self.assertEqual(location['datastore'], 'ds1')
+        self.assertEqual([x['datastore'] for x in running.values()], ['ds1'])
+        self.assertEqual(after, {})
+
+    def test_placed_disabled(self):
+        """``placed`` yields None when no candidate datastores are configured"""
+        placement.const.VLAB_DATAIQ_DATASTORES = []
+
+        with placement.placed(MagicMock(), 100, MagicMock()) as location:
+            pass
+
+        self.assertTrue(location is None)
+
+    def test_load_deploys_stale(self):
+        """``_load_deploys`` drops deploys left behind by a process that's gone"""
+        placement._save_deploys({'a' : {'datastore' : 'ds1', 'host' : 'esxi1', 'bytes' : 1, 'pid' : os.getpid(), 'started' : time.time()},
+                                 'b' : {'datastore' : 'ds1', 'host' : 'esxi1', 'bytes' : 1, 'pid' : os.getpid(), 'started' : 1}})
+
+        output = placement._load_deploys()
+
+        self.assertEqual(list(output.keys()), ['a'])
+
+    def test_snapshot(self):
+        """``_snapshot`` reads the capacity of the candidate datastores"""
+        fake_vcenter = MagicMock()
+        fake_datastore = MagicMock()
+        fake_datastore.name = 'ds1'
+        fake_datastore.summary.capacity = 1000
+        fake_datastore.summary.freeSpace = 800
+        fake_datastore.summary.uncommitted = None
+        fake_datastore.summary.maintenanceMode = 'normal'
+        fake_datastore.host = [MagicMock()]
+        fake_datastore.host[0].key.name = 'esxi1'
+        other_datastore = MagicMock()
+        other_datastore.name = 'local-disk'
+        fake_host = MagicMock()
+        fake_host.name = 'esxi1'
+        fake_host.summary.runtime.connectionState = 'connected'
+        fake_host.summary.runtime.inMaintenanceMode = False
+        fake_host.summary.hardware.memorySize = 1024 * 1024 * 1024
+        fake_host.summary.quickStats.overallMemoryUsage = 512
+        fake_vcenter.get_by_type.side_effect = [[], [fake_datastore, other_datastore], [fake_host]]
+
+        output = placement._snapshot(fake_vcenter)
+        expected = {'datastores' : {'ds1' : {'capacity' : 1000, 'free' : 800, 'uncommitted' : 0, 'hosts' : ['esxi1']}},
+                    'hosts' : {'esxi1' : {'usable' : True, 'memory_used' : 0.5}}}
+
+        self.assertEqual(output, expected)
+
+    def test_snapshot_cached(self):
+        """``_snapshot`` reuses a recent snapshot instead of asking vCenter"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.get_by_type.side_effect = [[], [], []]
+        placement._snapshot(fake_vcenter)
+
+        placement._snapshot(fake_vcenter)
+
+        self.assertEqual(fake_vcenter.get_by_type.call_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in queues.py
+"""
+import unittest
+
+from celery import Celery
+
+from vlab_dataiq_api.lib import queues
+
+
+class TestQueues(unittest.TestCase):
+    """A set of test cases for queues.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.app = Celery('testing')
+
+    def test_configure(self):
+        """``configure`` routes a listing and a create to different queues"""
+        queues.configure(self.app)
+        router = self.app.amqp.router
+
+        fast = router.route({}, 'dataiq.show')['queue'].name
+        heavy = router.route({}, 'dataiq.create')['queue'].name
+
+        self.assertEqual(fast, queues.const.VLAB_DATAIQ_FAST_QUEUE)
+        self.assertEqual(heavy, queues.const.VLAB_DATAIQ_HEAVY_QUEUE)
+
+    def test_configure_every_task(self):
+        """Every task in tasks.py is routed to a queue"""
+        from vlab_dataiq_api.lib.worker import tasks
+        names = [x for x in tasks.app.tasks.keys() if x.startswith('dataiq.')]
+
+        routed = set(queues.FAST_TASKS + queues.HEAVY_TASKS)
+
+        self.assertEqual(set(names) - routed, set())
+
+    def test_configure_worker_heavy(self):
+        """``configure_worker`` only consumes the heavy queue for a heavy worker"""
+        queues.configure_worker(self.app, 'heavy')
+
+        self.assertEqual([x.name for x in self.app.conf.task_queues], [queues.const.VLAB_DATAIQ_HEAVY_QUEUE])
+        self.assertEqual(self.app.conf.worker_prefetch_multiplier, queues.const.VLAB_DATAIQ_HEAVY_PREFETCH)
+
+    def test_configure_worker_all(self):
+        """``configure_worker`` consumes both queues for an "all" worker"""
+        queues.configure_worker(self.app, 'all')
+
+        self.assertEqual(len(self.app.conf.task_queues), 2)
+
+    def test_configure_worker_bad_type(self):
+        """``configure_worker`` raises ValueError for an unknown worker type"""
+        with self.assertRaises(ValueError):
+            queues.configure_worker(self.app, 'medium')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in readiness.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_dataiq_api.lib.worker import readiness
+
+
+def _make_update(changes, version='1'):
+    """Build a fake ``WaitForUpdatesEx`` response for a VM"""
+    obj_update = MagicMock()
+    obj_update.changeSet = [readiness.vim.PropertyChange(name=x, op='assign', val=y) for x, y in changes.items()]
+    filter_update = MagicMock()
+    filter_update.objectSet = [obj_update]
+    update = MagicMock()
+    update.version = version
+    update.filterSet = [filter_update]
+    return update
+
+
+READY = {'guest.toolsRunningStatus': 'guestToolsRunning', 'guest.guestOperationsReady': True}
+NOT_READY = {'guest.toolsRunningStatus': 'guestToolsNotRunning', 'guest.guestOperationsReady': False}
+
+
+class TestReadiness(unittest.TestCase):
+    """A set of test cases for readiness.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.fake_vcenter = MagicMock()
+        self.collector = self.fake_vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+        self.the_vm = readiness.vim.VirtualMachine('vm-1')
+
+    def test_wait_for_guest(self):
+        """``wait_for_guest`` returns as soon as the guest is ready"""
+        self.collector.WaitForUpdatesEx.side_effect = [_make_update(NOT_READY), None, _make_update(READY)]
+
+        readiness.wait_for_guest(self.fake_vcenter, self.the_vm)
+
+        self.assertEqual(self.collector.WaitForUpdatesEx.call_count, 3)
+
+    def test_wait_for_guest_already_ready(self):
+        """``wait_for_guest`` returns right away if the guest is already ready"""
+        self.collector.WaitForUpdatesEx.side_effect = [_make_update(READY)]
+
+        readiness.wait_for_guest(self.fake_vcenter, self.the_vm)
+
+        self.assertEqual(self.collector.WaitForUpdatesEx.call_count, 1)
+
+    def test_wait_for_guest_rebooted(self):
+        """``wait_for_guest`` waits for a rebooting guest to go down, and come back up"""
+        fake_rebooted = MagicMock(side_effect=[False, True])
+        self.collector.WaitForUpdatesEx.side_effect = [_make_update(READY),
+                                                       _make_update(NOT_READY),
+                                                       _make_update(READY)]
+
+        readiness.wait_for_guest(self.fake_vcenter, self.the_vm, rebooted=fake_rebooted)
+
+        self.assertEqual(self.collector.WaitForUpdatesEx.call_count, 3)
+
+    def test_wait_for_guest_rebooted_fast(self):
+        """``wait_for_guest`` notices a reboot that finished before the guest was ever seen going down"""
+        fake_rebooted = MagicMock(side_effect=[False, True])
+        self.collector.WaitForUpdatesEx.side_effect = [_make_update(READY), None]
+
+        readiness.wait_for_guest(self.fake_vcenter, self.the_vm, rebooted=fake_rebooted)
+
+        self.assertEqual(self.collector.WaitForUpdatesEx.call_count, 2)
+
+    def test_wait_for_guest_rebooted_not_ready(self):
+        """``wait_for_guest`` only checks if the guest rebooted while the guest looks ready"""
+        fake_rebooted = MagicMock(return_value=True)
+        self.collector.WaitForUpdatesEx.side_effect = [_make_update(NOT_READY), _make_update(READY)]
+
+        readiness.wait_for_guest(self.fake_vcenter, self.the_vm, rebooted=fake_rebooted)
+
+        self.assertEqual(fake_rebooted.call_count, 1)
+
+    def test_wait_for_ip(self):
+        """``wait_for_ip`` ignores IPv6 link local addresses"""
+        nics = readiness.vim.vm.GuestInfo.NicInfo.Array
+        link_local = readiness.vim.vm.GuestInfo.NicInfo(ipAddress=['fe80::1'])
+        routable = readiness.vim.vm.GuestInfo.NicInfo(ipAddress=['fe80::1', '10.7.7.2'])
+        self.collector.WaitForUpdatesEx.side_effect = [_make_update({'guest.net': nics([link_local])}),
+                                                       _make_update({'guest.net': nics([routable])})]
+
+        readiness.wait_for_ip(self.fake_vcenter, self.the_vm)
+
+        self.assertEqual(self.collector.WaitForUpdatesEx.call_count, 2)
+
+    @patch.object(readiness.time, 'time')
+    def test_wait_for_ip_timeout(self, fake_time):
+        """``wait_for_ip`` raises RuntimeError at the deadline"""
+        fake_time.side_effect = [0, 1, 9000]
+        self.collector.WaitForUpdatesEx.side_effect = [_make_update({'guest.net': readiness.vim.vm.GuestInfo.NicInfo.Array()})]
+
+        with self.assertRaises(RuntimeError):
+            readiness.wait_for_ip(self.fake_vcenter, self.the_vm, timeout=10)
+
+    @patch.object(readiness.time, 'time')
+    def test_wait_for_guest_timeout(self, fake_time):
+        """``wait_for_guest`` raises RuntimeError at the deadline"""
+        fake_time.side_effect = [0, 1, 9000]
+        self.collector.WaitForUpdatesEx.side_effect = [_make_update(NOT_READY)]
+
+        with self.assertRaises(RuntimeError):
+            readiness.wait_for_guest(self.fake_vcenter, self.the_vm, timeout=10)
+
+    def test_wait_for_guest_cleans_up(self):
+        """``wait_for_guest`` destroys its property collector"""
+        self.collector.WaitForUpdatesEx.side_effect = [RuntimeError('testing')]
+
+        with self.assertRaises(RuntimeError):
+            readiness.wait_for_guest(self.fake_vcenter, self.the_vm)
+
+        self.assertTrue(self.collector.DestroyPropertyCollector.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in sessions.py
+"""
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_dataiq_api.lib.worker import sessions
+
+
+class TestSessionPool(unittest.TestCase):
+    """A set of test cases for the SessionPool object"""
+
+    @patch.object(sessions, '_login')
+    def test_miss(self, fake_login):
+        """``SessionPool`` logs in when there's no idle session"""
+        pool = sessions.SessionPool(max_sessions=1, keepalive=0)
+
+        with pool.connection():
+            pass
+
+        self.assertTrue(fake_login.called)
+        self.assertEqual(pool.stats['misses'], 1)
+
+    @patch.object(sessions.metrics, 'SESSION_POOL_EVENTS')
+    @patch.object(sessions, '_is_alive')
+    @patch.object(sessions, '_login')
+    def test_metrics(self, fake_login, fake_is_alive, fake_events):
+        """``SessionPool`` exports its hits and misses to Prometheus"""
+        fake_is_alive.return_value = True
+        pool = sessions.SessionPool(max_sessions=1, keepalive=0)
+
+        with pool.connection():
+            pass
+        with pool.connection():
+            pass
+        events = [x[1]['event'] for x in fake_events.labels.call_args_list]
+
+        self.assertEqual(events, ['misses', 'hits'])
+
+    @patch.object(sessions, '_is_alive')
+    @patch.object(sessions, '_login')
+    def test_hit(self, fake_login, fake_is_alive):
+        """``SessionPool`` reuses an idle session"""
+        fake_is_alive.return_value = True
+        pool = sessions.SessionPool(max_sessions=1, keepalive=0)
+
+        with pool.connection() as vcenter1:
+            pass
+        with pool.connection() as vcenter2:
+            pass
+
+        self.assertTrue(vcenter1 is vcenter2)
+        self.assertEqual(fake_login.call_count, 1)
+        self.assertEqual(pool.stats['hits'], 1)
+
+    @patch.object(sessions, '_is_alive')
+    @patch.object(sessions, '_login')
+    def test_relogin(self, fake_login, fake_is_alive):
+        """``SessionPool`` logs in again when an idle session has expired"""
+        fake_is_alive.return_value = False
+        pool = sessions.SessionPool(max_sessions=1, keepalive=0)
+
+        with pool.connection():
+            pass
+        with pool.connection():
+            pass
+
+        self.assertEqual(fake_login.call_count, 2)
+        self.assertEqual(pool.stats['relogins'], 1)
+
+    @patch.object(sessions.SessionPool, '_chime_keepalive')
+    @patch.object(sessions, '_is_alive')
+    @patch.object(sessions, '_login')
+    def test_relogin_recent(self, fake_login, fake_is_alive, fake_chime_keepalive):
+        """``SessionPool`` checks a session on checkout, even if it was just used"""
+        fake_is_alive.return_value = False
+        pool = sessions.SessionPool(max_sessions=1, keepalive=600)
+
+        with pool.connection():
+            pass
+        with pool.connection() as vcenter:
+            pass
+
+        self.assertTrue(vcenter is fake_login.return_value)
+        self.assertEqual(fake_login.call_count, 2)
+        self.assertEqual(pool.stats['relogins'], 1)
+
+    @patch.object(sessions, '_is_alive')
+    @patch.object(sessions, '_login')
+    def test_not_authenticated(self, fake_login, fake_is_alive):
+        """``SessionPool`` discards a session that raises NotAuthenticated"""
+        pool = sessions.SessionPool(max_sessions=1, keepalive=0)
+
+        with self.assertRaises(sessions.vim.fault.NotAuthenticated):
+            with pool.connection():
+                raise sessions.vim.fault.NotAuthenticated()
+        with pool.connection():
+            pass
+
+        self.assertEqual(fake_login.call_count, 2)
+        self.assertEqual(pool.stats['discards'], 1)
+
+    @patch.object(sessions.lookups, 'forget')
+    @patch.object(sessions, '_is_alive')
+    @patch.object(sessions, '_login')
+    def test_stale_reference(self, fake_login, fake_is_alive, fake_forget):
+        """``SessionPool`` drops the lookup index of a session that hits a stale reference"""
+        pool = sessions.SessionPool(max_sessions=1, keepalive=0)
+
+        with self.assertRaises(sessions.vmodl.fault.ManagedObjectNotFound):
+            with pool.connection():
+                raise sessions.vmodl.fault.ManagedObjectNotFound()
+
+        fake_forget.assert_called_with(fake_login.return_value)
+        self.assertEqual(pool.stats['discards'], 0)
+
+    @patch.object(sessions, '_is_alive')
+    @patch.object(sessions, '_login')
+    def test_other_errors(self, fake_login, fake_is_alive):
+        """``SessionPool`` keeps the session when the caller hits an unrelated error"""
+        fake_is_alive.return_value = True
+        pool = sessions.SessionPool(max_sessions=1, keepalive=0)
+
+        with self.assertRaises(ValueError):
+            with pool.connection():
+                raise ValueError('testing')
+        with pool.connection():
+            pass
+
+        self.assertEqual(fake_login.call_count, 1)
+
+    @patch.object(sessions, '_login')
+    def test_close(self, fake_login):
+        """``SessionPool`` logs out of idle sessions when closed"""
+        pool = sessions.SessionPool(max_sessions=1, keepalive=0)
+        with pool.connection() as vcenter:
+            pass
+
+        pool.close()
+
+        self.assertTrue(vcenter.close.called)
+
+    def test_is_alive(self):
+        """``_is_alive`` returns False when vCenter has no session for the connection"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.sessionManager.currentSession = None
+
+        self.assertFalse(sessions._is_alive(fake_vcenter))
+
+    def test_is_alive_not_authenticated(self):
+        """``_is_alive`` returns False when vCenter raises NotAuthenticated"""
+        fake_vcenter = MagicMock()
+        type(fake_vcenter).content = property(MagicMock(side_effect=sessions.vim.fault.NotAuthenticated()))
+
+        self.assertFalse(sessions._is_alive(fake_vcenter))
+
+    @patch.object(sessions, 'SessionPool')
+    def test_get_pool(self, fake_SessionPool):
+        """``get_pool`` returns the same pool for the same process"""
+        sessions._POOL = None
+
+        pool1 = sessions.get_pool()
+        pool2 = sessions.get_pool()
+        sessions._POOL = None
+
+        self.assertTrue(pool1 is pool2)
+
+
+if __name__ == '__main__':
+    unittest.main()
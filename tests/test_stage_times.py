@@ -0,0 +1,55 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in stage_times.py
+"""
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from vlab_dataiq_api.lib.worker import stage_times
+
+
+class TestStageTimes(unittest.TestCase):
+    """A set of test cases for stage_times.py"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.cache_dir = tempfile.mkdtemp()
+        self.patchers = [patch.object(stage_times, 'const'), patch.object(stage_times, 'file_lock')]
+        fake_const, _ = [x.start() for x in self.patchers]
+        fake_const.VLAB_DATAIQ_CACHE_DIR = self.cache_dir
+
+    def tearDown(self):
+        """Runs after every test case"""
+        for patcher in self.patchers:
+            patcher.stop()
+        shutil.rmtree(self.cache_dir)
+
+    def test_estimate_no_history(self):
+        """``estimate`` returns None when a stage has never been timed"""
+        self.assertTrue(stage_times.estimate(['gui', 'rdp']) is None)
+
+    def test_estimate(self):
+        """``estimate`` adds up the average duration of every stage"""
+        stage_times.record('gui', 100)
+        stage_times.record('rdp', 20)
+
+        self.assertEqual(stage_times.estimate(['gui', 'rdp']), 120)
+
+    def test_estimate_in_stage(self):
+        """``estimate`` subtracts the time already spent in the current stage"""
+        stage_times.record('gui', 100)
+        stage_times.record('rdp', 20)
+
+        self.assertEqual(stage_times.estimate(['gui', 'rdp'], in_stage=40), 80)
+
+    def test_record_average(self):
+        """``record`` keeps a moving average of the duration"""
+        stage_times.record('gui', 100)
+        stage_times.record('gui', 200)
+
+        self.assertEqual(stage_times.estimate(['gui']), 130)
+
+
+if __name__ == '__main__':
+    unittest.main()
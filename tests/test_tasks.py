@@ -10,30 +10,60 @@ from vlab_dataiq_api.lib.worker import tasks
 
 class TestTasks(unittest.TestCase):
     """A set of test cases for tasks.py"""
+    @patch.object(tasks, 'cache')
     @patch.object(tasks, 'vmware')
-    def test_show_ok(self, fake_vmware):
+    def test_show_ok(self, fake_vmware, fake_cache):
         """``show`` returns a dictionary when everything works as expected"""
         fake_vmware.show_dataiq.return_value = {'worked': True}
+        fake_cache.get.return_value = None
 
         output = tasks.show(username='bob', txn_id='myId')
         expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'cache')
     @patch.object(tasks, 'vmware')
-    def test_show_value_error(self, fake_vmware):
+    def test_show_value_error(self, fake_vmware, fake_cache):
         """``show`` sets the error in the dictionary to the ValueError message"""
         fake_vmware.show_dataiq.side_effect = [ValueError("testing")]
+        fake_cache.get.return_value = None
 
         output = tasks.show(username='bob', txn_id='myId')
         expected = {'content' : {}, 'error': 'testing', 'params': {}}
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'cache')
     @patch.object(tasks, 'vmware')
-    def test_create_ok(self, fake_vmware):
-        """``create`` returns a dictionary when everything works as expected"""
-        fake_vmware.create_dataiq.return_value = {'worked': True}
+    def test_show_cached(self, fake_vmware, fake_cache):
+        """``show`` returns the cached inventory without scanning vCenter"""
+        fake_cache.get.return_value = {'cached': True}
+
+        output = tasks.show(username='bob', txn_id='myId')
+        expected = {'content' : {'cached': True}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+        self.assertFalse(fake_vmware.show_dataiq.called)
+
+    @patch.object(tasks, 'cache')
+    @patch.object(tasks, 'vmware')
+    def test_show_fresh(self, fake_vmware, fake_cache):
+        """``show`` ignores the cache when ``fresh`` is True"""
+        fake_vmware.show_dataiq.return_value = {'worked': True}
+        fake_cache.get.return_value = {'cached': True}
+
+        output = tasks.show(username='bob', txn_id='myId', fresh=True)
+        expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+        self.assertTrue(fake_cache.put.called)
+
+    @patch.object(tasks.create, 'update_state')
+    @patch.object(tasks.create, 'replace')
+    def test_create_ok(self, fake_replace, fake_update_state):
+        """``create`` replaces itself with a chain of every create stage"""
+        fake_replace.return_value = {'worked': True}
 
         output = tasks.create(username='bob',
                               machine_name='dataiqBox',
@@ -47,18 +77,46 @@ class TestTasks(unittest.TestCase):
                               cpu_count=4,
                               ram=32,
                               txn_id='myId')
-        expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
+        the_chain = fake_replace.call_args[0][0]
+        stages = [the_chain.tasks[0].args[1]] + [x.args[0] for x in the_chain.tasks[1:]]
 
-        self.assertEqual(output, expected)
+        self.assertEqual(output, {'worked': True})
+        self.assertEqual(stages, tasks.vmware.CREATE_STAGES)
 
-    @patch.object(tasks, 'vmware')
-    def test_create_value_error(self, fake_vmware):
-        """``create`` sets the error in the dictionary to the ValueError message"""
-        fake_vmware.create_dataiq.side_effect = [ValueError("testing")]
+    @patch.object(tasks.images, 'resolve')
+    @patch.object(tasks.create, 'update_state')
+    @patch.object(tasks.create, 'replace')
+    def test_create_latest(self, fake_replace, fake_update_state, fake_resolve):
+        """``create`` resolves the 'latest' image to a version before running any stage"""
+        fake_resolve.return_value = '2.0.0'
+
+        tasks.create(username='bob',
+                     machine_name='dataiqBox',
+                     image='latest',
+                     network='someLAN',
+                     static_ip='192.168.1.2',
+                     default_gateway='192.168.1.1',
+                     netmask='255.255.255.0',
+                     dns=['192.168.1.1'],
+                     disk_size=250,
+                     cpu_count=4,
+                     ram=32,
+                     txn_id='myId')
+        the_chain = fake_replace.call_args[0][0]
+        spec = the_chain.tasks[0].args[2]
+
+        self.assertEqual(spec['image'], '2.0.0')
+
+    @patch.object(tasks.images, 'resolve')
+    @patch.object(tasks.create, 'update_state')
+    @patch.object(tasks.create, 'replace')
+    def test_create_latest_no_images(self, fake_replace, fake_update_state, fake_resolve):
+        """``create`` returns an error if there's no image to resolve 'latest' to"""
+        fake_resolve.side_effect = [ValueError('testing')]
 
         output = tasks.create(username='bob',
                               machine_name='dataiqBox',
-                              image='0.0.1',
+                              image='latest',
                               network='someLAN',
                               static_ip='192.168.1.2',
                               default_gateway='192.168.1.1',
@@ -68,12 +126,224 @@ class TestTasks(unittest.TestCase):
                               cpu_count=4,
                               ram=32,
                               txn_id='myId')
+
+        self.assertEqual(output['error'], 'testing')
+        self.assertFalse(fake_replace.called)
+
+    @patch.object(tasks.create, 'update_state')
+    @patch.object(tasks.create, 'replace')
+    def test_create_progress(self, fake_replace, fake_update_state):
+        """``create`` reports that it's been picked up before running any stage"""
+        tasks.create(username='bob',
+                     machine_name='dataiqBox',
+                     image='0.0.1',
+                     network='someLAN',
+                     static_ip='192.168.1.2',
+                     default_gateway='192.168.1.1',
+                     netmask='255.255.255.0',
+                     dns=['192.168.1.1'],
+                     disk_size=250,
+                     cpu_count=4,
+                     ram=32,
+                     txn_id='myId')
+
+        fake_update_state.assert_called_with(state='PROGRESS', meta={'stage': 'queued'})
+
+    @patch.object(tasks.create, 'update_state')
+    @patch.object(tasks.create, 'replace')
+    def test_create_status_id(self, fake_replace, fake_update_state):
+        """``create`` has every stage report progress under its own task id, even as part of a bulk create"""
+        tasks.create.push_request(id='theCreateTask', root_id='theBulkTask', reply_to='theApi')
+        try:
+            tasks.create(username='bob',
+                         machine_name='dataiqBox',
+                         image='0.0.1',
+                         network='someLAN',
+                         static_ip='192.168.1.2',
+                         default_gateway='192.168.1.1',
+                         netmask='255.255.255.0',
+                         dns=['192.168.1.1'],
+                         disk_size=250,
+                         cpu_count=4,
+                         ram=32,
+                         txn_id='myId')
+        finally:
+            tasks.create.pop_request()
+        the_chain = fake_replace.call_args[0][0]
+        status_ids = {x.args[-1] for x in the_chain.tasks}
+
+        self.assertEqual(status_ids, {'theCreateTask'})
+
+    @patch.object(tasks.vmware, 'resume_plan')
+    @patch.object(tasks.resume, 'replace')
+    def test_resume(self, fake_replace, fake_resume_plan):
+        """``resume`` replaces itself with a chain of the stages that didn't complete"""
+        fake_resume_plan.return_value = ({'username': 'bob'}, ['gui', 'rdp', 'info'])
+
+        tasks.resume(username='bob', machine_name='dataiqBox', txn_id='myId')
+        the_chain = fake_replace.call_args[0][0]
+        stages = [the_chain.tasks[0].args[1]] + [x.args[0] for x in the_chain.tasks[1:]]
+
+        self.assertEqual(stages, ['gui', 'rdp', 'info'])
+
+    @patch.object(tasks.vmware, 'resume_plan')
+    @patch.object(tasks.resume, 'replace')
+    def test_resume_value_error(self, fake_replace, fake_resume_plan):
+        """``resume`` sets the error in the dictionary to the ValueError message"""
+        fake_resume_plan.side_effect = [ValueError('testing')]
+
+        output = tasks.resume(username='bob', machine_name='dataiqBox', txn_id='myId')
+        expected = {'content' : {}, 'error': 'testing', 'params': {}}
+
+        self.assertEqual(output, expected)
+        self.assertFalse(fake_replace.called)
+
+    @patch.object(tasks, 'cache')
+    @patch.object(tasks, 'vmware')
+    def test_create_stage_ok(self, fake_vmware, fake_cache):
+        """``create_stage`` returns the machine info from the final stage"""
+        fake_vmware.CREATE_STAGES = ['deploy', 'info']
+        fake_vmware.create_stage.return_value = {'worked': True}
+        resp = {'content' : {}, 'error': None, 'params': {}}
+
+        output = tasks.create_stage(resp, 'info', {'username': 'bob', 'image': '0.0.1'}, 'myId', 'theCreateTask')
+        expected = {'content' : {'worked': True}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks.app.backend, 'store_result')
+    @patch.object(tasks, 'cache')
+    @patch.object(tasks, 'vmware')
+    def test_create_stage_progress(self, fake_vmware, fake_cache, fake_store_result):
+        """``create_stage`` reports progress as the state of the create task the chain replaced, not the root task"""
+        resp = {'content' : {}, 'error': None, 'params': {}}
+        tasks.create_stage.push_request(id='theStageTask', root_id='theRootTask', reply_to='theApi')
+        try:
+            tasks.create_stage(resp, 'gui', {'username': 'bob', 'image': '0.0.1'}, 'myId', 'theCreateTask')
+        finally:
+            tasks.create_stage.pop_request()
+        progress = fake_vmware.create_stage.call_args[1]['progress']
+        progress({'stage': 'gui'})
+        task_id, meta, state = fake_store_result.call_args[0]
+        request = fake_store_result.call_args[1]['request']
+
+        self.assertEqual((task_id, meta, state), ('theCreateTask', {'stage': 'gui'}, 'PROGRESS'))
+        self.assertEqual((request.reply_to, request.correlation_id), ('theApi', 'theCreateTask'))
+
+    @patch.object(tasks, 'cache')
+    @patch.object(tasks, 'vmware')
+    def test_create_stage_value_error(self, fake_vmware, fake_cache):
+        """``create_stage`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.create_stage.side_effect = [ValueError("testing")]
+        resp = {'content' : {}, 'error': None, 'params': {}}
+
+        output = tasks.create_stage(resp, 'deploy', {'username': 'bob', 'image': '0.0.1'}, 'myId', 'theCreateTask')
         expected = {'content' : {}, 'error': 'testing', 'params': {}}
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'cache')
+    @patch.object(tasks, 'vmware')
+    def test_create_stage_any_error(self, fake_vmware, fake_cache):
+        """``create_stage`` doesn't let any exception break the chain"""
+        fake_vmware.create_stage.side_effect = [Exception("testing")]
+        resp = {'content' : {}, 'error': None, 'params': {}}
+
+        output = tasks.create_stage(resp, 'deploy', {'username': 'bob', 'image': '0.0.1'}, 'myId', 'theCreateTask')
+
+        self.assertEqual(output['error'], 'testing')
+
+    @patch.object(tasks, 'cache')
+    @patch.object(tasks, 'vmware')
+    def test_create_stage_skips_after_error(self, fake_vmware, fake_cache):
+        """``create_stage`` doesn't run once an earlier stage has failed"""
+        resp = {'content' : {}, 'error': 'testing', 'params': {}}
+
+        output = tasks.create_stage(resp, 'gui', {'username': 'bob', 'image': '0.0.1'}, 'myId', 'theCreateTask')
+
+        self.assertFalse(fake_vmware.create_stage.called)
+        self.assertEqual(output['error'], 'testing')
+
+    @patch.object(tasks, 'group')
     @patch.object(tasks, 'vmware')
-    def test_delete_ok(self, fake_vmware):
+    def test_bulk_create_ok(self, fake_vmware, fake_group):
+        """``bulk_create`` returns the task id of every machine"""
+        output = tasks.bulk_create('bob', [['box-1', '10.7.7.2'], ['box-2', '10.7.7.3']], '0.0.1', 'someLAN',
+                                   '10.7.7.1', '255.255.255.0', ['10.7.7.1'], 250, 4, 32, 'myId')
+
+        self.assertEqual(sorted(output['content'].keys()), ['tasks'])
+        self.assertEqual(sorted(output['content']['tasks'].keys()), ['box-1', 'box-2'])
+
+    @patch.object(tasks, 'group')
+    @patch.object(tasks, 'vmware')
+    def test_bulk_create_group(self, fake_vmware, fake_group):
+        """``bulk_create`` dispatches a create task for every machine"""
+        output = tasks.bulk_create('bob', [['box-1', '10.7.7.2'], ['box-2', '10.7.7.3']], '0.0.1', 'someLAN',
+                                   '10.7.7.1', '255.255.255.0', ['10.7.7.1'], 250, 4, 32, 'myId')
+        lanes = fake_group.call_args[0][0]
+        dispatched = {x.options['task_id']: x.args[1] for lane in lanes for x in lane.tasks}
+        expected = {v: k for k, v in output['content']['tasks'].items()}
+
+        self.assertEqual(dispatched, expected)
+        self.assertTrue(all(x.task == 'dataiq.create' for lane in lanes for x in lane.tasks))
+
+    @patch.object(tasks, 'const')
+    @patch.object(tasks, 'group')
+    @patch.object(tasks, 'vmware')
+    def test_bulk_create_parallel(self, fake_vmware, fake_group, fake_const):
+        """``bulk_create`` limits how many machines are created at once to VLAB_DATAIQ_BULK_PARALLEL"""
+        fake_const.VLAB_DATAIQ_BULK_PARALLEL = 2
+        fake_const.VLAB_DATAIQ_LOG_LEVEL = 'INFO'
+        machines = [['box-{}'.format(x), '10.7.7.{}'.format(x)] for x in range(5)]
+
+        tasks.bulk_create('bob', machines, '0.0.1', 'someLAN', '10.7.7.1', '255.255.255.0',
+                          ['10.7.7.1'], 250, 4, 32, 'myId')
+        lanes = fake_group.call_args[0][0]
+
+        self.assertEqual(len(lanes), 2)
+        self.assertEqual(sum(len(x.tasks) for x in lanes), 5)
+
+    @patch.object(tasks, 'group')
+    @patch.object(tasks, 'vmware')
+    def test_bulk_create_value_error(self, fake_vmware, fake_group):
+        """``bulk_create`` sets the error in the dictionary to the ValueError message, and dispatches nothing"""
+        fake_vmware.check_image.side_effect = [ValueError('testing')]
+
+        output = tasks.bulk_create('bob', [['box-1', '10.7.7.2']], '0.0.1', 'someLAN', '10.7.7.1',
+                                   '255.255.255.0', ['10.7.7.1'], 250, 4, 32, 'myId')
+
+        self.assertEqual(output['error'], 'testing')
+        self.assertFalse(fake_group.called)
+
+    @patch.object(tasks.images, 'resolve')
+    @patch.object(tasks, 'group')
+    @patch.object(tasks, 'vmware')
+    def test_bulk_create_latest(self, fake_vmware, fake_group, fake_resolve):
+        """``bulk_create`` resolves the 'latest' image to a version, once for every machine"""
+        fake_resolve.return_value = '2.0.0'
+
+        tasks.bulk_create('bob', [['box-1', '10.7.7.2']], 'latest', 'someLAN', '10.7.7.1',
+                          '255.255.255.0', ['10.7.7.1'], 250, 4, 32, 'myId')
+        image = fake_group.call_args[0][0][0].tasks[0].args[2]
+
+        self.assertEqual(image, '2.0.0')
+        self.assertEqual(fake_resolve.call_count, 1)
+
+    def test_bulk_lanes(self):
+        """``_bulk_lanes`` splits the machines into at most the requested number of chains"""
+        output = tasks._bulk_lanes([1, 2, 3, 4, 5], 2)
+
+        self.assertEqual(output, [[1, 3, 5], [2, 4]])
+
+    def test_bulk_lanes_few_machines(self):
+        """``_bulk_lanes`` doesn't make empty chains"""
+        output = tasks._bulk_lanes([1], 4)
+
+        self.assertEqual(output, [[1]])
+
+    @patch.object(tasks, 'cache')
+    @patch.object(tasks, 'vmware')
+    def test_delete_ok(self, fake_vmware, fake_cache):
         """``delete`` returns a dictionary when everything works as expected"""
         fake_vmware.delete_dataiq.return_value = {'worked': True}
 
@@ -82,8 +352,9 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'cache')
     @patch.object(tasks, 'vmware')
-    def test_delete_value_error(self, fake_vmware):
+    def test_delete_value_error(self, fake_vmware, fake_cache):
         """``delete`` sets the error in the dictionary to the ValueError message"""
         fake_vmware.delete_dataiq.side_effect = [ValueError("testing")]
 
@@ -92,6 +363,58 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'refill_pool')
+    @patch.object(tasks.warm_pool, 'enabled')
+    @patch.object(tasks, 'cache')
+    @patch.object(tasks, 'vmware')
+    def test_create_refills_pool(self, fake_vmware, fake_cache, fake_enabled, fake_refill_pool):
+        """``create_stage`` refills the warm pool of the image after the final stage"""
+        fake_enabled.return_value = True
+        fake_vmware.CREATE_STAGES = ['deploy', 'info']
+        resp = {'content' : {}, 'error': None, 'params': {}}
+
+        tasks.create_stage(resp, 'info', {'username': 'bob', 'image': '0.0.1'}, 'myId', 'theCreateTask')
+
+        fake_refill_pool.delay.assert_called_with('0.0.1', 'myId')
+
+    @patch.object(tasks, 'vmware')
+    def test_refill_pool(self, fake_vmware):
+        """``refill_pool`` returns how many VMs were provisioned"""
+        fake_vmware.refill_warm_pool.return_value = 2
+
+        output = tasks.refill_pool(image='0.0.1', txn_id='myId')
+        expected = {'content' : {'provisioned': 2}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_refill_pool_error(self, fake_vmware):
+        """``refill_pool`` sets the error in the dictionary when provisioning fails"""
+        fake_vmware.refill_warm_pool.side_effect = [RuntimeError('testing')]
+
+        output = tasks.refill_pool(image='0.0.1', txn_id='myId')
+
+        self.assertEqual(output['error'], 'testing')
+
+    @patch.object(tasks, 'cache')
+    @patch.object(tasks, 'vmware')
+    def test_create_invalidates_cache(self, fake_vmware, fake_cache):
+        """``create_stage`` invalidates the cached inventory of the user after the final stage, even if the create fails"""
+        fake_vmware.CREATE_STAGES = ['deploy', 'info']
+        resp = {'content' : {}, 'error': 'testing', 'params': {}}
+
+        tasks.create_stage(resp, 'info', {'username': 'bob', 'image': '0.0.1'}, 'myId', 'theCreateTask')
+
+        fake_cache.invalidate.assert_called_with('bob')
+
+    @patch.object(tasks, 'cache')
+    @patch.object(tasks, 'vmware')
+    def test_delete_invalidates_cache(self, fake_vmware, fake_cache):
+        """``delete`` invalidates the cached inventory of the user"""
+        tasks.delete(username='bob', machine_name='dataiqBox', txn_id='myId')
+
+        fake_cache.invalidate.assert_called_with('bob')
+
     @patch.object(tasks, 'vmware')
     def test_image(self, fake_vmware):
         """``image`` returns a dictionary when everything works as expected"""
@@ -102,6 +425,111 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
+    @patch.object(tasks, 'vmware')
+    def test_image_filters(self, fake_vmware):
+        """``image`` passes the version prefix and latest filters along"""
+        fake_vmware.list_images.return_value = ['1.1.0']
+
+        tasks.image(txn_id='myId', prefix='1.1', latest=True)
+
+        fake_vmware.list_images.assert_called_with(prefix='1.1', latest=True)
+
+
+    @patch.object(tasks.images, 'manifest')
+    def test_index_images(self, fake_manifest):
+        """``index_images`` refreshes the image manifest, and lists the images in it"""
+        fake_manifest.return_value = {'1.10.0': {}, '1.9.0': {}}
+
+        output = tasks.index_images(txn_id='myId')
+        expected = {'content' : {'image': ['1.9.0', '1.10.0']}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks.images, 'manifest')
+    def test_index_images_os_error(self, fake_manifest):
+        """``index_images`` sets the error in the dictionary if the manifest can't be written"""
+        fake_manifest.side_effect = [OSError('testing')]
+
+        output = tasks.index_images(txn_id='myId')
+
+        self.assertEqual(output['error'], 'testing')
+
+    @patch.object(tasks, 'vmware')
+    def test_bake(self, fake_vmware):
+        """``bake`` returns the name of the new image"""
+        fake_vmware.bake_image.return_value = '1.0.0-gui'
+
+        output = tasks.bake(image='1.0.0', txn_id='myId')
+        expected = {'content' : {'image': '1.0.0-gui'}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+
+    @patch.object(tasks, 'vmware')
+    def test_bake_value_error(self, fake_vmware):
+        """``bake`` sets the error in the dictionary to the ValueError message"""
+        fake_vmware.bake_image.side_effect = [ValueError('testing')]
+
+        output = tasks.bake(image='1.0.0', txn_id='myId')
+
+        self.assertEqual(output['error'], 'testing')
+
+    @patch.object(tasks, 'vmware')
+    def test_bake_os_error(self, fake_vmware):
+        """``bake`` sets the error in the dictionary when writing the image fails"""
+        fake_vmware.bake_image.side_effect = [PermissionError('testing')]
+
+        output = tasks.bake(image='1.0.0', txn_id='myId')
+
+        self.assertEqual(output['error'], 'testing')
+
+    @patch.object(tasks, 'metrics')
+    def test_task_timers(self, fake_metrics):
+        """The task signal handlers record how long a task ran"""
+        fake_task = MagicMock()
+        fake_task.name = 'dataiq.show'
+        fake_task.request.sent_at = None
+
+        tasks.start_task_timer(task_id='myId', task=fake_task)
+        tasks.observe_task_time(task_id='myId', task=fake_task, state='SUCCESS')
+
+        fake_metrics.TASK_SECONDS.labels.assert_called_with(task='dataiq.show', state='SUCCESS')
+        self.assertNotIn('myId', tasks._STARTED)
+
+    @patch.object(tasks, 'metrics')
+    def test_task_queue_wait(self, fake_metrics):
+        """``start_task_timer`` records how long the task was queued"""
+        fake_task = MagicMock()
+        fake_task.name = 'dataiq.show'
+        fake_task.request.sent_at = 1.0
+
+        tasks.start_task_timer(task_id='myId', task=fake_task)
+        tasks._STARTED.pop('myId')
+
+        fake_metrics.QUEUE_WAIT_SECONDS.labels.assert_called_with(task='dataiq.show')
+
+
+    @patch.object(tasks, 'cache')
+    @patch.object(tasks, 'vmware')
+    def test_bulk_delete(self, fake_vmware, fake_cache):
+        """``bulk_delete`` returns the names of the deleted machines"""
+        fake_vmware.delete_many.return_value = (['box-1', 'box-2'], {})
+
+        output = tasks.bulk_delete(username='bob', machine_names=['box-1', 'box-2'], txn_id='myId')
+        expected = {'content' : {'deleted': ['box-1', 'box-2']}, 'error': None, 'params': {}}
+
+        self.assertEqual(output, expected)
+        self.assertTrue(fake_cache.invalidate.called)
+
+    @patch.object(tasks, 'cache')
+    @patch.object(tasks, 'vmware')
+    def test_bulk_delete_errors(self, fake_vmware, fake_cache):
+        """``bulk_delete`` sets the error to the machines that failed to be deleted"""
+        fake_vmware.delete_many.return_value = (['box-1'], {'box-2': 'testing'})
+
+        output = tasks.bulk_delete(username='bob', machine_names=['box-1', 'box-2'], txn_id='myId')
+
+        self.assertEqual(output['error'], 'Failed to delete 1 machines; box-2: testing')
+
 
 if __name__ == '__main__':
     unittest.main()
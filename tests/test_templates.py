@@ -0,0 +1,276 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in templates.py
+"""
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_dataiq_api.lib.worker import templates
+
+
+def _make_retired(name, disk):
+    """Build a fake template VM with a single disk"""
+    template = MagicMock(spec=templates.vim.VirtualMachine)
+    template.name = name
+    template._moId = name
+    template.layoutEx.file = [templates.vim.vm.FileLayoutEx.FileInfo(name=disk, type='diskDescriptor')]
+    return template
+
+
+class TestTemplates(unittest.TestCase):
+    """A set of test cases for templates.py"""
+
+    @patch.object(templates.virtual_machine, 'change_network')
+    @patch.object(templates, 'consume_task')
+    @patch.object(templates, 'get_template')
+    def test_clone_from_template(self, fake_get_template, fake_consume_task, fake_change_network):
+        """``clone_from_template`` returns the new VM"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.resource_pools = {templates.const.INF_VCENTER_RESORUCE_POOL: templates.vim.ResourcePool('rp-1')}
+        fake_get_template.return_value.snapshot.currentSnapshot = templates.vim.vm.Snapshot('snapshot-1')
+        fake_logger = MagicMock()
+        fake_consume_task.return_value = 'theNewVM'
+
+        output = templates.clone_from_template(fake_vcenter, '1.0.0', '/images/dataiq-1.0.0.ova',
+                                               MagicMock(), 'alice', 'myDataIQ', fake_logger)
+
+        self.assertEqual(output, 'theNewVM')
+
+    @patch.object(templates.virtual_machine, 'change_network')
+    @patch.object(templates, 'consume_task')
+    @patch.object(templates, 'get_template')
+    def test_clone_from_template_linked(self, fake_get_template, fake_consume_task, fake_change_network):
+        """``clone_from_template`` creates a linked clone from the template's snapshot"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.resource_pools = {templates.const.INF_VCENTER_RESORUCE_POOL: templates.vim.ResourcePool('rp-1')}
+        fake_get_template.return_value.snapshot.currentSnapshot = templates.vim.vm.Snapshot('snapshot-1')
+        fake_logger = MagicMock()
+
+        templates.clone_from_template(fake_vcenter, '1.0.0', '/images/dataiq-1.0.0.ova',
+                                      MagicMock(), 'alice', 'myDataIQ', fake_logger)
+        clone_spec = fake_get_template.return_value.CloneVM_Task.call_args[1]['spec']
+
+        self.assertEqual(clone_spec.location.diskMoveType, 'createNewChildDiskBacking')
+
+    @patch.object(templates.virtual_machine, 'change_network')
+    @patch.object(templates, 'consume_task')
+    @patch.object(templates, 'get_template')
+    def test_clone_from_template_location(self, fake_get_template, fake_consume_task, fake_change_network):
+        """``clone_from_template`` puts the clone on the datastore and host it's given"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.resource_pools = {templates.const.INF_VCENTER_RESORUCE_POOL: templates.vim.ResourcePool('rp-1')}
+        fake_vcenter.get_by_name.return_value = templates.vim.Datastore('datastore-1')
+        fake_vcenter.host_systems = {'esxi1': templates.vim.HostSystem('host-1')}
+        fake_get_template.return_value.snapshot.currentSnapshot = templates.vim.vm.Snapshot('snapshot-1')
+
+        templates.clone_from_template(fake_vcenter, '1.0.0', '/images/dataiq-1.0.0.ova', MagicMock(),
+                                      'alice', 'myDataIQ', MagicMock(), location={'datastore': 'ds1', 'host': 'esxi1'})
+        clone_spec = fake_get_template.return_value.CloneVM_Task.call_args[1]['spec']
+
+        self.assertEqual(clone_spec.location.datastore, templates.vim.Datastore('datastore-1'))
+        self.assertEqual(clone_spec.location.host, templates.vim.HostSystem('host-1'))
+
+    @patch.object(templates, 'get_template')
+    def test_clone_from_template_bad_name(self, fake_get_template):
+        """``clone_from_template`` raises ValueError if the machine name isn't a valid hostname"""
+        with self.assertRaises(ValueError):
+            templates.clone_from_template(MagicMock(), '1.0.0', '/images/dataiq-1.0.0.ova',
+                                          MagicMock(), 'alice', 'my_DataIQ!', MagicMock())
+
+    def test_check_machine_name(self):
+        """``check_machine_name`` accepts a valid hostname"""
+        templates.check_machine_name('my-DataIQ.1')
+
+    def test_check_machine_name_bad(self):
+        """``check_machine_name`` raises ValueError for a name that would break the guest's shell commands"""
+        with self.assertRaises(ValueError):
+            templates.check_machine_name('box; reboot')
+
+    @patch.object(templates, '_make_template')
+    @patch.object(templates, 'get_folder')
+    @patch.object(templates, '_ova_signature')
+    @patch.object(templates, 'file_lock')
+    def test_get_template_reuse(self, fake_file_lock, fake_ova_signature, fake_get_folder,
+                                fake_make_template):
+        """``get_template`` reuses the template when the OVA hasn't changed"""
+        fake_ova_signature.return_value = {'mtime': 1, 'size': 2}
+        fake_template = MagicMock()
+        fake_template.name = 'dataiq-template-1.0.0'
+        fake_template.config.annotation = '{"source": {"mtime": 1, "size": 2}}'
+        fake_get_folder.return_value.childEntity = [fake_template]
+
+        output = templates.get_template(MagicMock(), '1.0.0', '/images/dataiq-1.0.0.ova', MagicMock())
+
+        self.assertTrue(output is fake_template)
+        self.assertFalse(fake_make_template.called)
+
+    @patch.object(templates, 'consume_task')
+    @patch.object(templates, '_make_template')
+    @patch.object(templates, 'get_folder')
+    @patch.object(templates, '_ova_signature')
+    @patch.object(templates, 'file_lock')
+    def test_get_template_refresh(self, fake_file_lock, fake_ova_signature, fake_get_folder,
+                                  fake_make_template, fake_consume_task):
+        """``get_template`` retires the old template and makes a new one when the OVA has changed"""
+        fake_ova_signature.return_value = {'mtime': 3, 'size': 2}
+        fake_template = MagicMock()
+        fake_template.name = 'dataiq-template-1.0.0'
+        fake_template.config.annotation = '{"source": {"mtime": 1, "size": 2}}'
+        fake_get_folder.return_value.childEntity = [fake_template]
+
+        templates.get_template(MagicMock(), '1.0.0', '/images/dataiq-1.0.0.ova', MagicMock())
+
+        self.assertTrue(fake_template.Rename_Task.called)
+        self.assertFalse(fake_template.Destroy_Task.called)
+        self.assertTrue(fake_make_template.called)
+
+    @patch.object(templates, 'consume_task')
+    @patch.object(templates, '_make_template')
+    @patch.object(templates, 'get_folder')
+    @patch.object(templates, '_ova_signature')
+    @patch.object(templates, 'file_lock')
+    def test_get_template_no_snapshot(self, fake_file_lock, fake_ova_signature, fake_get_folder,
+                                      fake_make_template, fake_consume_task):
+        """``get_template`` replaces a template that has no snapshot"""
+        fake_ova_signature.return_value = {'mtime': 1, 'size': 2}
+        fake_template = MagicMock()
+        fake_template.name = 'dataiq-template-1.0.0'
+        fake_template.config.annotation = '{"source": {"mtime": 1, "size": 2}}'
+        fake_template.snapshot = None
+        fake_get_folder.return_value.childEntity = [fake_template]
+
+        templates.get_template(MagicMock(), '1.0.0', '/images/dataiq-1.0.0.ova', MagicMock())
+
+        self.assertTrue(fake_template.Destroy_Task.called)
+        self.assertTrue(fake_make_template.called)
+
+    @patch.object(templates, 'purge_retired')
+    @patch.object(templates, 'consume_task')
+    @patch.object(templates, '_make_template')
+    @patch.object(templates, 'get_folder')
+    @patch.object(templates, '_ova_signature')
+    @patch.object(templates, 'file_lock')
+    def test_get_template_refresh_purges(self, fake_file_lock, fake_ova_signature, fake_get_folder,
+                                         fake_make_template, fake_consume_task, fake_purge_retired):
+        """``get_template`` cleans up older retired templates when it retires one"""
+        fake_ova_signature.return_value = {'mtime': 3, 'size': 2}
+        fake_template = MagicMock()
+        fake_template.name = 'dataiq-template-1.0.0'
+        fake_template.config.annotation = '{"source": {"mtime": 1, "size": 2}}'
+        fake_get_folder.return_value.childEntity = [fake_template]
+
+        templates.get_template(MagicMock(), '1.0.0', '/images/dataiq-1.0.0.ova', MagicMock())
+
+        self.assertTrue(fake_purge_retired.called)
+
+    @patch.object(templates, 'consume_task')
+    @patch.object(templates, '_disks_in_use')
+    @patch.object(templates, 'get_folder')
+    def test_purge_retired(self, fake_get_folder, fake_disks_in_use, fake_consume_task):
+        """``purge_retired`` destroys retired templates without any linked clones"""
+        unused = _make_retired('dataiq-template-1.0.0-retired-1', '[ds] t1/t1.vmdk')
+        in_use = _make_retired('dataiq-template-1.0.0-retired-2', '[ds] t2/t2.vmdk')
+        fake_get_folder.return_value.childEntity = [unused, in_use]
+        fake_disks_in_use.return_value = {'[ds] t2/t2.vmdk'}
+
+        output = templates.purge_retired(MagicMock(), MagicMock())
+
+        self.assertEqual(output, ['dataiq-template-1.0.0-retired-1'])
+        self.assertFalse(in_use.Destroy_Task.called)
+
+    @patch.object(templates, 'consume_task')
+    @patch.object(templates, '_disks_in_use')
+    @patch.object(templates, 'get_folder')
+    def test_purge_retired_grace(self, fake_get_folder, fake_disks_in_use, fake_consume_task):
+        """``purge_retired`` keeps a template that was only just retired"""
+        recent = _make_retired('dataiq-template-1.0.0-retired-{}'.format(int(time.time())), '[ds] t1/t1.vmdk')
+        fake_get_folder.return_value.childEntity = [recent]
+
+        output = templates.purge_retired(MagicMock(), MagicMock())
+
+        self.assertEqual(output, [])
+        self.assertFalse(fake_disks_in_use.called)
+
+    @patch.object(templates, '_disks_in_use')
+    @patch.object(templates, 'get_folder')
+    def test_purge_retired_only_retired(self, fake_get_folder, fake_disks_in_use):
+        """``purge_retired`` doesn't touch templates that are in use"""
+        current = _make_retired('dataiq-template-1.0.0', '[ds] t1/t1.vmdk')
+        fake_get_folder.return_value.childEntity = [current]
+
+        output = templates.purge_retired(MagicMock(), MagicMock())
+
+        self.assertEqual(output, [])
+        self.assertFalse(current.Destroy_Task.called)
+
+    @patch.object(templates, '_make_template')
+    @patch.object(templates, 'get_folder')
+    @patch.object(templates, '_ova_signature')
+    @patch.object(templates, 'file_lock')
+    def test_get_template_new(self, fake_file_lock, fake_ova_signature, fake_get_folder,
+                              fake_make_template):
+        """``get_template`` makes a template when there isn't one for the image"""
+        fake_get_folder.return_value.childEntity = []
+
+        templates.get_template(MagicMock(), '1.0.0', '/images/dataiq-1.0.0.ova', MagicMock())
+
+        self.assertTrue(fake_make_template.called)
+
+    @patch.object(templates, 'consume_task')
+    @patch.object(templates.lookups, 'network')
+    @patch.object(templates.virtual_machine, 'set_meta')
+    @patch.object(templates.virtual_machine, 'deploy_from_ova')
+    @patch.object(templates.ova_cache, 'open_ova')
+    def test_make_template(self, fake_open_ova, fake_deploy_from_ova, fake_set_meta, fake_network, fake_consume_task):
+        """``_make_template`` snapshots the new template"""
+        fake_open_ova.return_value.networks = ['someLAN']
+        fake_network.return_value = templates.vim.Network('network-1')
+
+        templates._make_template(MagicMock(), '1.0.0', '/images/dataiq-1.0.0.ova',
+                                 'dataiq-template-1.0.0', {'mtime': 1, 'size': 2}, MagicMock())
+
+        self.assertTrue(fake_deploy_from_ova.return_value.CreateSnapshot_Task.called)
+
+    @patch.object(templates, 'consume_task')
+    @patch.object(templates.lookups, 'network')
+    @patch.object(templates.virtual_machine, 'set_meta')
+    @patch.object(templates.virtual_machine, 'deploy_from_ova')
+    @patch.object(templates.ova_cache, 'open_ova')
+    def test_make_template_network(self, fake_open_ova, fake_deploy_from_ova, fake_set_meta, fake_network,
+                                   fake_consume_task):
+        """``_make_template`` connects the template to the provisioning network, not a user's network"""
+        fake_open_ova.return_value.networks = ['someLAN']
+        fake_network.return_value = templates.vim.Network('network-1')
+
+        templates._make_template(MagicMock(), '1.0.0', '/images/dataiq-1.0.0.ova',
+                                 'dataiq-template-1.0.0', {'mtime': 1, 'size': 2}, MagicMock())
+        network_map = fake_deploy_from_ova.call_args[1]['network_map'][0]
+
+        self.assertEqual(fake_network.call_args[0][1], templates.const.VLAB_DATAIQ_PROVISION_NETWORK)
+        self.assertEqual(network_map.network, templates.vim.Network('network-1'))
+
+    def test_get_folder(self):
+        """``get_folder`` creates the folder if it doesn't exist"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.get_by_name.side_effect = [ValueError('testing'), MagicMock()]
+
+        templates.get_folder(fake_vcenter, 'dataiq-templates')
+
+        self.assertTrue(fake_vcenter.create_vm_folder.called)
+
+    def test_ova_signature_missing(self):
+        """``_ova_signature`` raises ValueError if the image doesn't exist"""
+        with self.assertRaises(ValueError):
+            templates._ova_signature('/not/a/real/dataiq-1.0.0.ova')
+
+    def test_template_source_no_meta(self):
+        """``_template_source`` returns None when the template has no meta data"""
+        fake_template = MagicMock()
+        fake_template.config.annotation = ''
+
+        self.assertTrue(templates._template_source(fake_template) is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,156 +2,780 @@
 """
 A suite of tests for the functions in vmware.py
 """
+import os
+import shutil
 import builtins
+import tempfile
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, PropertyMock, mock_open
 
 from vlab_dataiq_api.lib.worker import vmware
 
 
+def _make_network(name):
+    """Build a fake network, like the ones ``vCenter.get_by_type`` returns"""
+    network = MagicMock(spec=vmware.vim.Network)
+    network.name = name
+    return network
+
+
 class TestVMware(unittest.TestCase):
     """A set of test cases for the vmware.py module"""
 
-    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, '_get_console_params')
+    @patch.object(vmware, '_retrieve_vm_properties')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_show_dataiq(self, fake_vCenter, fake_consume_task, fake_get_info):
+    @patch.object(vmware, 'vcenter_session')
+    def test_show_dataiq(self, fake_vcenter_session, fake_consume_task, fake_retrieve_vm_properties,
+                         fake_get_console_params):
         """``dataiq`` returns a dictionary when everything works as expected"""
-        fake_vm = MagicMock()
-        fake_vm.name = 'DataIQ'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'DataIQ',
-                                               'created': 1234,
-                                               'version': '1.0',
-                                               'configured': False,
-                                               'generation': 1}}
+        fake_vm = vmware.vim.VirtualMachine('vm-1')
+        props = {'name': 'DataIQ',
+                 'runtime.powerState': 'poweredOn',
+                 'config.annotation': '{"component": "DataIQ", "created": 1234, "version": "1.0", "configured": false, "generation": 1}',
+                 'guest.net': [],
+                 'network': []}
+        fake_retrieve_vm_properties.return_value = ([(fake_vm, props)], {})
 
         output = vmware.show_dataiq(username='alice')
-        expected = {'DataIQ': {'meta': {'component': 'DataIQ',
-                                                             'created': 1234,
-                                                             'version': '1.0',
-                                                             'configured': False,
-                                                             'generation': 1}}}
-        self.assertEqual(output, expected)
+        expected = {'meta': {'component': 'DataIQ',
+                             'created': 1234,
+                             'version': '1.0',
+                             'configured': False,
+                             'generation': 1}}
+
+        self.assertEqual(output['DataIQ']['meta'], expected['meta'])
+
+    @patch.object(vmware, '_get_console_params')
+    @patch.object(vmware, '_retrieve_vm_properties')
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_show_dataiq_filters(self, fake_vcenter_session, fake_consume_task, fake_retrieve_vm_properties,
+                                 fake_get_console_params):
+        """``show_dataiq`` only returns DataIQ machines"""
+        fake_vm = vmware.vim.VirtualMachine('vm-1')
+        props = {'name': 'someOtherVM', 'config.annotation': '{"component": "OneFS"}'}
+        fake_retrieve_vm_properties.return_value = ([(fake_vm, props)], {})
+
+        output = vmware.show_dataiq(username='alice')
+
+        self.assertEqual(output, {})
+        self.assertFalse(fake_get_console_params.called)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, '_get_console_params')
+    @patch.object(vmware, '_retrieve_vm_properties')
+    @patch.object(vmware.inventory, 'get_inventory')
+    @patch.object(vmware, 'vcenter_session')
+    def test_show_dataiq_live_inventory(self, fake_vcenter_session, fake_get_inventory,
+                                        fake_retrieve_vm_properties, fake_get_console_params):
+        """``show_dataiq`` skips connecting to vCenter when the live inventory says there's no DataIQ"""
+        fake_get_inventory.return_value.dataiq_vms.return_value = {}
+
+        output = vmware.show_dataiq(username='alice')
+
+        self.assertEqual(output, {})
+        self.assertFalse(fake_vcenter_session.called)
+
+    @patch.object(vmware, '_get_console_params')
+    @patch.object(vmware, '_retrieve_vm_properties')
+    @patch.object(vmware.inventory, 'get_inventory')
+    @patch.object(vmware, 'vcenter_session')
+    def test_show_dataiq_live_inventory_vms(self, fake_vcenter_session, fake_get_inventory,
+                                            fake_retrieve_vm_properties, fake_get_console_params):
+        """``show_dataiq`` only retrieves the VMs the live inventory returns"""
+        fake_get_inventory.return_value.dataiq_vms.return_value = {'myDataIQ': 'vm-1'}
+        fake_retrieve_vm_properties.return_value = ([], {})
+
+        vmware.show_dataiq(username='alice')
+        the_vms = fake_retrieve_vm_properties.call_args[1]['the_vms']
+
+        self.assertEqual([x._moId for x in the_vms], ['vm-1'])
+
+    @patch.object(vmware, '_destroy')
+    @patch.object(vmware.inventory, 'get_inventory')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_dataiq_live_inventory(self, fake_vcenter_session, fake_get_inventory, fake_destroy):
+        """``delete_dataiq`` uses the live inventory instead of scanning the user's folder"""
+        fake_logger = MagicMock()
+        fake_get_inventory.return_value.find.return_value = 'vm-1'
+        fake_vcenter = fake_vcenter_session.return_value.__enter__.return_value
+
+        vmware.delete_dataiq(username='bob', machine_name='DataIQBox', logger=fake_logger)
+
+        self.assertTrue(fake_destroy.called)
+        self.assertFalse(fake_vcenter.get_by_name.called)
+
+    def test_retrieve_vm_properties(self):
+        """``_retrieve_vm_properties`` fetches every VM with a single RetrievePropertiesEx call"""
+        fake_vcenter = MagicMock()
+        fake_vm = vmware.vim.VirtualMachine('vm-1')
+        fake_net = vmware.vim.Network('network-1')
+        vm_obj = MagicMock()
+        vm_obj.obj = fake_vm
+        vm_obj.propSet = [vmware.vim.DynamicProperty(name='name', val='myDataIQ')]
+        net_obj = MagicMock()
+        net_obj.obj = fake_net
+        net_obj.propSet = [vmware.vim.DynamicProperty(name='name', val='alice_someLAN')]
+        collector = fake_vcenter.content.propertyCollector
+        collector.RetrievePropertiesEx.return_value.objects = [vm_obj, net_obj]
+        collector.RetrievePropertiesEx.return_value.token = None
+
+        vms, network_names = vmware._retrieve_vm_properties(fake_vcenter, vmware.vim.Folder('group-1'))
+
+        self.assertEqual(vms, [(fake_vm, {'name': 'myDataIQ'})])
+        self.assertEqual(network_names, {'network-1': 'alice_someLAN'})
+        self.assertEqual(collector.RetrievePropertiesEx.call_count, 1)
+
+    def test_retrieve_vm_properties_token(self):
+        """``_retrieve_vm_properties`` continues retrieving when the results are paged"""
+        fake_vcenter = MagicMock()
+        collector = fake_vcenter.content.propertyCollector
+        collector.RetrievePropertiesEx.return_value.objects = []
+        collector.RetrievePropertiesEx.return_value.token = 'someToken'
+        collector.ContinueRetrievePropertiesEx.return_value.objects = []
+        collector.ContinueRetrievePropertiesEx.return_value.token = None
+
+        vmware._retrieve_vm_properties(fake_vcenter, vmware.vim.Folder('group-1'))
+
+        self.assertTrue(collector.ContinueRetrievePropertiesEx.called)
+
+    def test_parse_meta(self):
+        """``_parse_meta`` returns the 'Unknown' meta data when the annotation is not set"""
+        output = vmware._parse_meta(None)
+
+        self.assertEqual(output, vmware.UNKNOWN_META)
+
+    def test_format_info(self):
+        """``_format_info`` returns the same keys as ``virtual_machine.get_info``"""
+        fake_vm = vmware.vim.VirtualMachine('vm-1')
+        fake_nic = MagicMock()
+        fake_nic.ipAddress = ['10.7.7.2', 'fe80::1']
+        props = {'name': 'myDataIQ',
+                 'runtime.powerState': 'poweredOn',
+                 'guest.net': [fake_nic],
+                 'network': [vmware.vim.Network('network-1')]}
+        console_params = {'thumbprint': 'AA:BB', 'server_guid': 'someGuid', 'session_manager': MagicMock()}
+
+        output = vmware._format_info(fake_vm, props, {}, {'network-1': 'alice_someLAN'}, console_params, 'alice')
+
+        self.assertEqual(set(output.keys()), {'state', 'console', 'ips', 'networks', 'moid', 'meta'})
+        self.assertEqual(output['ips'], ['10.7.7.2'])
+        self.assertEqual(output['networks'], ['someLAN'])
+
+    @patch.object(vmware, '_get_console_params')
+    @patch.object(vmware, '_retrieve_vm_properties')
+    @patch.object(vmware.readiness, 'wait_for_ip')
+    def test_vm_info(self, fake_wait_for_ip, fake_retrieve_vm_properties, fake_get_console_params):
+        """``_vm_info`` waits for an IP, then reads the network names from vCenter instead of a cache"""
+        fake_vm = vmware.vim.VirtualMachine('vm-1')
+        props = {'name': 'myDataIQ', 'network': [vmware.vim.Network('network-1')]}
+        fake_retrieve_vm_properties.return_value = ([(fake_vm, props)], {'network-1': 'alice_someLAN'})
+        fake_get_console_params.return_value = {'thumbprint': 'AA:BB', 'server_guid': 'someGuid', 'session_manager': MagicMock()}
+
+        output = vmware._vm_info(MagicMock(), fake_vm, 'alice')
+
+        self.assertTrue(fake_wait_for_ip.called)
+        self.assertEqual(output['networks'], ['someLAN'])
+
+    @patch.object(vmware, '_vm_info')
     @patch.object(vmware.virtual_machine, 'power')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_dataiq(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_dataiq(self, fake_vcenter_session, fake_consume_task, fake_power, fake_vm_info):
         """``delete_dataiq`` returns None when everything works as expected"""
         fake_logger = MagicMock()
-        fake_vm = MagicMock()
+        fake_vm = MagicMock(spec=vmware.vim.VirtualMachine)
         fake_vm.name = 'DataIQBox'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'DataIQ',
-                                               'created': 1234,
-                                               'version': '1.0',
-                                               'configured': False,
-                                               'generation': 1}}
+        fake_vm.config.annotation = '{"component": "DataIQ", "created": 1234, "version": "1.0", "configured": false, "generation": 1}'
+        fake_vcenter_session.return_value.__enter__.return_value.content.searchIndex.FindChild.return_value = fake_vm
 
         output = vmware.delete_dataiq(username='bob', machine_name='DataIQBox', logger=fake_logger)
         expected = None
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, '_vm_info')
     @patch.object(vmware.virtual_machine, 'power')
     @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_delete_dataiq_value_error(self, fake_vCenter, fake_consume_task, fake_power, fake_get_info):
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_dataiq_value_error(self, fake_vcenter_session, fake_consume_task, fake_power, fake_vm_info):
         """``delete_dataiq`` raises ValueError when unable to find requested vm for deletion"""
         fake_logger = MagicMock()
-        fake_vm = MagicMock()
-        fake_vm.name = 'win10'
-        fake_folder = MagicMock()
-        fake_folder.childEntity = [fake_vm]
-        fake_vCenter.return_value.__enter__.return_value.get_by_name.return_value = fake_folder
-        fake_get_info.return_value = {'meta': {'component': 'DataIQ',
-                                               'created': 1234,
-                                               'version': '1.0',
-                                               'configured': False,
-                                               'generation': 1}}
+        fake_vcenter_session.return_value.__enter__.return_value.content.searchIndex.FindChild.return_value = None
 
         with self.assertRaises(ValueError):
             vmware.delete_dataiq(username='bob', machine_name='myOtherDataIQBox', logger=fake_logger)
 
-    @patch.object(vmware, '_add_gui')
-    @patch.object(vmware, '_config_network')
-    @patch.object(vmware.virtual_machine, 'adjust_ram')
-    @patch.object(vmware.virtual_machine, 'adjust_cpu')
-    @patch.object(vmware, '_add_database_disk')
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_dataiq_not_dataiq(self, fake_vcenter_session, fake_consume_task, fake_power):
+        """``delete_dataiq`` raises ValueError if the VM with that name isn't a DataIQ"""
+        fake_vm = MagicMock()
+        fake_vm.config.annotation = '{"component": "Windows"}'
+        fake_vcenter_session.return_value.__enter__.return_value.content.searchIndex.FindChild.return_value = fake_vm
+
+        with self.assertRaises(ValueError):
+            vmware.delete_dataiq(username='bob', machine_name='win10', logger=MagicMock())
+
+        self.assertFalse(fake_vm.Destroy_Task.called)
+
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, '_retrieve_vm_properties')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_many(self, fake_vcenter_session, fake_retrieve_vm_properties, fake_consume_task):
+        """``delete_many`` starts every destroy before waiting on any of them"""
+        vm1, vm2 = MagicMock(), MagicMock()
+        fake_vcenter_session.return_value.__enter__.return_value.content.searchIndex.FindChild.return_value = MagicMock(spec=vmware.vim.VirtualMachine)
+        fake_retrieve_vm_properties.return_value = ([(vm1, {'name': 'dq1', 'config.annotation': '{"component": "DataIQ"}', 'runtime.powerState': 'poweredOn'}),
+                                                     (vm2, {'name': 'dq2', 'config.annotation': '{"component": "DataIQ"}', 'runtime.powerState': 'poweredOff'})],
+                                                    {})
+        calls = MagicMock()
+        calls.attach_mock(vm1.Destroy_Task, 'destroy1')
+        calls.attach_mock(vm2.Destroy_Task, 'destroy2')
+        calls.attach_mock(fake_consume_task, 'wait')
+
+        deleted, errors = vmware.delete_many('bob', ['dq1', 'dq2'], MagicMock())
+        call_order = [x[0] for x in calls.mock_calls]
+
+        self.assertEqual(deleted, ['dq1', 'dq2'])
+        self.assertEqual(errors, {})
+        self.assertTrue(vm1.PowerOffVM_Task.called)
+        self.assertFalse(vm2.PowerOffVM_Task.called)
+        self.assertEqual(call_order[-4:], ['destroy1', 'destroy2', 'wait', 'wait'])
+
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, '_retrieve_vm_properties')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_many_missing(self, fake_vcenter_session, fake_retrieve_vm_properties, fake_consume_task):
+        """``delete_many`` reports names that aren't found, and deletes the rest"""
+        fake_vcenter = fake_vcenter_session.return_value.__enter__.return_value
+        vm1 = MagicMock(spec=vmware.vim.VirtualMachine)
+        fake_vcenter.content.searchIndex.FindChild.side_effect = [vm1, None]
+        fake_retrieve_vm_properties.return_value = ([(vm1, {'name': 'dq1', 'config.annotation': '{"component": "DataIQ"}'})], {})
+
+        deleted, errors = vmware.delete_many('bob', ['dq1', 'dq2'], MagicMock())
+
+        self.assertEqual(deleted, ['dq1'])
+        self.assertEqual(list(errors.keys()), ['dq2'])
+
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, '_retrieve_vm_properties')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_many_all(self, fake_vcenter_session, fake_retrieve_vm_properties, fake_consume_task):
+        """``delete_many`` deletes only the DataIQ machines when given no names"""
+        vm1, vm2 = MagicMock(), MagicMock()
+        fake_retrieve_vm_properties.return_value = ([(vm1, {'name': 'dq1', 'config.annotation': '{"component": "DataIQ"}'}),
+                                                     (vm2, {'name': 'win10', 'config.annotation': '{"component": "Windows"}'})],
+                                                    {})
+
+        deleted, errors = vmware.delete_many('bob', None, MagicMock())
+
+        self.assertEqual(deleted, ['dq1'])
+        self.assertEqual(errors, {})
+        self.assertFalse(vm2.Destroy_Task.called)
+
+    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, '_retrieve_vm_properties')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_many_task_error(self, fake_vcenter_session, fake_retrieve_vm_properties, fake_consume_task):
+        """``delete_many`` records the error of a VM whose destroy failed"""
+        vm1 = MagicMock()
+        fake_retrieve_vm_properties.return_value = ([(vm1, {'name': 'dq1', 'config.annotation': '{"component": "DataIQ"}'})], {})
+        fake_consume_task.side_effect = RuntimeError('testing')
+
+        deleted, errors = vmware.delete_many('bob', None, MagicMock())
+
+        self.assertEqual(deleted, [])
+        self.assertEqual(errors, {'dq1': 'testing'})
+
+    @patch.object(vmware, 'check_image')
+    @patch.object(vmware, 'image_meta')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware, 'placement')
+    def test_stage_deploy_placement(self, fake_placement, fake_deploy, fake_set_meta, fake_image_meta, fake_check_image):
+        """``_stage_deploy`` deploys to the placed datastore and host, and records the decision"""
+        location = {'datastore': 'ds1', 'host': 'esxi1', 'score': 0.5}
+        fake_placement.placed.return_value.__enter__.return_value = location
+        fake_image_meta.return_value = {}
+        spec = {'image': '1.0.0', 'network': 'someLAN', 'username': 'alice',
+                'machine_name': 'DataIQBox', 'disk_size': 250}
+
+        _, meta = vmware._stage_deploy(MagicMock(), spec, MagicMock())
+
+        self.assertEqual(fake_deploy.call_args[1]['location'], location)
+        self.assertEqual(meta['placement'], location)
+
+    @patch.object(vmware, 'check_image')
+    @patch.object(vmware, 'image_meta')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware, 'admission')
+    def test_stage_deploy_queued(self, fake_admission, fake_deploy, fake_set_meta, fake_image_meta, fake_check_image):
+        """``_stage_deploy`` reports the queue position while it waits to deploy"""
+        fake_admission.admitted.side_effect = lambda username, datastore, on_wait: on_wait(3) or MagicMock()
+        fake_image_meta.return_value = {}
+        fake_progress = MagicMock()
+        spec = {'image': '1.0.0', 'network': 'someLAN', 'username': 'alice',
+                'machine_name': 'DataIQBox', 'disk_size': 250}
+
+        vmware._stage_deploy(MagicMock(), spec, MagicMock(), progress=fake_progress)
+        reported = fake_progress.call_args[0][0]
+
+        self.assertEqual(reported['queue_position'], 3)
+        self.assertEqual(reported['stage'], 'deploy')
+
+    @patch.object(vmware, '_wait_for_lease')
+    def test_deploy_placed(self, fake_wait_for_lease):
+        """``_deploy_placed`` uploads the OVA to the datastore and host it's given"""
+        fake_vcenter = MagicMock()
+        fake_vm = MagicMock()
+        fake_vm.name = 'DataIQBox'
+        fake_vcenter.get_by_name.return_value.childEntity = [fake_vm]
+        fake_vcenter.host_systems = {'esxi1': MagicMock()}
+        fake_ova = MagicMock()
+
+        output = vmware._deploy_placed(fake_vcenter, fake_ova, vmware.vim.OvfManager.NetworkMapping(), 'alice',
+                                       'DataIQBox', {'datastore': 'ds1', 'host': 'esxi1'}, MagicMock())
+
+        self.assertTrue(output is fake_vm)
+        import_vapp = fake_vcenter.resource_pools.__getitem__.return_value.ImportVApp
+        self.assertTrue(import_vapp.call_args[1]['host'] is fake_vcenter.host_systems['esxi1'])
+        fake_wait_for_lease.assert_called_with(import_vapp.return_value)
+        self.assertTrue(fake_ova.deploy.called)
+
+    @patch.object(vmware, '_wait_for_lease')
+    def test_deploy_placed_missing(self, fake_wait_for_lease):
+        """``_deploy_placed`` raises RuntimeError if the new VM can't be found"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.get_by_name.return_value.childEntity = []
+        fake_vcenter.host_systems = {'esxi1': MagicMock()}
+
+        with self.assertRaises(RuntimeError):
+            vmware._deploy_placed(fake_vcenter, MagicMock(), vmware.vim.OvfManager.NetworkMapping(), 'alice',
+                                  'DataIQBox', {'datastore': 'ds1', 'host': 'esxi1'}, MagicMock())
+
+    @patch.object(vmware.time, 'sleep')
+    def test_wait_for_lease(self, fake_sleep):
+        """``_wait_for_lease`` returns once the lease is ready"""
+        fake_lease = MagicMock()
+        fake_lease.error = None
+        type(fake_lease).state = PropertyMock(side_effect=['initializing', 'ready'])
+
+        vmware._wait_for_lease(fake_lease)
+
+        self.assertEqual(fake_sleep.call_count, 1)
+
+    @patch.object(vmware.time, 'sleep')
+    def test_wait_for_lease_error(self, fake_sleep):
+        """``_wait_for_lease`` raises RuntimeError if the lease fails"""
+        fake_lease = MagicMock()
+        fake_lease.error.msg = 'testing'
+
+        with self.assertRaisesRegex(RuntimeError, 'testing'):
+            vmware._wait_for_lease(fake_lease)
+
+    @patch.object(vmware.time, 'sleep')
+    def test_wait_for_lease_timeout(self, fake_sleep):
+        """``_wait_for_lease`` raises RuntimeError if the lease is never ready"""
+        fake_lease = MagicMock()
+        fake_lease.error = None
+        fake_lease.state = 'initializing'
+
+        with self.assertRaises(RuntimeError):
+            vmware._wait_for_lease(fake_lease, timeout=3)
+
+    @patch.object(vmware, 'check_image')
+    @patch.object(vmware, 'image_meta')
+    @patch.object(vmware, 'const')
+    @patch.object(vmware.templates, 'clone_from_template')
     @patch.object(vmware.virtual_machine, 'set_meta')
-    @patch.object(vmware, 'Ova')
-    @patch.object(vmware.virtual_machine, 'get_info')
     @patch.object(vmware.virtual_machine, 'deploy_from_ova')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_create_dataiq(self, fake_vCenter, fake_consume_task, fake_deploy_from_ova,
-                           fake_get_info, fake_Ova, fake_set_meta, fake_add_database_disk,
-                           fake_adjust_cpu, fake_adjust_ram, fake_config_network,
-                           fake_add_gui):
-        """``create_dataiq`` returns a dictionary upon success"""
-        fake_logger = MagicMock()
-        fake_deploy_from_ova.return_value.name = 'myDataIQ'
-        fake_get_info.return_value = {'worked': True}
-        fake_Ova.return_value.networks = ['someLAN']
-        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
-
-
-        output = vmware.create_dataiq(username='alice',
-                                       machine_name='DataIQBox',
-                                       image='1.0.0',
-                                       network='someLAN',
-                                       static_ip='10.7.7.2',
-                                       default_gateway='10.7.7.1',
-                                       netmask='255.255.255.0',
-                                       dns=['10.7.7.1'],
-                                       disk_size=250,
-                                       cpu_count=4,
-                                       ram=32,
-                                       logger=fake_logger)
-        expected = {'myDataIQ': {'worked': True}}
+    @patch.object(vmware, 'placement')
+    @patch.object(vmware, 'admission')
+    def test_stage_deploy_linked_clone(self, fake_admission, fake_placement, fake_deploy_from_ova, fake_set_meta,
+                                       fake_clone_from_template, fake_const, fake_image_meta, fake_check_image):
+        """``_stage_deploy`` clones from a template instead of uploading the OVA in linked-clone mode"""
+        fake_const.VLAB_DATAIQ_LINKED_CLONE = True
+        fake_const.VLAB_DATAIQ_WARM_POOL_SIZE = 0
+        fake_const.VLAB_DATAIQ_IMAGES_DIR = '/images'
+        fake_placement.placed.return_value.__enter__.return_value = None
+        fake_image_meta.return_value = {}
+        fake_vcenter = MagicMock()
+        fake_vcenter.get_by_type.return_value = [_make_network('someLAN')]
+        spec = {'username': 'alice', 'machine_name': 'DataIQBox', 'image': '1.0.0', 'network': 'someLAN',
+                'static_ip': '10.7.7.2', 'default_gateway': '10.7.7.1', 'netmask': '255.255.255.0',
+                'dns': ['10.7.7.1'], 'disk_size': 250, 'cpu_count': 4, 'ram': 32}
 
-        self.assertEqual(output, expected)
+        the_vm, _ = vmware._stage_deploy(fake_vcenter, spec, MagicMock())
+
+        self.assertTrue(the_vm is fake_clone_from_template.return_value)
+        self.assertFalse(fake_deploy_from_ova.called)
 
-    @patch.object(vmware, '_add_database_disk')
-    @patch.object(vmware, 'Ova')
-    @patch.object(vmware.virtual_machine, 'get_info')
+    @patch.object(vmware, 'check_image')
+    @patch.object(vmware.warm_pool, 'claim')
+    @patch.object(vmware.warm_pool, 'enabled')
+    @patch.object(vmware.virtual_machine, 'change_network')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_deploy')
+    def test_stage_deploy_warm_pool(self, fake_deploy, fake_set_meta, fake_change_network, fake_enabled,
+                                    fake_claim, fake_check_image):
+        """``_stage_deploy`` claims a VM from the warm pool instead of deploying a new one"""
+        fake_enabled.return_value = True
+        fake_vcenter = MagicMock()
+        fake_vcenter.get_by_type.return_value = [_make_network('someLAN')]
+        spec = {'username': 'alice', 'machine_name': 'DataIQBox', 'image': '1.0.0', 'network': 'someLAN',
+                'static_ip': '10.7.7.2', 'default_gateway': '10.7.7.1', 'netmask': '255.255.255.0',
+                'dns': ['10.7.7.1'], 'disk_size': 250, 'cpu_count': 4, 'ram': 32}
+
+        the_vm, meta = vmware._stage_deploy(fake_vcenter, spec, MagicMock())
+
+        self.assertTrue(the_vm is fake_claim.return_value)
+        self.assertFalse(fake_deploy.called)
+        self.assertTrue(fake_change_network.called)
+        # Pool VMs already have the GUI, so the gui and rdp stages are skipped
+        self.assertTrue(meta['has_gui'])
+
+    @patch.object(vmware, 'check_image')
+    @patch.object(vmware, 'image_meta')
+    @patch.object(vmware.warm_pool, 'claim')
+    @patch.object(vmware.warm_pool, 'enabled')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware, 'placement')
+    @patch.object(vmware, 'admission')
+    def test_stage_deploy_warm_pool_empty(self, fake_admission, fake_placement, fake_deploy, fake_set_meta,
+                                          fake_enabled, fake_claim, fake_image_meta, fake_check_image):
+        """``_stage_deploy`` deploys a new VM when the warm pool is empty"""
+        fake_enabled.return_value = True
+        fake_claim.return_value = None
+        fake_placement.placed.return_value.__enter__.return_value = None
+        fake_image_meta.return_value = {}
+        spec = {'username': 'alice', 'machine_name': 'DataIQBox', 'image': '1.0.0', 'network': 'someLAN',
+                'static_ip': '10.7.7.2', 'default_gateway': '10.7.7.1', 'netmask': '255.255.255.0',
+                'dns': ['10.7.7.1'], 'disk_size': 250, 'cpu_count': 4, 'ram': 32}
+
+        the_vm, meta = vmware._stage_deploy(MagicMock(), spec, MagicMock())
+
+        self.assertTrue(the_vm is fake_deploy.return_value)
+        self.assertFalse(meta['has_gui'])
+
+    @patch.object(vmware.templates, 'purge_retired')
+    @patch.object(vmware, '_provision_pool_vm')
+    @patch.object(vmware.warm_pool, 'shortfall')
+    @patch.object(vmware.warm_pool, 'refill_lock')
+    @patch.object(vmware.warm_pool, 'enabled')
+    @patch.object(vmware, 'vcenter_session')
+    def test_refill_warm_pool(self, fake_vcenter_session, fake_enabled, fake_refill_lock,
+                              fake_shortfall, fake_provision_pool_vm, fake_purge_retired):
+        """``refill_warm_pool`` provisions enough VMs to fill the pool"""
+        fake_enabled.return_value = True
+        fake_shortfall.return_value = 2
+
+        output = vmware.refill_warm_pool('1.0.0', MagicMock())
+
+        self.assertEqual(output, 2)
+        self.assertEqual(fake_provision_pool_vm.call_count, 2)
+
+    @patch.object(vmware.templates, 'purge_retired')
+    @patch.object(vmware, '_provision_pool_vm')
+    @patch.object(vmware.warm_pool, 'shortfall')
+    @patch.object(vmware.warm_pool, 'refill_lock')
+    @patch.object(vmware.warm_pool, 'enabled')
+    @patch.object(vmware, 'vcenter_session')
+    def test_refill_warm_pool_purges(self, fake_vcenter_session, fake_enabled, fake_refill_lock,
+                                     fake_shortfall, fake_provision_pool_vm, fake_purge_retired):
+        """``refill_warm_pool`` cleans up retired templates"""
+        fake_enabled.return_value = True
+        fake_shortfall.return_value = 0
+
+        vmware.refill_warm_pool('1.0.0', MagicMock())
+
+        self.assertTrue(fake_purge_retired.called)
+
+    @patch.object(vmware, '_provision_pool_vm')
+    @patch.object(vmware.warm_pool, 'refill_lock')
+    @patch.object(vmware.warm_pool, 'enabled')
+    @patch.object(vmware, 'vcenter_session')
+    def test_refill_warm_pool_busy(self, fake_vcenter_session, fake_enabled, fake_refill_lock,
+                                   fake_provision_pool_vm):
+        """``refill_warm_pool`` returns right away if another process is already refilling the pool"""
+        fake_enabled.return_value = True
+        fake_refill_lock.return_value.__enter__.return_value = False
+
+        output = vmware.refill_warm_pool('1.0.0', MagicMock())
+
+        self.assertEqual(output, 0)
+        self.assertFalse(fake_vcenter_session.called)
+        self.assertFalse(fake_provision_pool_vm.called)
+
+    @patch.object(vmware, 'vcenter_session')
+    def test_refill_warm_pool_disabled(self, fake_vcenter_session):
+        """``refill_warm_pool`` does nothing for images without a warm pool"""
+        output = vmware.refill_warm_pool('1.0.0', MagicMock())
+
+        self.assertEqual(output, 0)
+        self.assertFalse(fake_vcenter_session.called)
+
+    @patch.object(vmware, '_shutdown')
+    @patch.object(vmware, '_add_gui')
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware.templates, 'get_folder')
+    def test_provision_pool_vm(self, fake_get_folder, fake_deploy, fake_set_meta, fake_power,
+                               fake_add_gui, fake_shutdown):
+        """``_provision_pool_vm`` only marks the VM as ready after it's provisioned and powered off"""
+        vmware._provision_pool_vm(MagicMock(), '1.0.0', MagicMock())
+
+        last_meta = fake_set_meta.call_args[0][1]
+
+        self.assertTrue(fake_add_gui.called)
+        self.assertTrue(fake_shutdown.called)
+        self.assertTrue(last_meta['ready'])
+
+    @patch.object(vmware.virtual_machine, 'power')
+    def test_shutdown(self, fake_power):
+        """``_shutdown`` doesn't force a power off when the guest shuts down"""
+        fake_vm = MagicMock()
+        fake_vm.runtime.powerState = 'poweredOff'
+
+        vmware._shutdown(fake_vm, MagicMock())
+
+        self.assertTrue(fake_vm.ShutdownGuest.called)
+        self.assertFalse(fake_power.called)
+
+    @patch.object(vmware.time, 'sleep')
+    @patch.object(vmware.virtual_machine, 'power')
+    def test_shutdown_timeout(self, fake_power, fake_sleep):
+        """``_shutdown`` powers off the VM if the guest doesn't shutdown in time"""
+        fake_vm = MagicMock()
+        fake_vm.runtime.powerState = 'poweredOn'
+
+        vmware._shutdown(fake_vm, MagicMock(), timeout=2)
+
+        fake_power.assert_called_with(fake_vm, state='off')
+
+    @patch.object(vmware, 'const')
+    @patch.object(vmware.ova_cache, 'open_ova')
     @patch.object(vmware.virtual_machine, 'deploy_from_ova')
-    @patch.object(vmware, 'consume_task')
-    @patch.object(vmware, 'vCenter')
-    def test_create_dataiq_invalid_network(self, fake_vCenter, fake_consume_task,
-                                           fake_deploy_from_ova, fake_get_info, fake_Ova,
-                                           fake_add_database_disk):
-        """``create_dataiq`` raises ValueError if supplied with a non-existing network"""
-        fake_logger = MagicMock()
-        fake_get_info.return_value = {'worked': True}
-        fake_Ova.return_value.networks = ['someLAN']
-        fake_vCenter.return_value.__enter__.return_value.networks = {'someLAN' : vmware.vim.Network(moId='1')}
+    def test_deploy_invalid_network(self, fake_deploy_from_ova, fake_open_ova, fake_const):
+        """``_deploy`` raises ValueError if supplied with a non-existing network"""
+        fake_const.VLAB_DATAIQ_LINKED_CLONE = False
+        fake_const.VLAB_DATAIQ_IMAGES_DIR = '/images'
+        fake_open_ova.return_value.networks = ['someLAN']
+        fake_vcenter = MagicMock()
+        fake_vcenter.get_by_type.return_value = [_make_network('someLAN')]
+
+        with self.assertRaises(ValueError):
+            vmware._deploy(fake_vcenter, '1.0.0', 'someOtherLAN', 'alice', 'DataIQBox', MagicMock())
+
+        self.assertFalse(fake_deploy_from_ova.called)
+
+    @patch.object(vmware, 'const')
+    @patch.object(vmware.ova_cache, 'open_ova')
+    @patch.object(vmware, '_deploy_placed')
+    def test_deploy_placed_bad_name(self, fake_deploy_placed, fake_open_ova, fake_const):
+        """``_deploy`` raises ValueError for a machine name that isn't a valid hostname, before a placed deploy"""
+        fake_const.VLAB_DATAIQ_LINKED_CLONE = False
+        fake_const.VLAB_DATAIQ_IMAGES_DIR = '/images'
+
+        with self.assertRaises(ValueError):
+            vmware._deploy(MagicMock(), '1.0.0', 'someLAN', 'alice', 'box; reboot', MagicMock(),
+                           location={'datastore': 'ds1', 'host': 'esxi1'})
+
+        self.assertFalse(fake_deploy_placed.called)
+        self.assertFalse(fake_open_ova.called)
+
+    @patch.object(vmware, 'const')
+    @patch.object(vmware.templates, 'clone_from_template')
+    def test_deploy_linked_clone_bad_name(self, fake_clone_from_template, fake_const):
+        """``_deploy`` raises ValueError for a machine name that isn't a valid hostname, before cloning"""
+        fake_const.VLAB_DATAIQ_LINKED_CLONE = True
+        fake_const.VLAB_DATAIQ_IMAGES_DIR = '/images'
+
+        with self.assertRaises(ValueError):
+            vmware._deploy(MagicMock(), '1.0.0', 'someLAN', 'alice', 'box; reboot', MagicMock())
+
+        self.assertFalse(fake_clone_from_template.called)
+
+    @patch.object(vmware.stage_times, 'estimate')
+    def test_stage_progress(self, fake_estimate):
+        """``stage_progress`` describes the running stage, and how long the finished ones took"""
+        fake_estimate.return_value = 600
+        meta = {'timings': {'deploy': 30.0, 'size': 2.0}}
+
+        output = vmware.stage_progress('network', meta, vmware.time.time())
+
+        self.assertEqual(output['stage'], 'network')
+        self.assertEqual(output['stage_number'], 3)
+        self.assertEqual(output['elapsed'], {'deploy': 30.0, 'size': 2.0})
+        self.assertEqual(output['eta'], 600)
+
+    @patch.object(vmware.stage_times, 'record')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_stage_size')
+    @patch.object(vmware, '_find_vm')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_stage_progress(self, fake_vcenter_session, fake_find_vm, fake_stage_size,
+                                   fake_set_meta, fake_record):
+        """``create_stage`` reports progress when the stage starts, and records how long it took"""
+        fake_find_vm.return_value.config.annotation = '{"component": "DataIQ", "stages": ["deploy"]}'
+        fake_progress = MagicMock()
+
+        with patch.dict(vmware._STAGES, {'size': fake_stage_size}):
+            vmware.create_stage('size', {'username': 'alice', 'machine_name': 'DataIQBox'},
+                                MagicMock(), progress=fake_progress)
+        reported = fake_progress.call_args[0][0]
+        meta = fake_set_meta.call_args[0][1]
+
+        self.assertEqual(reported['stage'], 'size')
+        self.assertTrue('size' in meta['timings'])
+        self.assertTrue(fake_record.called)
+
+    @patch.object(vmware, '_stage_size')
+    @patch.object(vmware, '_find_vm')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_stage_skips_done(self, fake_vcenter_session, fake_find_vm, fake_stage_size):
+        """``create_stage`` skips a stage that's already recorded in the meta data"""
+        fake_find_vm.return_value.config.annotation = '{"component": "DataIQ", "stages": ["deploy", "size"]}'
+
+        with patch.dict(vmware._STAGES, {'size': fake_stage_size}):
+            vmware.create_stage('size', {'username': 'alice', 'machine_name': 'DataIQBox'}, MagicMock())
+
+        self.assertFalse(fake_stage_size.called)
+
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_stage_size')
+    @patch.object(vmware, '_find_vm')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_stage_checkpoints(self, fake_vcenter_session, fake_find_vm, fake_stage_size, fake_set_meta):
+        """``create_stage`` records the stage in the meta data of the VM once it's done"""
+        fake_find_vm.return_value.config.annotation = '{"component": "DataIQ", "stages": ["deploy"]}'
+
+        with patch.dict(vmware._STAGES, {'size': fake_stage_size}):
+            vmware.create_stage('size', {'username': 'alice', 'machine_name': 'DataIQBox'}, MagicMock())
+        meta = fake_set_meta.call_args[0][1]
+
+        self.assertTrue(fake_stage_size.called)
+        self.assertEqual(meta['stages'], ['deploy', 'size'])
+
+    @patch.object(vmware, '_find_vm')
+    @patch.object(vmware, 'vcenter_session')
+    def test_create_stage_no_vm(self, fake_vcenter_session, fake_find_vm):
+        """``create_stage`` raises ValueError if the VM for a later stage doesn't exist"""
+        fake_find_vm.return_value = None
+
+        with self.assertRaises(ValueError):
+            vmware.create_stage('gui', {'username': 'alice', 'machine_name': 'DataIQBox'}, MagicMock())
+
+    @patch.object(vmware, '_find_vm')
+    @patch.object(vmware, 'vcenter_session')
+    def test_resume_plan(self, fake_vcenter_session, fake_find_vm):
+        """``resume_plan`` returns the create parameters, and the stages that didn't complete"""
+        fake_find_vm.return_value.config.annotation = '{"component": "DataIQ", "create": {"ram": 32}, "stages": ["deploy", "size", "network"]}'
+
+        spec, stages = vmware.resume_plan('alice', 'DataIQBox')
+
+        self.assertEqual(spec, {'ram': 32})
+        self.assertEqual(stages, ['gui', 'rdp', 'info'])
+
+    @patch.object(vmware, '_find_vm')
+    @patch.object(vmware, 'vcenter_session')
+    def test_resume_plan_complete(self, fake_vcenter_session, fake_find_vm):
+        """``resume_plan`` still runs the info stage when every stage is done"""
+        meta = {'component': 'DataIQ', 'create': {'ram': 32}, 'stages': vmware.CREATE_STAGES}
+        fake_find_vm.return_value.config.annotation = vmware.ujson.dumps(meta)
+
+        _, stages = vmware.resume_plan('alice', 'DataIQBox')
+
+        self.assertEqual(stages, ['info'])
+
+    @patch.object(vmware, '_find_vm')
+    @patch.object(vmware, 'vcenter_session')
+    def test_resume_plan_no_record(self, fake_vcenter_session, fake_find_vm):
+        """``resume_plan`` raises ValueError for VMs created before stages were recorded"""
+        fake_find_vm.return_value.config.annotation = '{"component": "DataIQ"}'
+
+        with self.assertRaises(ValueError):
+            vmware.resume_plan('alice', 'DataIQBox')
+
+    @patch.object(vmware, '_find_vm')
+    @patch.object(vmware, 'vcenter_session')
+    def test_resume_plan_no_vm(self, fake_vcenter_session, fake_find_vm):
+        """``resume_plan`` raises ValueError if the VM doesn't exist"""
+        fake_find_vm.return_value = None
+
+        with self.assertRaises(ValueError):
+            vmware.resume_plan('alice', 'DataIQBox')
+
+    @patch.object(vmware.inventory, 'get_inventory')
+    def test_find_vm(self, fake_get_inventory):
+        """``_find_vm`` only returns DataIQ machines"""
+        fake_get_inventory.return_value = None
+        fake_vcenter = MagicMock()
+        fake_vm = MagicMock()
+        fake_vm.name = 'DataIQBox'
+        fake_vm.config.annotation = '{"component": "OneFS"}'
+        fake_vcenter.get_by_name.return_value.childEntity = [fake_vm]
+
+        output = vmware._find_vm(fake_vcenter, 'alice', 'DataIQBox')
+
+        self.assertTrue(output is None)
+
+    @patch.object(vmware.inventory, 'get_inventory')
+    def test_find_vm_found(self, fake_get_inventory):
+        """``_find_vm`` returns the DataIQ machine with the name"""
+        fake_get_inventory.return_value = None
+        fake_vcenter = MagicMock()
+        fake_vm = MagicMock(spec=vmware.vim.VirtualMachine)
+        fake_vm.name = 'DataIQBox'
+        fake_vm.config.annotation = '{"component": "DataIQ"}'
+        fake_vcenter.get_by_name.return_value.childEntity = [fake_vm]
+
+        with patch.object(vmware.lookups, 'folder', return_value=fake_vcenter.get_by_name.return_value):
+            output = vmware._find_vm(fake_vcenter, 'alice', 'DataIQBox')
+
+        self.assertTrue(output is fake_vm)
+
+    @patch.object(vmware.inventory, 'get_inventory')
+    def test_find_vm_folder(self, fake_get_inventory):
+        """``_find_vm`` ignores a folder with the same name as the machine"""
+        fake_get_inventory.return_value = None
+        fake_folder = MagicMock(spec=vmware.vim.Folder)
+        fake_folder.name = 'DataIQBox'
+
+        with patch.object(vmware.lookups, 'folder') as fake_lookup_folder:
+            fake_lookup_folder.return_value.childEntity = [fake_folder]
+            output = vmware._find_vm(MagicMock(), 'alice', 'DataIQBox')
+
+        self.assertTrue(output is None)
+
+    def test_is_dataiq_no_config(self):
+        """``_is_dataiq`` is False for a VM that has no config yet"""
+        fake_vm = MagicMock(spec=vmware.vim.VirtualMachine)
+        fake_vm.config = None
+
+        self.assertFalse(vmware._is_dataiq(fake_vm))
+
+    @patch.object(vmware, '_destroy')
+    @patch.object(vmware.inventory, 'get_inventory')
+    @patch.object(vmware, 'vcenter_session')
+    def test_delete_dataiq_folder(self, fake_vcenter_session, fake_get_inventory, fake_destroy):
+        """``delete_dataiq`` raises ValueError, instead of destroying, when the name is a folder"""
+        fake_get_inventory.return_value = None
+        fake_vcenter_session.return_value.__enter__.return_value.content.searchIndex.FindChild.return_value = MagicMock(spec=vmware.vim.Folder)
 
         with self.assertRaises(ValueError):
-            vmware.create_dataiq(username='alice',
-                                  machine_name='DataIQBox',
-                                  image='1.0.0',
-                                  network='someOtherLAN',
-                                  static_ip='10.7.7.2',
-                                  default_gateway='10.7.7.1',
-                                  netmask='255.255.255.0',
-                                  dns=['10.7.7.1'],
-                                  disk_size=250,
-                                  cpu_count=4,
-                                  ram=32,
-                                  logger=fake_logger)
-
-    @patch.object(vmware.os, 'listdir')
-    def test_list_images(self, fake_listdir):
+            vmware.delete_dataiq('alice', 'DataIQBox', MagicMock())
+
+        self.assertFalse(fake_destroy.called)
+
+    @patch.object(vmware.images, 'listing')
+    def test_list_images(self, fake_listing):
         """``list_images`` - Returns a list of available DataIQ versions that can be deployed"""
-        fake_listdir.return_value = ['dataiq-1.0.0.ova']
+        fake_listing.return_value = {'1.0.0' : {'version' : '1.0.0'}}
 
         output = vmware.list_images()
         expected = ['1.0.0']
@@ -173,10 +797,295 @@ class TestVMware(unittest.TestCase):
 
         self.assertEqual(output, expected)
 
-    @patch.object(vmware, '_upload_nic_config')
-    @patch.object(vmware, '_run_cmd')
-    def test_config_network(self, fake_run_cmd, fake_upload_nic_config):
-        """``_config_network`` calls ``_upload_nic_config`` to edit the network file"""
+    def test_convert_name_to_version_baked(self):
+        """``convert_name`` - keeps the suffix of baked images in the version"""
+        output = vmware.convert_name(name='dataiq-1.0.0-gui.ova', to_version=True)
+        expected = '1.0.0-gui'
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware.images, 'listing')
+    def test_list_images_baked(self, fake_listing):
+        """``list_images`` - Includes baked images"""
+        fake_listing.return_value = {'1.0.0' : {'version' : '1.0.0'}, '1.0.0-gui' : {'version' : '1.0.0-gui'}}
+
+        output = vmware.list_images()
+        expected = ['1.0.0', '1.0.0-gui']
+
+        self.assertEqual(set(output), set(expected))
+
+    @patch.object(vmware.images, 'listing')
+    def test_list_images_sorted(self, fake_listing):
+        """``list_images`` - Returns the versions oldest first"""
+        fake_listing.return_value = {'1.10.0' : {}, '1.9.0' : {}, '1.9.0-gui' : {}}
+
+        output = vmware.list_images()
+        expected = ['1.9.0', '1.9.0-gui', '1.10.0']
+
+        self.assertEqual(output, expected)
+
+    @patch.object(vmware.images, 'listing')
+    def test_list_images_filtered(self, fake_listing):
+        """``list_images`` - Supports only listing the newest version with a prefix"""
+        fake_listing.return_value = {'1.10.0' : {}, '1.9.0' : {}, '2.0.0' : {}}
+
+        output = vmware.list_images(prefix='1', latest=True)
+        expected = ['1.10.0']
+
+        self.assertEqual(output, expected)
+
+    def test_check_image(self):
+        """``check_image`` - Returns None when the OVA of an image exists"""
+        images_dir = tempfile.mkdtemp()
+        with open(os.path.join(images_dir, 'dataiq-1.0.0.ova'), 'w') as the_file:
+            the_file.write('an ova')
+        try:
+            with patch.object(vmware, 'const') as fake_const:
+                fake_const.VLAB_DATAIQ_IMAGES_DIR = images_dir
+                output = vmware.check_image('1.0.0')
+        finally:
+            shutil.rmtree(images_dir)
+
+        self.assertTrue(output is None)
+
+    @patch.object(vmware.os, 'stat')
+    def test_check_image_missing(self, fake_stat):
+        """``check_image`` - Raises ValueError if the image doesn't exist"""
+        fake_stat.side_effect = [FileNotFoundError()]
+
+        with self.assertRaises(ValueError):
+            vmware.check_image('1.0.0')
+
+    @patch.object(vmware.os, 'stat')
+    def test_check_image_empty(self, fake_stat):
+        """``check_image`` - Raises ValueError if the OVA is empty"""
+        fake_stat.return_value = os.stat_result((0o100644, 0, 0, 1, 0, 0, 0, 0, 0, 0))
+
+        with self.assertRaises(ValueError):
+            vmware.check_image('1.0.0')
+
+    @patch.object(vmware.images, 'manifest')
+    @patch.object(vmware.os, 'stat')
+    def test_check_image_stat_only(self, fake_stat, fake_manifest):
+        """``check_image`` - Doesn't read (or describe) the OVA"""
+        fake_stat.return_value = os.stat_result((0o100644, 0, 0, 1, 0, 0, 10, 0, 0, 0))
+
+        vmware.check_image('1.0.0')
+
+        self.assertFalse(fake_manifest.called)
+
+    def test_image_meta(self):
+        """``image_meta`` - Returns the meta data of a baked image"""
+        with patch.object(builtins, 'open', mock_open(read_data='{"baked": true}')):
+            output = vmware.image_meta('1.0.0-gui')
+
+        self.assertEqual(output, {'baked': True})
+
+    def test_image_meta_none(self):
+        """``image_meta`` - Returns an empty dictionary for images without meta data"""
+        output = vmware.image_meta('not-a-real-image')
+
+        self.assertEqual(output, {})
+
+    @patch.object(vmware, 'check_image')
+    @patch.object(vmware, 'image_meta')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware, 'placement')
+    @patch.object(vmware, 'admission')
+    def test_stage_deploy_baked(self, fake_admission, fake_placement, fake_deploy, fake_set_meta,
+                                fake_image_meta, fake_check_image):
+        """``_stage_deploy`` records that a VM from a baked image already has the GUI"""
+        fake_image_meta.return_value = {'baked': True}
+        fake_placement.placed.return_value.__enter__.return_value = None
+        spec = {'username': 'alice', 'machine_name': 'DataIQBox', 'image': '1.0.0', 'network': 'someLAN',
+                'static_ip': '10.7.7.2', 'default_gateway': '10.7.7.1', 'netmask': '255.255.255.0',
+                'dns': ['10.7.7.1'], 'disk_size': 250, 'cpu_count': 4, 'ram': 32}
+        spec['image'] = '1.0.0-gui'
+
+        _, meta = vmware._stage_deploy(MagicMock(), spec, MagicMock())
+
+        self.assertTrue(meta['has_gui'])
+
+    @patch.object(vmware, '_install_gui')
+    @patch.object(vmware, '_power_on')
+    def test_stage_gui_has_gui(self, fake_power_on, fake_install_gui):
+        """``_stage_gui`` skips installing the GUI on a VM that already has it"""
+        vmware._stage_gui(MagicMock(), MagicMock(), {'has_gui': True}, {}, MagicMock())
+
+        self.assertFalse(fake_install_gui.called)
+
+    @patch.object(vmware.images, 'manifest')
+    @patch.object(vmware.shutil, 'rmtree')
+    @patch.object(vmware, '_publish_image')
+    @patch.object(vmware.os, 'access')
+    @patch.object(vmware.os, 'makedirs')
+    @patch.object(vmware, '_destroy')
+    @patch.object(vmware.virtual_machine, 'make_ova')
+    @patch.object(vmware, '_shutdown')
+    @patch.object(vmware, '_add_gui')
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware.templates, 'get_folder')
+    @patch.object(vmware, 'list_images')
+    @patch.object(vmware, 'vcenter_session')
+    def test_bake_image(self, fake_vcenter_session, fake_list_images, fake_get_folder, fake_deploy,
+                        fake_set_meta, fake_power, fake_add_gui, fake_shutdown, fake_make_ova,
+                        fake_destroy, fake_makedirs, fake_access, fake_publish_image, fake_rmtree,
+                        fake_manifest):
+        """``bake_image`` exports a new image with the GUI installed, and publishes it"""
+        fake_list_images.return_value = ['1.0.0']
+        fake_access.return_value = True
+        fake_make_ova.return_value = '/tmp/vlab_dataiq/bake-1.0.0/dataiq-1.0.0-gui.ova'
+
+        output = vmware.bake_image('1.0.0', MagicMock())
+        args, _ = fake_publish_image.call_args
+
+        self.assertEqual(output, '1.0.0-gui')
+        self.assertTrue(fake_add_gui.called)
+        self.assertTrue(fake_destroy.called)
+        self.assertTrue(fake_rmtree.called)
+        self.assertEqual(args[:2], ('1.0.0-gui', '/tmp/vlab_dataiq/bake-1.0.0/dataiq-1.0.0-gui.ova'))
+        self.assertEqual(args[2]['baked'], True)
+        # The new image is described in the background job, not on a later request
+        self.assertTrue(fake_manifest.called)
+
+    @patch.object(vmware, 'const')
+    @patch.object(vmware, 'list_images')
+    def test_bake_image_staging(self, fake_list_images, fake_const):
+        """``bake_image`` exports the OVA to the cache dir, not the images dir"""
+        fake_list_images.return_value = ['1.0.0']
+        fake_const.VLAB_DATAIQ_CACHE_DIR = '/tmp/vlab_dataiq'
+        fake_const.VLAB_DATAIQ_IMAGES_DIR = '/images'
+        with patch.object(vmware.os, 'access', return_value=True), \
+             patch.object(vmware.os, 'makedirs') as fake_makedirs, \
+             patch.object(vmware.shutil, 'rmtree'), \
+             patch.object(vmware, 'vcenter_session', side_effect=RuntimeError('testing')):
+            with self.assertRaises(RuntimeError):
+                vmware.bake_image('1.0.0', MagicMock())
+
+        fake_makedirs.assert_called_with('/tmp/vlab_dataiq/bake-1.0.0', exist_ok=True)
+
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware.os, 'access')
+    @patch.object(vmware, 'list_images')
+    @patch.object(vmware, 'vcenter_session')
+    def test_bake_image_not_writable(self, fake_vcenter_session, fake_list_images, fake_access, fake_deploy):
+        """``bake_image`` raises RuntimeError, before deploying, if it can't write to the images dir"""
+        fake_list_images.return_value = ['1.0.0']
+        fake_access.return_value = False
+
+        with self.assertRaises(RuntimeError):
+            vmware.bake_image('1.0.0', MagicMock())
+
+        self.assertFalse(fake_deploy.called)
+
+    @patch.object(vmware.shutil, 'rmtree')
+    @patch.object(vmware.os, 'access')
+    @patch.object(vmware, '_destroy')
+    @patch.object(vmware.virtual_machine, 'make_ova')
+    @patch.object(vmware, '_add_gui')
+    @patch.object(vmware.virtual_machine, 'power')
+    @patch.object(vmware.virtual_machine, 'set_meta')
+    @patch.object(vmware, '_deploy')
+    @patch.object(vmware.templates, 'get_folder')
+    @patch.object(vmware.os, 'makedirs')
+    @patch.object(vmware, 'list_images')
+    @patch.object(vmware, 'vcenter_session')
+    def test_bake_image_failure(self, fake_vcenter_session, fake_list_images, fake_makedirs, fake_get_folder,
+                                fake_deploy, fake_set_meta, fake_power, fake_add_gui, fake_make_ova,
+                                fake_destroy, fake_access, fake_rmtree):
+        """``bake_image`` destroys the VM it deployed, and the staging dir, if baking fails"""
+        fake_list_images.return_value = ['1.0.0']
+        fake_access.return_value = True
+        fake_add_gui.side_effect = [RuntimeError('testing')]
+
+        with self.assertRaises(RuntimeError):
+            vmware.bake_image('1.0.0', MagicMock())
+
+        self.assertTrue(fake_destroy.called)
+        self.assertTrue(fake_rmtree.called)
+        self.assertFalse(fake_make_ova.called)
+
+    def test_publish_image(self):
+        """``_publish_image`` moves the OVA into the images dir, next to its meta data"""
+        staging_dir = tempfile.mkdtemp()
+        images_dir = tempfile.mkdtemp()
+        ova_path = os.path.join(staging_dir, 'dataiq-1.0.0-gui.ova')
+        with open(ova_path, 'w') as the_file:
+            the_file.write('an ova')
+        try:
+            with patch.object(vmware, 'const') as fake_const:
+                fake_const.VLAB_DATAIQ_IMAGES_DIR = images_dir
+                vmware._publish_image('1.0.0-gui', ova_path, {'baked' : True})
+            found = sorted(os.listdir(images_dir))
+        finally:
+            shutil.rmtree(staging_dir)
+            shutil.rmtree(images_dir)
+
+        self.assertEqual(found, ['dataiq-1.0.0-gui.json', 'dataiq-1.0.0-gui.ova'])
+
+    @patch.object(vmware, 'image_meta')
+    def test_bake_image_already_baked(self, fake_image_meta):
+        """``bake_image`` raises ValueError when the image is already baked"""
+        fake_image_meta.return_value = {'baked': True}
+
+        with self.assertRaises(ValueError):
+            vmware.bake_image('1.0.0-gui', MagicMock())
+
+    @patch.object(vmware, 'list_images')
+    def test_bake_image_exists(self, fake_list_images):
+        """``bake_image`` raises ValueError when the baked image already exists"""
+        fake_list_images.return_value = ['1.0.0', '1.0.0-gui']
+
+        with self.assertRaises(ValueError):
+            vmware.bake_image('1.0.0', MagicMock())
+
+    @patch.object(vmware, 'const')
+    @patch.object(vmware, '_customize_network')
+    @patch.object(vmware, '_resize')
+    def test_stage_size_customize_network(self, fake_resize, fake_customize_network, fake_const):
+        """``_stage_size`` configures the network before power on, instead of via guest operations"""
+        fake_const.VLAB_DATAIQ_CUSTOMIZE_NETWORK = True
+        fake_the_vm = MagicMock()
+        fake_the_vm.config.hardware.device = [vmware.vim.vm.device.VirtualDisk()]
+        spec = {'username': 'alice', 'machine_name': 'DataIQBox', 'image': '1.0.0', 'network': 'someLAN',
+                'static_ip': '10.7.7.2', 'default_gateway': '10.7.7.1', 'netmask': '255.255.255.0',
+                'dns': ['10.7.7.1'], 'disk_size': 250, 'cpu_count': 4, 'ram': 32}
+
+        vmware._stage_size(MagicMock(), fake_the_vm, {'disks': 1}, spec, MagicMock())
+
+        fake_customize_network.assert_called_with(fake_the_vm, '10.7.7.2', '10.7.7.1', '255.255.255.0', ['10.7.7.1'])
+
+    @patch.object(vmware, 'const')
+    @patch.object(vmware, '_config_network')
+    @patch.object(vmware, '_power_on')
+    def test_stage_network_customized(self, fake_power_on, fake_config_network, fake_const):
+        """``_stage_network`` doesn't use guest operations when the network was customized"""
+        fake_const.VLAB_DATAIQ_CUSTOMIZE_NETWORK = True
+
+        vmware._stage_network(MagicMock(), MagicMock(), {}, {}, MagicMock())
+
+        self.assertTrue(fake_power_on.called)
+        self.assertFalse(fake_config_network.called)
+
+    @patch.object(vmware, 'consume_task')
+    def test_customize_network(self, fake_consume_task):
+        """``_customize_network`` sets the static IP and hostname of the VM"""
+        fake_the_vm = MagicMock()
+        fake_the_vm.name = 'DataIQBox'
+
+        vmware._customize_network(fake_the_vm, '10.7.7.2', '10.7.7.1', '255.255.255.0', ['10.7.7.1'])
+        spec = fake_the_vm.CustomizeVM_Task.call_args[1]['spec']
+
+        self.assertEqual(spec.nicSettingMap[0].adapter.ip.ipAddress, '10.7.7.2')
+        self.assertEqual(spec.nicSettingMap[0].adapter.gateway, ['10.7.7.1'])
+        self.assertEqual(spec.identity.hostName.name, 'DataIQBox')
+
+    @patch.object(vmware, '_provision')
+    def test_config_network(self, fake_provision):
+        """``_config_network`` runs every step in a single provisioning script"""
         fake_vcenter = MagicMock()
         fake_the_vm = MagicMock()
         fake_static_ip = '192.168.1.6'
@@ -193,11 +1102,10 @@ class TestVMware(unittest.TestCase):
                                fake_dns,
                                fake_logger)
 
-        self.assertTrue(fake_upload_nic_config.called)
+        self.assertEqual(fake_provision.call_count, 1)
 
-    @patch.object(vmware, '_upload_nic_config')
-    @patch.object(vmware, '_run_cmd')
-    def test_config_network_overwrites(self, fake_run_cmd, fake__upload_nic_config):
+    @patch.object(vmware, '_provision')
+    def test_config_network_overwrites(self, fake_provision):
         """``_config_network`` overwrites the config file"""
         fake_vcenter = MagicMock()
         fake_the_vm = MagicMock()
@@ -215,14 +1123,13 @@ class TestVMware(unittest.TestCase):
                                fake_dns,
                                fake_logger)
 
-        command_args = fake_run_cmd.call_args_list[0][0][-2]
-        expected = '-f /home/administrator/ifcfg-eth0 /etc/sysconfig/network-scripts/ifcfg-eth0'
+        command = fake_provision.call_args[0][2][0][1]
 
-        self.assertEqual(command_args, expected)
+        self.assertTrue(command.startswith('/bin/cat > /etc/sysconfig/network-scripts/ifcfg-eth0'))
+        self.assertTrue('IPADDR=192.168.1.6' in command)
 
-    @patch.object(vmware, '_upload_nic_config')
-    @patch.object(vmware, '_run_cmd')
-    def test_config_network_restarts_network(self, fake_run_cmd, fake_upload_nic_config):
+    @patch.object(vmware, '_provision')
+    def test_config_network_restarts_network(self, fake_provision):
         """``_config_network`` restarts the network after configuring it"""
         fake_vcenter = MagicMock()
         fake_the_vm = MagicMock()
@@ -240,26 +1147,26 @@ class TestVMware(unittest.TestCase):
                                fake_dns,
                                fake_logger)
 
-        command_args = fake_run_cmd.call_args_list[-2][0][-2]
-        expected = 'restart network'
+        command = fake_provision.call_args[0][2][-2][1]
+        expected = '/bin/systemctl restart network'
 
-        self.assertEqual(command_args, expected)
+        self.assertEqual(command, expected)
 
     @patch.object(vmware, 'consume_task')
-    def test_add_database_disk(self, fake_consume_task):
-        """``_add_database_disk`` Blocks on adding an extra VMDK to the DataIQ machine"""
+    def test_resize_database_disk(self, fake_consume_task):
+        """``_resize`` Blocks on adding an extra VMDK to the DataIQ machine"""
         fake_dev = MagicMock()
         fake_the_vm = MagicMock()
         fake_the_vm.config.hardware.device = [fake_dev]
         disk_size = 1
 
-        vmware._add_database_disk(fake_the_vm, disk_size)
+        vmware._resize(fake_the_vm, 4, 32, disk_size)
 
         self.assertTrue(fake_consume_task.called)
 
     @patch.object(vmware, 'consume_task')
-    def test_add_database_disk_too_many_vmdks(self, fake_consume_task):
-        """``_add_database_disk`` Raises RuntimeError if there are 16 or more VMDKs"""
+    def test_resize_database_disk_too_many_vmdks(self, fake_consume_task):
+        """``_resize`` Raises RuntimeError if there are 16 or more VMDKs"""
         fake_dev = MagicMock()
         fake_dev.unitNumber = 15
         fake_the_vm = MagicMock()
@@ -267,48 +1174,98 @@ class TestVMware(unittest.TestCase):
         disk_size = 1
 
         with self.assertRaises(RuntimeError):
-            vmware._add_database_disk(fake_the_vm, disk_size)
+            vmware._resize(fake_the_vm, 4, 32, disk_size)
 
     @patch.object(vmware, 'consume_task')
-    def test_add_database_disk_no_vmdks(self, fake_consume_task):
-        """``_add_database_disk`` Raises RuntimeError if there zero VMDKs"""
+    def test_resize_database_disk_no_vmdks(self, fake_consume_task):
+        """``_resize`` Raises RuntimeError if there zero VMDKs"""
         fake_the_vm = MagicMock()
         fake_the_vm.config.hardware.device = []
         disk_size = 1
 
         with self.assertRaises(RuntimeError):
-            vmware._add_database_disk(fake_the_vm, disk_size)
+            vmware._resize(fake_the_vm, 4, 32, disk_size)
 
     @patch.object(vmware, 'consume_task')
-    def test_add_database_disk_scsi_unit(self, fake_consume_task):
-        """``_add_database_disk`` Doesn't use unitNumber 7"""
+    def test_resize_database_disk_scsi_unit(self, fake_consume_task):
+        """``_resize`` Doesn't use unitNumber 7"""
         fake_dev = MagicMock()
         fake_dev.unitNumber = 6
         fake_the_vm = MagicMock()
         fake_the_vm.config.hardware.device = [fake_dev]
         disk_size = 1
 
-        vmware._add_database_disk(fake_the_vm, disk_size)
+        vmware._resize(fake_the_vm, 4, 32, disk_size)
         unit = fake_the_vm.ReconfigVM_Task.call_args[1]['spec'].deviceChange[0].device.unitNumber
         expected = 8
 
         self.assertEqual(unit, expected)
 
     @patch.object(vmware, 'consume_task')
-    def test_add_database_disk_thin(self, fake_consume_task):
-        """``_add_database_disk`` Creates a thin-provisioned VMDK"""
+    def test_resize_database_disk_thin(self, fake_consume_task):
+        """``_resize`` Creates a thin-provisioned VMDK"""
         fake_dev = MagicMock()
         fake_dev.unitNumber = 6
         fake_the_vm = MagicMock()
         fake_the_vm.config.hardware.device = [fake_dev]
         disk_size = 1
 
-        vmware._add_database_disk(fake_the_vm, disk_size)
+        vmware._resize(fake_the_vm, 4, 32, disk_size)
 
         thin_provision = fake_the_vm.ReconfigVM_Task.call_args[1]['spec'].deviceChange[0].device.backing.thinProvisioned
 
         self.assertTrue(thin_provision)
 
+    @patch.object(vmware, 'consume_task')
+    def test_resize_one_reconfigure(self, fake_consume_task):
+        """``_resize`` Sets the CPU, RAM and DB VMDK in a single reconfigure"""
+        fake_dev = MagicMock()
+        fake_dev.unitNumber = 0
+        fake_the_vm = MagicMock()
+        fake_the_vm.config.hardware.device = [fake_dev]
+
+        vmware._resize(fake_the_vm, 4, 32, 250)
+        spec = fake_the_vm.ReconfigVM_Task.call_args[1]['spec']
+
+        self.assertEqual(fake_the_vm.ReconfigVM_Task.call_count, 1)
+        self.assertEqual(spec.memoryMB, 32768)
+        self.assertEqual(spec.numCPUs, 4)
+        self.assertEqual(len(spec.deviceChange), 1)
+
+    @patch.object(vmware, 'consume_task')
+    def test_resize_without_disk(self, fake_consume_task):
+        """``_resize`` only sets the CPU and RAM when told not to add the DB VMDK"""
+        fake_the_vm = MagicMock()
+
+        vmware._resize(fake_the_vm, 4, 32, 250, add_disk=False)
+        spec = fake_the_vm.ReconfigVM_Task.call_args[1]['spec']
+
+        self.assertEqual(spec.numCPUs, 4)
+        self.assertEqual(len(spec.deviceChange), 0)
+
+    @patch.object(vmware, '_resize')
+    def test_stage_size(self, fake_resize):
+        """``_stage_size`` adds the DB VMDK to a VM that only has the disks of its image"""
+        fake_the_vm = MagicMock()
+        fake_the_vm.config.hardware.device = [vmware.vim.vm.device.VirtualDisk()]
+        spec = {'cpu_count': 4, 'ram': 32, 'disk_size': 250}
+
+        vmware._stage_size(MagicMock(), fake_the_vm, {'disks': 1}, spec, MagicMock())
+
+        self.assertTrue(fake_resize.call_args[1]['add_disk'])
+
+    @patch.object(vmware, '_resize')
+    def test_stage_size_resumed(self, fake_resize):
+        """``_stage_size`` doesn't add a second DB VMDK when a create is resumed"""
+        fake_the_vm = MagicMock()
+        fake_the_vm.config.hardware.device = [vmware.vim.vm.device.VirtualDisk(),
+                                              vmware.vim.vm.device.VirtualDisk()]
+        spec = {'cpu_count': 4, 'ram': 32, 'disk_size': 250}
+
+        vmware._stage_size(MagicMock(), fake_the_vm, {'disks': 1}, spec, MagicMock())
+
+        self.assertFalse(fake_resize.call_args[1]['add_disk'])
+
     @patch.object(vmware.virtual_machine, 'run_command')
     def test_run_cmd_logs(self, fake_run_command):
         """``_run_cmd`` logs the command if it fails"""
@@ -324,37 +1281,150 @@ class TestVMware(unittest.TestCase):
         self.assertTrue(fake_logger.error.called)
 
     @patch.object(vmware.requests, 'put')
-    @patch.object(builtins, "open")
-    def test_upload_nic_config_http_put(self, fake_open, fake_put):
-        """``_upload_nic_config`` Uploads the file via the PUT method"""
+    @patch.object(vmware, '_get_upload_url')
+    def test_upload_file_http_put(self, fake_get_upload_url, fake_put):
+        """``_upload_file`` Uploads the file via the PUT method"""
         fake_vcenter = MagicMock()
         fake_the_vm = MagicMock()
         fake_logger = MagicMock()
-        nic_config = 'TYPE=Ethernet'
-        config_name = 'eth0'
 
-        vmware._upload_nic_config(fake_vcenter, fake_the_vm, nic_config, config_name, fake_logger)
+        vmware._upload_file(fake_vcenter, fake_the_vm, 'TYPE=Ethernet', '/home/administrator/eth0', fake_logger)
 
         self.assertTrue(fake_put.called)
 
     @patch.object(vmware.requests, 'put')
-    @patch.object(builtins, "open")
-    def test_upload_nic_config_checks_http_status(self, fake_open, fake_put):
-        """``_upload_nic_config`` Checks the HTTP response status of the upload"""
+    @patch.object(vmware, '_get_upload_url')
+    def test_upload_file_checks_http_status(self, fake_get_upload_url, fake_put):
+        """``_upload_file`` Checks the HTTP response status of the upload"""
         fake_vcenter = MagicMock()
         fake_the_vm = MagicMock()
         fake_resp = MagicMock()
         fake_logger = MagicMock()
-        nic_config = 'TYPE=Ethernet'
-        config_name = 'eth0'
         fake_put.return_value = fake_resp
 
-        vmware._upload_nic_config(fake_vcenter, fake_the_vm, nic_config, config_name, fake_logger)
+        vmware._upload_file(fake_vcenter, fake_the_vm, 'TYPE=Ethernet', '/home/administrator/eth0', fake_logger)
 
         self.assertTrue(fake_resp.raise_for_status.called)
 
+    @patch.object(vmware.requests, 'get')
+    def test_download_file(self, fake_get):
+        """``_download_file`` Returns the contents of the file"""
+        fake_get.return_value.text = 'some content'
+
+        output = vmware._download_file(MagicMock(), MagicMock(), '/home/administrator/foo')
+
+        self.assertEqual(output, 'some content')
+
+    def test_download_file_missing(self):
+        """``_download_file`` Returns None if the file doesn't exist"""
+        fake_vcenter = MagicMock()
+        fake_vcenter.content.guestOperationsManager.fileManager.InitiateFileTransferFromGuest.side_effect = [vmware.vim.fault.FileNotFound()]
+
+        output = vmware._download_file(fake_vcenter, MagicMock(), '/home/administrator/foo')
+
+        self.assertTrue(output is None)
+
+    @patch.object(vmware, '_wait_for_process')
+    @patch.object(vmware, '_download_file')
+    @patch.object(vmware, '_run_cmd')
+    @patch.object(vmware, '_upload_file')
+    def test_provision(self, fake_upload_file, fake_run_cmd, fake_download_file, fake_wait_for_process):
+        """``_provision`` uploads and runs one script, and returns the result of every step"""
+        fake_wait_for_process.return_value = 0
+        fake_download_file.return_value = '{"step": "a", "exit_code": 0, "start": 1.0, "end": 3.0}\n' \
+                                          '{"step": "b", "exit_code": 0, "start": 3.0, "end": 4.0}\n__done__\n'
+
+        output = vmware._provision(MagicMock(), MagicMock(), [('a', 'true'), ('b', 'true')], MagicMock())
+        expected = [{'step': 'a', 'exit_code': 0, 'duration': 2.0}, {'step': 'b', 'exit_code': 0, 'duration': 1.0}]
+
+        self.assertEqual(output, expected)
+        self.assertEqual(fake_upload_file.call_count, 1)
+        self.assertEqual(fake_run_cmd.call_count, 1)
+
+    @patch.object(vmware, '_wait_for_process')
+    @patch.object(vmware, '_download_file')
+    @patch.object(vmware, '_run_cmd')
+    @patch.object(vmware, '_upload_file')
+    def test_provision_reads_results_once(self, fake_upload_file, fake_run_cmd, fake_download_file, fake_wait_for_process):
+        """``_provision`` only reads the results file after the script exits"""
+        fake_wait_for_process.return_value = 0
+        fake_download_file.return_value = '__done__\n'
+
+        vmware._provision(MagicMock(), MagicMock(), [('a', 'true')], MagicMock())
+
+        self.assertEqual(fake_download_file.call_count, 1)
+
+    @patch.object(vmware, '_wait_for_process')
+    @patch.object(vmware, '_download_file')
+    @patch.object(vmware, '_run_cmd')
+    @patch.object(vmware, '_upload_file')
+    def test_provision_step_failed(self, fake_upload_file, fake_run_cmd, fake_download_file, fake_wait_for_process):
+        """``_provision`` raises RuntimeError naming the step that failed"""
+        fake_wait_for_process.return_value = 1
+        fake_download_file.return_value = '{"step": "a", "exit_code": 0, "start": 1.0, "end": 3.0}\n' \
+                                          '{"step": "b", "exit_code": 2, "start": 3.0, "end": 4.0}\n__done__\n'
+
+        with self.assertRaisesRegex(RuntimeError, 'step "b"'):
+            vmware._provision(MagicMock(), MagicMock(), [('a', 'true'), ('b', 'false')], MagicMock())
+
+    @patch.object(vmware, '_wait_for_process')
+    @patch.object(vmware, '_download_file')
+    @patch.object(vmware, '_run_cmd')
+    @patch.object(vmware, '_upload_file')
+    def test_provision_unfinished(self, fake_upload_file, fake_run_cmd, fake_download_file, fake_wait_for_process):
+        """``_provision`` raises RuntimeError if the script exits without finishing every step"""
+        fake_wait_for_process.return_value = 137
+        fake_download_file.return_value = None
+
+        with self.assertRaisesRegex(RuntimeError, 'exited 137'):
+            vmware._provision(MagicMock(), MagicMock(), [('a', 'true')], MagicMock())
+
+    @patch.object(vmware.time, 'sleep')
+    @patch.object(vmware.virtual_machine, 'get_process_info')
+    def test_wait_for_process(self, fake_get_process_info, fake_sleep):
+        """``_wait_for_process`` returns the exit code, backing off between checks"""
+        fake_get_process_info.side_effect = [MagicMock(endTime=None),
+                                             MagicMock(endTime=None),
+                                             MagicMock(endTime=1, exitCode=0)]
+
+        output = vmware._wait_for_process(MagicMock(), MagicMock(), 1234, 60)
+        slept = [x[0][0] for x in fake_sleep.call_args_list]
+
+        self.assertEqual(output, 0)
+        self.assertEqual(slept, [1, 2, 4])
+
+    @patch.object(vmware.time, 'sleep')
+    @patch.object(vmware.virtual_machine, 'get_process_info')
+    def test_wait_for_process_max_interval(self, fake_get_process_info, fake_sleep):
+        """``_wait_for_process`` never waits longer than PROVISION_POLL_MAX between checks"""
+        fake_get_process_info.return_value = MagicMock(endTime=None)
+
+        with self.assertRaises(RuntimeError):
+            vmware._wait_for_process(MagicMock(), MagicMock(), 1234, 300)
+        slept = [x[0][0] for x in fake_sleep.call_args_list]
+
+        self.assertEqual(max(slept), vmware.PROVISION_POLL_MAX)
+
     @patch.object(vmware.time, 'sleep')
-    def test_get_upload_url(self, fake_sleep):
+    @patch.object(vmware.virtual_machine, 'get_process_info')
+    def test_wait_for_process_timeout(self, fake_get_process_info, fake_sleep):
+        """``_wait_for_process`` raises RuntimeError if the process doesn't exit in time"""
+        fake_get_process_info.return_value = MagicMock(endTime=None)
+
+        with self.assertRaises(RuntimeError):
+            vmware._wait_for_process(MagicMock(), MagicMock(), 1234, 10)
+
+    def test_render_script(self):
+        """``_render_script`` quotes every command, and stops at the first failing step"""
+        output = vmware._render_script([('say it', "echo 'hi'")], '/tmp/results', '/tmp/log')
+        expected = """step 'say it' 'echo '"'"'hi'"'"'' || { /bin/echo __done__ >> "$RESULTS"; exit 1; }"""
+
+        self.assertTrue(expected in output.splitlines())
+        self.assertEqual(output.splitlines()[-1], '/bin/echo __done__ >> "$RESULTS"')
+
+    @patch.object(vmware.readiness, 'wait_for_guest')
+    @patch.object(vmware.time, 'sleep')
+    def test_get_upload_url(self, fake_sleep, fake_wait_for_guest):
         """``_get_upload_url`` retries while the VM is booting up"""
         fake_vm = MagicMock()
         fake_creds = MagicMock()
@@ -365,35 +1435,41 @@ class TestVMware(unittest.TestCase):
         fake_vcenter.content.guestOperationsManager.fileManager.InitiateFileTransferToGuest.side_effect = [vmware.vim.fault.GuestOperationsUnavailable(),
                                                                                                            vmware.vim.fault.GuestOperationsUnavailable(),
                                                                                                            'https://some-url.org']
-        vmware._get_upload_url(fake_vcenter,
-                               fake_vm,
-                               fake_creds,
-                               fake_upload_path,
-                               fake_file_size,
-                               fake_file_attributes)
+        output = vmware._get_upload_url(fake_vcenter,
+                                        fake_vm,
+                                        fake_creds,
+                                        fake_upload_path,
+                                        fake_file_size,
+                                        fake_file_attributes)
 
         # one for every vmware.vim.fault.GuestOperationsUnavailable() side_effect
         self.assertEqual(fake_sleep.call_count, 2)
+        self.assertEqual(output, 'https://some-url.org')
+
+    @patch.object(vmware.readiness, 'wait_for_guest')
+    @patch.object(vmware.time, 'sleep')
+    def test_get_upload_url_waits_for_guest(self, fake_sleep, fake_wait_for_guest):
+        """``_get_upload_url`` waits for the guest to be ready before uploading"""
+        fake_vcenter = MagicMock()
+
+        vmware._get_upload_url(fake_vcenter, MagicMock(), MagicMock(), '/home/foo.sh', 9001, MagicMock())
 
+        self.assertTrue(fake_wait_for_guest.called)
+        self.assertFalse(fake_sleep.called)
+
+    @patch.object(vmware.time, 'time')
+    @patch.object(vmware.readiness, 'wait_for_guest')
     @patch.object(vmware.time, 'sleep')
-    def test_get_upload_url(self, fake_sleep):
+    def test_get_upload_url_timeout(self, fake_sleep, fake_wait_for_guest, fake_time):
         """``_get_upload_url`` Raises ValueError if the VM is never ready for the file upload"""
+        fake_time.side_effect = [0, 0, 9000]
         fake_vm = MagicMock()
         fake_creds = MagicMock()
         fake_upload_path = '/home/foo.sh'
         fake_file_size = 9001
         fake_file_attributes = MagicMock()
         fake_vcenter = MagicMock()
-        fake_vcenter.content.guestOperationsManager.fileManager.InitiateFileTransferToGuest.side_effect = [vmware.vim.fault.GuestOperationsUnavailable(),
-                                                                                                           vmware.vim.fault.GuestOperationsUnavailable(),
-                                                                                                           vmware.vim.fault.GuestOperationsUnavailable(),
-                                                                                                           vmware.vim.fault.GuestOperationsUnavailable(),
-                                                                                                           vmware.vim.fault.GuestOperationsUnavailable(),
-                                                                                                           vmware.vim.fault.GuestOperationsUnavailable(),
-                                                                                                           vmware.vim.fault.GuestOperationsUnavailable(),
-                                                                                                           vmware.vim.fault.GuestOperationsUnavailable(),
-                                                                                                           vmware.vim.fault.GuestOperationsUnavailable(),
-                                                                                                           vmware.vim.fault.GuestOperationsUnavailable(),]
+        fake_vcenter.content.guestOperationsManager.fileManager.InitiateFileTransferToGuest.side_effect = [vmware.vim.fault.GuestOperationsUnavailable()]
 
         with self.assertRaises(ValueError):
             vmware._get_upload_url(fake_vcenter,
@@ -404,8 +1480,9 @@ class TestVMware(unittest.TestCase):
                                    fake_file_attributes)
 
     @patch.object(vmware, '_run_cmd')
-    @patch.object(vmware.time, 'sleep')
-    def test_add_gui(self, fake_sleep, fake_run_cmd):
+    @patch.object(vmware, '_provision')
+    @patch.object(vmware.readiness, 'wait_for_guest')
+    def test_add_gui(self, fake_wait_for_guest, fake_provision, fake_run_cmd):
         """``_add_gui`` - installs GNOME Desktop"""
         fake_vcenter = MagicMock()
         fake_the_vm = MagicMock()
@@ -413,50 +1490,94 @@ class TestVMware(unittest.TestCase):
 
         vmware._add_gui(fake_vcenter, fake_the_vm, fake_logger)
 
-        installed = fake_run_cmd.call_args_list[0][0][3]
+        installed = fake_provision.call_args_list[0][0][2][0][1]
         expected = 'yum -y groupinstall "GNOME Desktop" "Graphical Administration Tools"'
 
         self.assertEqual(installed, expected)
 
     @patch.object(vmware, '_run_cmd')
-    @patch.object(vmware.time, 'sleep')
-    def test_add_gui_sleeps_while_rebooting(self, fake_sleep, fake_run_cmd):
-        """``_add_gui`` - Sleeps when rebooting VM"""
+    @patch.object(vmware, '_provision')
+    @patch.object(vmware.readiness, 'wait_for_guest')
+    def test_add_gui_waits_while_rebooting(self, fake_wait_for_guest, fake_provision, fake_run_cmd):
+        """``_add_gui`` - Waits for the VM to come back up after rebooting it"""
         fake_vcenter = MagicMock()
         fake_the_vm = MagicMock()
         fake_logger = MagicMock()
 
         vmware._add_gui(fake_vcenter, fake_the_vm, fake_logger)
 
-        self.assertTrue(fake_sleep.called)
+        self.assertTrue(callable(fake_wait_for_guest.call_args[1]['rebooted']))
 
+    @patch.object(vmware, '_download_file')
     @patch.object(vmware, '_run_cmd')
-    @patch.object(vmware.time, 'sleep')
-    def test_add_gui_rdp(self, fake_sleep, fake_run_cmd):
+    @patch.object(vmware, '_provision')
+    @patch.object(vmware.readiness, 'wait_for_guest')
+    def test_add_gui_boot_marker(self, fake_wait_for_guest, fake_provision, fake_run_cmd, fake_download_file):
+        """``_add_gui`` - The guest has rebooted once the marker written before the reboot is gone"""
+        fake_download_file.return_value = None
+
+        vmware._add_gui(MagicMock(), MagicMock(), MagicMock())
+        steps = dict(fake_provision.call_args_list[0][0][2])
+        rebooted = fake_wait_for_guest.call_args[1]['rebooted']()
+        marker = fake_download_file.call_args[0][2]
+
+        self.assertEqual(steps['mark boot'], '/bin/touch {}'.format(marker))
+        self.assertTrue(marker.startswith('/run/'))
+        self.assertTrue(rebooted)
+
+    @patch.object(vmware, '_download_file')
+    def test_rebooted_marker_exists(self, fake_download_file):
+        """``_rebooted`` returns False while the marker file is still in the guest"""
+        fake_download_file.return_value = ''
+
+        self.assertFalse(vmware._rebooted(MagicMock(), MagicMock(), '/run/dataiq-boot-1'))
+
+    @patch.object(vmware, '_download_file')
+    def test_rebooted_guest_down(self, fake_download_file):
+        """``_rebooted`` returns False while guest operations are unavailable"""
+        fake_download_file.side_effect = [vmware.vim.fault.GuestOperationsUnavailable()]
+
+        self.assertFalse(vmware._rebooted(MagicMock(), MagicMock(), '/run/dataiq-boot-1'))
+
+    @patch.object(vmware, '_run_cmd')
+    @patch.object(vmware, '_provision')
+    @patch.object(vmware.readiness, 'wait_for_guest')
+    def test_add_gui_rdp(self, fake_wait_for_guest, fake_provision, fake_run_cmd):
         """``_add_gui`` - installs an RDP server"""
         fake_vcenter = MagicMock()
         fake_the_vm = MagicMock()
         fake_logger = MagicMock()
 
         vmware._add_gui(fake_vcenter, fake_the_vm, fake_logger)
-        installed = fake_run_cmd.call_args_list[7][0][3]
+        installed = fake_provision.call_args_list[1][0][2][0][1]
         expected = 'yum -y install xrdp tigervnc-server'
 
         self.assertEqual(installed, expected)
 
     @patch.object(vmware, '_run_cmd')
-    @patch.object(vmware.time, 'sleep')
-    def test_add_gui_libvirtd(self, fake_sleep, fake_run_cmd):
+    @patch.object(vmware, '_provision')
+    @patch.object(vmware.readiness, 'wait_for_guest')
+    def test_add_gui_libvirtd(self, fake_wait_for_guest, fake_provision, fake_run_cmd):
         """``_add_gui`` - disables libvirtd"""
         fake_vcenter = MagicMock()
         fake_the_vm = MagicMock()
         fake_logger = MagicMock()
 
         vmware._add_gui(fake_vcenter, fake_the_vm, fake_logger)
-        installed = fake_run_cmd.call_args_list[5][0][3]
+        installed = dict(fake_provision.call_args_list[0][0][2])['disable libvirtd']
         expected = 'systemctl disable libvirtd'
 
         self.assertEqual(installed, expected)
 
+    @patch.object(vmware, '_run_cmd')
+    @patch.object(vmware, '_provision')
+    @patch.object(vmware.readiness, 'wait_for_guest')
+    def test_add_gui_round_trips(self, fake_wait_for_guest, fake_provision, fake_run_cmd):
+        """``_add_gui`` - runs two provisioning scripts, and one reboot"""
+        vmware._add_gui(MagicMock(), MagicMock(), MagicMock())
+
+        self.assertEqual(fake_provision.call_count, 2)
+        self.assertEqual(fake_run_cmd.call_count, 1)
+
 if __name__ == '__main__':
     unittest.main()
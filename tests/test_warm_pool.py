@@ -0,0 +1,171 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in warm_pool.py
+"""
+import time
+import unittest
+from unittest.mock import patch, MagicMock
+
+import ujson
+
+from vlab_dataiq_api.lib.worker import warm_pool
+
+
+def _make_pool_vm(name, image='1.0.0', ready=True, power_state='poweredOff', created=None):
+    """Build a fake VM in the warm pool"""
+    fake_vm = MagicMock(spec=warm_pool.vim.VirtualMachine)
+    fake_vm.name = name
+    meta = warm_pool.pool_meta(image, ready=ready)
+    if created is not None:
+        meta['created'] = created
+    fake_vm.config.annotation = ujson.dumps(meta)
+    fake_vm.runtime.powerState = power_state
+    return fake_vm
+
+
+class TestWarmPool(unittest.TestCase):
+    """A set of test cases for warm_pool.py"""
+
+    @patch.object(warm_pool, 'const')
+    def test_enabled(self, fake_const):
+        """``enabled`` returns True for images that have a warm pool"""
+        fake_const.VLAB_DATAIQ_WARM_POOL_SIZE = 2
+        fake_const.VLAB_DATAIQ_WARM_POOL_IMAGES = ['1.0.0']
+
+        self.assertTrue(warm_pool.enabled('1.0.0'))
+        self.assertFalse(warm_pool.enabled('2.0.0'))
+
+    @patch.object(warm_pool, 'const')
+    def test_enabled_no_size(self, fake_const):
+        """``enabled`` returns False when the pool size is zero"""
+        fake_const.VLAB_DATAIQ_WARM_POOL_SIZE = 0
+        fake_const.VLAB_DATAIQ_WARM_POOL_IMAGES = ['1.0.0']
+
+        self.assertFalse(warm_pool.enabled('1.0.0'))
+
+    def test_new_name(self):
+        """``new_name`` generates unique names"""
+        self.assertNotEqual(warm_pool.new_name('1.0.0'), warm_pool.new_name('1.0.0'))
+
+    @patch.object(warm_pool, 'consume_task')
+    @patch.object(warm_pool, 'get_folder')
+    @patch.object(warm_pool, 'file_lock')
+    def test_claim(self, fake_file_lock, fake_get_folder, fake_consume_task):
+        """``claim`` renames and moves a ready VM into the user's folder"""
+        ready_vm = _make_pool_vm('dataiq-pool-1.0.0-aaaa')
+        fake_get_folder.return_value.childEntity = [ready_vm]
+        fake_vcenter = MagicMock()
+
+        output = warm_pool.claim(fake_vcenter, '1.0.0', 'alice', 'myDataIQ', MagicMock())
+        user_folder = fake_vcenter.get_by_name.return_value
+
+        self.assertTrue(output is ready_vm)
+        ready_vm.Rename_Task.assert_called_with(newName='myDataIQ')
+        user_folder.MoveIntoFolder_Task.assert_called_with([ready_vm])
+
+    @patch.object(warm_pool, 'consume_task')
+    @patch.object(warm_pool, 'get_folder')
+    @patch.object(warm_pool, 'file_lock')
+    def test_claim_move_fails(self, fake_file_lock, fake_get_folder, fake_consume_task):
+        """``claim`` doesn't rename a VM it couldn't move out of the pool"""
+        ready_vm = _make_pool_vm('dataiq-pool-1.0.0-aaaa')
+        fake_get_folder.return_value.childEntity = [ready_vm]
+        fake_consume_task.side_effect = [RuntimeError('testing')]
+
+        with self.assertRaises(RuntimeError):
+            warm_pool.claim(MagicMock(), '1.0.0', 'alice', 'myDataIQ', MagicMock())
+
+        self.assertFalse(ready_vm.Rename_Task.called)
+
+    @patch.object(warm_pool, 'consume_task')
+    @patch.object(warm_pool, 'get_folder')
+    @patch.object(warm_pool, 'file_lock')
+    def test_claim_rename_fails(self, fake_file_lock, fake_get_folder, fake_consume_task):
+        """``claim`` moves the VM back into the pool if it can't be renamed"""
+        ready_vm = _make_pool_vm('dataiq-pool-1.0.0-aaaa')
+        pool_folder = fake_get_folder.return_value
+        pool_folder.childEntity = [ready_vm]
+        fake_consume_task.side_effect = [None, RuntimeError('testing'), None]
+
+        with self.assertRaises(RuntimeError):
+            warm_pool.claim(MagicMock(), '1.0.0', 'alice', 'myDataIQ', MagicMock())
+
+        pool_folder.MoveIntoFolder_Task.assert_called_with([ready_vm])
+
+    @patch.object(warm_pool, 'consume_task')
+    @patch.object(warm_pool, 'get_folder')
+    @patch.object(warm_pool, 'file_lock')
+    def test_claim_empty(self, fake_file_lock, fake_get_folder, fake_consume_task):
+        """``claim`` returns None when there are no ready VMs for the image"""
+        fake_get_folder.return_value.childEntity = [_make_pool_vm('dataiq-pool-1.0.0-aaaa', ready=False),
+                                                    _make_pool_vm('dataiq-pool-2.0.0-bbbb', image='2.0.0')]
+
+        output = warm_pool.claim(MagicMock(), '1.0.0', 'alice', 'myDataIQ', MagicMock())
+
+        self.assertTrue(output is None)
+
+    @patch.object(warm_pool, 'consume_task')
+    @patch.object(warm_pool, 'get_folder')
+    @patch.object(warm_pool, 'file_lock')
+    def test_claim_bad_name(self, fake_file_lock, fake_get_folder, fake_consume_task):
+        """``claim`` raises ValueError, without touching the pool, if the name isn't a valid hostname"""
+        fake_get_folder.return_value.childEntity = [_make_pool_vm('dataiq-pool-1.0.0-aaaa')]
+
+        with self.assertRaises(ValueError):
+            warm_pool.claim(MagicMock(), '1.0.0', 'alice', 'my DataIQ; reboot', MagicMock())
+
+        self.assertFalse(fake_consume_task.called)
+
+    @patch.object(warm_pool, 'file_lock')
+    def test_refill_lock(self, fake_file_lock):
+        """``refill_lock`` doesn't wait on another process that's refilling the pool"""
+        fake_file_lock.return_value.__enter__.return_value = False
+
+        with warm_pool.refill_lock('1.0.0') as acquired:
+            pass
+
+        self.assertFalse(acquired)
+        self.assertEqual(fake_file_lock.call_args[1], {'blocking': False})
+
+    @patch.object(warm_pool, 'const')
+    @patch.object(warm_pool, 'consume_task')
+    @patch.object(warm_pool, 'get_folder')
+    def test_shortfall(self, fake_get_folder, fake_consume_task, fake_const):
+        """``shortfall`` counts VMs being provisioned as part of the pool"""
+        fake_const.VLAB_DATAIQ_WARM_POOL_SIZE = 3
+        fake_get_folder.return_value.childEntity = [_make_pool_vm('dataiq-pool-1.0.0-aaaa'),
+                                                    _make_pool_vm('dataiq-pool-1.0.0-bbbb', ready=False)]
+
+        output = warm_pool.shortfall(MagicMock(), '1.0.0', MagicMock())
+
+        self.assertEqual(output, 1)
+
+    @patch.object(warm_pool, 'const')
+    @patch.object(warm_pool, 'consume_task')
+    @patch.object(warm_pool, 'get_folder')
+    def test_shortfall_abandoned(self, fake_get_folder, fake_consume_task, fake_const):
+        """``shortfall`` destroys VMs whose provisioning was abandoned"""
+        fake_const.VLAB_DATAIQ_WARM_POOL_SIZE = 1
+        abandoned = _make_pool_vm('dataiq-pool-1.0.0-aaaa', ready=False, power_state='poweredOn',
+                                  created=time.time() - warm_pool.PROVISION_TIMEOUT - 1)
+        fake_get_folder.return_value.childEntity = [abandoned]
+
+        output = warm_pool.shortfall(MagicMock(), '1.0.0', MagicMock())
+
+        self.assertEqual(output, 1)
+        self.assertTrue(abandoned.Destroy_Task.called)
+
+    def test_pool_vms_ignores_other_vms(self):
+        """``_pool_vms`` ignores VMs that aren't part of the pool"""
+        fake_folder = MagicMock()
+        other_vm = MagicMock(spec=warm_pool.vim.VirtualMachine)
+        other_vm.config.annotation = '{"component": "DataIQ", "version": "1.0.0"}'
+        fake_folder.childEntity = [other_vm, MagicMock()]
+
+        output = warm_pool._pool_vms(fake_folder, '1.0.0')
+
+        self.assertEqual(output, ([], []))
+
+
+if __name__ == '__main__':
+    unittest.main()
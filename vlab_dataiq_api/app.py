@@ -2,15 +2,19 @@
 from flask import Flask
 from celery import Celery
 
-from vlab_dataiq_api.lib import const
-from vlab_dataiq_api.lib.views import HealthView, DataIQView
+from vlab_dataiq_api.lib import const, metrics, queues
+from vlab_dataiq_api.lib.views import HealthView, DataIQView, MetricsView
 
+metrics.setup()
 app = Flask(__name__)
 app.celery_app = Celery('dataiq', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
 app.celery_app.conf.broker_heartbeat = 0 #https://github.com/celery/celery/issues/4895
+queues.configure(app.celery_app)
 
 HealthView.register(app)
 DataIQView.register(app)
+MetricsView.register(app)
+metrics.time_requests(app)
 
 
 if __name__ == '__main__':
@@ -26,6 +26,37 @@ DEFINED = OrderedDict([
             ('VLAB_VERIFY_TOKEN', environ.get('VLAB_VERIFY_TOKEN', False)),
             ('VLAB_DATAIQ_ADMIN', environ.get('VLAB_DATAIQ_ADMIN', 'administrator')),
             ('VLAB_DATAIQ_ADMIN_PW', environ.get('VLAB_DATAIQ_ADMIN_PW', 'ChangeMe')),
+            ('VLAB_DATAIQ_MAX_SESSIONS', int(environ.get('VLAB_DATAIQ_MAX_SESSIONS', 2))),
+            ('VLAB_DATAIQ_SESSION_KEEPALIVE', int(environ.get('VLAB_DATAIQ_SESSION_KEEPALIVE', 300))),
+            ('VLAB_DATAIQ_CACHE_DIR', environ.get('VLAB_DATAIQ_CACHE_DIR', '/tmp/vlab_dataiq')),
+            ('VLAB_DATAIQ_SHOW_CACHE_TTL', int(environ.get('VLAB_DATAIQ_SHOW_CACHE_TTL', 30))),
+            ('VLAB_DATAIQ_LIVE_INVENTORY', environ.get('VLAB_DATAIQ_LIVE_INVENTORY', False)),
+            ('VLAB_DATAIQ_INVENTORY_WAIT', int(environ.get('VLAB_DATAIQ_INVENTORY_WAIT', 30))),
+            ('VLAB_DATAIQ_LINKED_CLONE', environ.get('VLAB_DATAIQ_LINKED_CLONE', False)),
+            ('VLAB_DATAIQ_TEMPLATE_FOLDER', environ.get('VLAB_DATAIQ_TEMPLATE_FOLDER', 'dataiq-templates')),
+            ('VLAB_DATAIQ_WARM_POOL_SIZE', int(environ.get('VLAB_DATAIQ_WARM_POOL_SIZE', 0))),
+            ('VLAB_DATAIQ_WARM_POOL_IMAGES', [x for x in environ.get('VLAB_DATAIQ_WARM_POOL_IMAGES', '').split(',') if x]),
+            ('VLAB_DATAIQ_WARM_POOL_FOLDER', environ.get('VLAB_DATAIQ_WARM_POOL_FOLDER', 'dataiq-warm-pool')),
+            ('VLAB_DATAIQ_CUSTOMIZE_NETWORK', environ.get('VLAB_DATAIQ_CUSTOMIZE_NETWORK', False)),
+            ('VLAB_DATAIQ_PROVISION_NETWORK', environ.get('VLAB_DATAIQ_PROVISION_NETWORK', 'dataiq-provision')),
+            ('VLAB_DATAIQ_BULK_PARALLEL', int(environ.get('VLAB_DATAIQ_BULK_PARALLEL', 4))),
+            ('VLAB_DATAIQ_UPLOAD_PARALLEL', int(environ.get('VLAB_DATAIQ_UPLOAD_PARALLEL', 4))),
+            ('VLAB_DATAIQ_METRICS_DIR', environ.get('VLAB_DATAIQ_METRICS_DIR', '/tmp/vlab_dataiq/metrics')),
+            ('VLAB_DATAIQ_METRICS_PORT', int(environ.get('VLAB_DATAIQ_METRICS_PORT', 9540))),
+            ('VLAB_DATAIQ_DATASTORES', [x for x in environ.get('VLAB_DATAIQ_DATASTORES', '').split(',') if x]),
+            ('VLAB_DATAIQ_MAX_PROVISIONED', float(environ.get('VLAB_DATAIQ_MAX_PROVISIONED', 4.0))),
+            ('VLAB_DATAIQ_PLACEMENT_TTL', int(environ.get('VLAB_DATAIQ_PLACEMENT_TTL', 60))),
+            ('VLAB_DATAIQ_MAX_DEPLOYS', int(environ.get('VLAB_DATAIQ_MAX_DEPLOYS', 8))),
+            ('VLAB_DATAIQ_MAX_DEPLOYS_PER_DATASTORE', int(environ.get('VLAB_DATAIQ_MAX_DEPLOYS_PER_DATASTORE', 4))),
+            ('VLAB_DATAIQ_MAX_DEPLOYS_PER_USER', int(environ.get('VLAB_DATAIQ_MAX_DEPLOYS_PER_USER', 0))),
+            ('VLAB_DATAIQ_FAST_QUEUE', environ.get('VLAB_DATAIQ_FAST_QUEUE', 'dataiq-fast')),
+            ('VLAB_DATAIQ_HEAVY_QUEUE', environ.get('VLAB_DATAIQ_HEAVY_QUEUE', 'dataiq-heavy')),
+            ('VLAB_DATAIQ_WORKER_TYPE', environ.get('VLAB_DATAIQ_WORKER_TYPE', 'all')),
+            ('VLAB_DATAIQ_FAST_CONCURRENCY', int(environ.get('VLAB_DATAIQ_FAST_CONCURRENCY', 4))),
+            ('VLAB_DATAIQ_FAST_PREFETCH', int(environ.get('VLAB_DATAIQ_FAST_PREFETCH', 4))),
+            ('VLAB_DATAIQ_HEAVY_CONCURRENCY', int(environ.get('VLAB_DATAIQ_HEAVY_CONCURRENCY', 4))),
+            ('VLAB_DATAIQ_HEAVY_PREFETCH', int(environ.get('VLAB_DATAIQ_HEAVY_PREFETCH', 1))),
+            ('VLAB_DATAIQ_IMAGE_MANIFEST_TTL', int(environ.get('VLAB_DATAIQ_IMAGE_MANIFEST_TTL', 60))),
           ])
 
 Constants = namedtuple('Constants', list(DEFINED.keys()))
@@ -0,0 +1,363 @@
+# -*- coding: UTF-8 -*-
+"""
+An index of the DataIQ images (OVAs) in ``VLAB_DATAIQ_IMAGES_DIR``.
+
+Describing an OVA means reading all of it, so the description of every image
+is kept in a manifest in the local cache directory. A refresh only re-reads an
+OVA whose mtime or size changed, and a refresh is skipped entirely while the
+images directory is unchanged and the manifest is younger than
+``VLAB_DATAIQ_IMAGE_MANIFEST_TTL`` seconds. Only one process refreshes the
+manifest at a time; the rest wait, then use what it wrote.
+
+Hashing a multi-GB OVA takes minutes, so only background jobs refresh the
+manifest (``dataiq.bake`` and the periodic ``dataiq.index_images``). Anything
+on a request path uses ``listing``, which only stats the OVAs, or ``saved``,
+which reads the manifest as it was last written.
+
+Every image is described by:
+
+- ``version``: What a client asks for, i.e. ``1.0.0`` or ``1.0.0-gui``
+- ``file``, ``size``, ``mtime`` and ``sha256`` of the OVA
+- ``networks``: The names of the networks in the OVF descriptor
+- ``disks``: How many VMDKs the OVA has
+- ``cpu_count`` and ``ram``: The default sizing from the OVF descriptor, in cores and GB
+"""
+import os
+import re
+import time
+import tarfile
+import hashlib
+
+import ujson
+
+from vlab_dataiq_api.lib import const
+from vlab_dataiq_api.lib.locks import file_lock
+
+
+CHUNK_SIZE = 1024 * 1024
+# From the CIM_ResourceAllocationSettingData schema that OVF uses
+CPU_RESOURCE = '3'
+RAM_RESOURCE = '4'
+# What a client can ask for, instead of a specific version
+LATEST = 'latest'
+
+
+def manifest():
+    """Obtain the description of every image, refreshing the manifest if needed.
+
+    :Returns: Dictionary, version -> description
+    """
+    saved, fresh = _load()
+    if fresh:
+        return saved['images']
+    with file_lock('images'):
+        # Another process might have refreshed the manifest while we waited
+        saved, fresh = _load()
+        if fresh:
+            return saved['images']
+        dir_mtime = _dir_mtime()
+        images = _refresh(saved['images'])
+        path = _manifest_path()
+        tmp_path = '{}.{}'.format(path, os.getpid())
+        with open(tmp_path, 'w') as the_file:
+            ujson.dump({'dir_mtime' : dir_mtime, 'images' : images}, the_file)
+        os.replace(tmp_path, path)
+    return images
+
+
+def listing():
+    """Obtain the images without reading any OVA; every image has just its
+    ``version``, ``file``, ``size`` and ``mtime``. For the API, which shouldn't
+    block a request on describing an OVA.
+
+    :Returns: Dictionary, version -> partial description
+    """
+    return {version : {'version' : version,
+                       'file' : entry.name,
+                       'size' : info.st_size,
+                       'mtime' : int(info.st_mtime)} for version, entry, info in _scan()}
+
+
+def saved():
+    """Obtain the manifest as it was last written, without refreshing it. An
+    image that's new (or changed) since then is missing (or out of date).
+
+    :Returns: Dictionary, version -> description
+    """
+    return _load()[0]['images']
+
+
+def select(versions, prefix=None, latest=False):
+    """Sort versions of DataIQ, oldest first, optionally filtering them
+
+    :Returns: List
+
+    :param versions: The versions to sort
+    :type versions: Iterable
+
+    :param prefix: Only keep versions that start with these components, i.e.
+                   ``1.2`` keeps ``1.2.0`` and ``1.2.1-gui`` but not ``1.20.0``
+    :type prefix: String
+
+    :param latest: Set to True to only keep the newest version
+    :type latest: Boolean
+    """
+    if prefix:
+        versions = [x for x in versions if x == prefix or x.startswith((prefix + '.', prefix + '-'))]
+    ordered = sorted(versions, key=version_key)
+    if latest:
+        return ordered[-1:]
+    return ordered
+
+
+def resolve(version):
+    """Convert ``latest`` to the newest image; any other version is returned as is.
+
+    :Returns: String
+
+    :Raises: ValueError
+
+    :param version: The image/version of DataIQ, or ``latest``
+    :type version: String
+    """
+    if version != LATEST:
+        return version
+    newest = select(listing().keys(), latest=True)
+    if not newest:
+        raise ValueError('No images of DataIQ exist')
+    return newest[0]
+
+
+def version_key(version):
+    """Make a version of DataIQ comparable, so ``1.10.0`` sorts after ``1.9.0``.
+
+    Numeric components sort before words, and a baked image sorts just after
+    the image it was made from.
+
+    :Returns: Tuple
+
+    :param version: The image/version of DataIQ, i.e. ``1.0.0`` or ``1.0.0-gui``
+    :type version: String
+    """
+    number, _, suffix = version.partition('-')
+    components = tuple((0, int(x), '') if x.isdigit() else (1, 0, x) for x in number.split('.'))
+    return components, suffix
+
+
+def available():
+    """Is the images directory mounted here? It always is on a worker, but might
+    not be on the API.
+
+    :Returns: Boolean
+    """
+    return os.path.isdir(const.VLAB_DATAIQ_IMAGES_DIR)
+
+
+def etag(images):
+    """Make an ETag that changes whenever any image is added, removed or changed
+
+    :Returns: String
+
+    :param images: The output of ``manifest`` or ``listing``
+    :type images: Dictionary
+    """
+    state = sorted((x['version'], x['size'], x['mtime']) for x in images.values())
+    return hashlib.sha256(ujson.dumps(state).encode()).hexdigest()
+
+
+def to_version(file_name):
+    """Convert the name of an OVA to the version of DataIQ it contains
+
+    :Returns: String
+
+    :param file_name: The name of the OVA, i.e. dataiq-1.0.0.ova
+    :type file_name: String
+    """
+    # Baked images have a suffix, i.e. dataiq-1.0.0-gui.ova
+    return file_name.split('-', 1)[-1].replace('.ova', '')
+
+
+def to_file_name(version):
+    """Convert a version of DataIQ to the name of its OVA
+
+    :Returns: String
+
+    :param version: The image/version of DataIQ
+    :type version: String
+    """
+    return 'dataiq-{}.ova'.format(version)
+
+
+def parse_networks(ovf):
+    """Pull the network names out of an OVF descriptor, the same way ``Ova.networks`` does
+
+    :Returns: List
+
+    :param ovf: The XML of the OVF descriptor
+    :type ovf: String
+    """
+    ntwks = re.findall(r'Network ovf:name=[\w\ \"]{1,50}', ovf)
+    return [x.split('=')[1].replace('"', '') for x in ntwks]
+
+
+def _load():
+    """Read the saved manifest, and check if it's still up to date
+
+    :Returns: Tuple (Dictionary, Boolean)
+    """
+    path = _manifest_path()
+    try:
+        with open(path) as the_file:
+            saved = ujson.load(the_file)
+    except (OSError, ValueError):
+        saved = {'dir_mtime' : None, 'images' : {}}
+    try:
+        age = time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        age = None
+    dir_mtime = _dir_mtime()
+    # Replacing an OVA in place doesn't change the mtime of the directory
+    fresh = age is not None and age < const.VLAB_DATAIQ_IMAGE_MANIFEST_TTL
+    return saved, fresh and dir_mtime is not None and dir_mtime == saved['dir_mtime']
+
+
+def _dir_mtime():
+    """The mtime of the images directory, or None if it doesn't exist
+
+    :Returns: Float
+    """
+    try:
+        return os.stat(const.VLAB_DATAIQ_IMAGES_DIR).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def _refresh(known):
+    """Describe every OVA in the images directory, reusing the description of
+    any OVA that hasn't changed.
+
+    :Returns: Dictionary
+
+    :param known: The descriptions from the last refresh
+    :type known: Dictionary
+    """
+    images = {}
+    for version, entry, info in _scan():
+        old = known.get(version)
+        if old is not None and old['mtime'] == int(info.st_mtime) and old['size'] == info.st_size:
+            images[version] = old
+        else:
+            images[version] = _describe_ova(entry.path, version, info)
+    return images
+
+
+def _scan():
+    """Find every OVA in the images directory
+
+    :Returns: List of (version, os.DirEntry, os.stat_result)
+    """
+    found = []
+    try:
+        entries = list(os.scandir(const.VLAB_DATAIQ_IMAGES_DIR))
+    except FileNotFoundError:
+        return found
+    for entry in entries:
+        # Dot files are OVAs still being written, i.e. by ``bake_image``
+        if not entry.name.endswith('.ova') or entry.name.startswith('.') or not entry.is_file():
+            continue
+        found.append((to_version(entry.name), entry, entry.stat()))
+    return found
+
+
+def _describe_ova(ova_path, version, info):
+    """Read an OVA, in a single pass, to describe it
+
+    :Returns: Dictionary
+
+    :param ova_path: The location of the OVA
+    :type ova_path: String
+
+    :param version: The image/version of DataIQ
+    :type version: String
+
+    :param info: The result of stat'ing the OVA
+    :type info: os.stat_result
+    """
+    description = {'version' : version,
+                   'file' : os.path.basename(ova_path),
+                   'size' : info.st_size,
+                   'mtime' : int(info.st_mtime),
+                   'sha256' : None,
+                   'networks' : [],
+                   'disks' : 0,
+                   'cpu_count' : None,
+                   'ram' : None}
+    checksum = hashlib.sha256()
+    try:
+        with open(ova_path, 'rb') as raw:
+            with tarfile.open(fileobj=HashingReader(raw, checksum), mode='r|') as the_tar:
+                for member in the_tar:
+                    if member.name.endswith('.ovf'):
+                        ovf = the_tar.extractfile(member).read().decode(errors='replace')
+                        description.update(_parse_ovf(ovf))
+                    elif member.name.endswith('.vmdk'):
+                        description['disks'] += 1
+            # Finish hashing any padding after the last member
+            for chunk in iter(lambda: raw.read(CHUNK_SIZE), b''):
+                checksum.update(chunk)
+    except (OSError, tarfile.TarError):
+        # A corrupt (or still copying) OVA is listed, but has no details
+        return description
+    description['sha256'] = checksum.hexdigest()
+    return description
+
+
+def _parse_ovf(ovf):
+    """Pull the networks and default sizing out of an OVF descriptor
+
+    :Returns: Dictionary
+
+    :param ovf: The XML of the OVF descriptor
+    :type ovf: String
+    """
+    parsed = {'networks' : parse_networks(ovf)}
+    for item in re.findall(r'<Item>.*?</Item>', ovf, re.DOTALL):
+        resource_type = re.search(r'<rasd:ResourceType>(\d+)</rasd:ResourceType>', item)
+        quantity = re.search(r'<rasd:VirtualQuantity>(\d+)</rasd:VirtualQuantity>', item)
+        if resource_type is None or quantity is None:
+            continue
+        if resource_type.group(1) == CPU_RESOURCE:
+            parsed['cpu_count'] = int(quantity.group(1))
+        elif resource_type.group(1) == RAM_RESOURCE:
+            # The OVF states RAM in MB
+            parsed['ram'] = int(quantity.group(1)) // 1024
+    return parsed
+
+
+def _manifest_path():
+    """The file that holds the manifest
+
+    :Returns: String
+    """
+    os.makedirs(const.VLAB_DATAIQ_CACHE_DIR, exist_ok=True)
+    return os.path.join(const.VLAB_DATAIQ_CACHE_DIR, 'images.json')
+
+
+class HashingReader(object):
+    """Checksum a file while it's being read
+
+    :param the_file: The file to read
+    :type the_file: File
+
+    :param checksum: Updated with every byte that's read
+    :type checksum: hashlib.sha256
+    """
+    def __init__(self, the_file, checksum):
+        self._file = the_file
+        self._checksum = checksum
+
+    def read(self, size=-1):
+        """Read from the file, updating the checksum"""
+        data = self._file.read(size)
+        self._checksum.update(data)
+        return data
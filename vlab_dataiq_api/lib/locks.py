@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+"""
+Locks shared by every process on a host, backed by ``flock`` on files in the
+local cache directory.
+"""
+import os
+import fcntl
+import hashlib
+from contextlib import contextmanager
+
+from vlab_dataiq_api.lib import const
+
+
+@contextmanager
+def file_lock(name, blocking=True):
+    """Block until an exclusive lock is obtained, holding it for the duration
+    of a ``with`` statement. The ``with`` statement gets True if the lock was
+    obtained.
+
+    :param name: What's being locked. Processes that use the same name contend
+                 for the same lock.
+    :type name: String
+
+    :param blocking: Set to False to not wait for a lock that's already held;
+                     the ``with`` statement gets False instead.
+    :type blocking: Boolean
+    """
+    lock_dir = os.path.join(const.VLAB_DATAIQ_CACHE_DIR, 'locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    lock_file = os.path.join(lock_dir, hashlib.sha1(name.encode()).hexdigest())
+    with open(lock_file, 'w') as the_file:
+        try:
+            fcntl.flock(the_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(the_file, fcntl.LOCK_UN)
+
+
+def process_alive(pid):
+    """Is a process still running? For telling when state on disk was left
+    behind by a process that crashed.
+
+    :Returns: Boolean
+
+    :param pid: The process ID
+    :type pid: Integer
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # It exists, it's just not ours
+        return True
+    return True
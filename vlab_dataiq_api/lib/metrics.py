@@ -0,0 +1,150 @@
+# -*- coding: UTF-8 -*-
+"""
+Prometheus metrics for the API and the worker.
+
+Both uWSGI and Celery run the code in several processes, so the metrics are
+kept in prometheus_client's multiprocess mode; every process writes its
+samples to files in ``VLAB_DATAIQ_METRICS_DIR``, and whichever process serves
+the metrics adds them all up.
+
+.. note::
+    prometheus_client picks how it stores samples when it's first imported, so
+    nothing else may import it before this module. Call ``setup`` once, at
+    startup, before any metric is recorded; the API does that when it builds
+    the Flask app, and the worker in ``worker_init``.
+"""
+import os
+import time
+import functools
+
+from flask import g, request
+from celery.signals import before_task_publish
+from pyVmomi.SoapAdapter import SoapStubAdapter
+
+from vlab_dataiq_api.lib import const
+
+# Must be set before prometheus_client is imported
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', const.VLAB_DATAIQ_METRICS_DIR)
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+from prometheus_client import (CollectorRegistry, Counter, Histogram, generate_latest,
+                               multiprocess, start_http_server, CONTENT_TYPE_LATEST)
+
+
+# Creating DataIQ takes many minutes, so the buckets go up to a few hours
+LONG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200, 10800, float('inf'))
+# API requests just queue a task, so they should be quick
+API_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+REQUEST_SECONDS = Histogram('dataiq_api_request_seconds', 'Latency of API requests',
+                            ['route', 'method', 'status'], buckets=API_BUCKETS)
+TASK_SECONDS = Histogram('dataiq_task_seconds', 'How long a Celery task ran',
+                         ['task', 'state'], buckets=LONG_BUCKETS)
+QUEUE_WAIT_SECONDS = Histogram('dataiq_task_queue_wait_seconds', 'How long a task waited to be picked up by a worker',
+                               ['task'], buckets=LONG_BUCKETS)
+STAGE_SECONDS = Histogram('dataiq_create_stage_seconds', 'How long a stage of creating DataIQ took',
+                          ['stage'], buckets=LONG_BUCKETS)
+GUEST_COMMAND_SECONDS = Histogram('dataiq_guest_command_seconds', 'How long a command ran in the guest OS',
+                                  ['command'], buckets=LONG_BUCKETS)
+VCENTER_CALLS = Counter('dataiq_vcenter_calls_total', 'SOAP calls made to vCenter by this service',
+                        ['name'])
+SESSION_POOL_EVENTS = Counter('dataiq_vcenter_session_pool_total',
+                              'Checkouts from the vCenter session pool; hits, misses and relogins, plus discards',
+                              ['event'])
+
+
+def setup():
+    """Discard the samples left behind by processes that ran before this one started
+
+    :Returns: None
+    """
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    for stale in os.listdir(metrics_dir):
+        os.remove(os.path.join(metrics_dir, stale))
+
+
+def count_vcenter_calls():
+    """Count every SOAP call to vCenter, by the name of the method. The count is
+    kept by the pyVmomi stub, so it includes the calls made by vlab_inf_common,
+    and reading a property of a managed object (a ``Fetch``).
+
+    :Returns: None
+    """
+    invoke = SoapStubAdapter.InvokeMethod
+    if hasattr(invoke, '__wrapped__'):
+        # Already counting
+        return
+
+    @functools.wraps(invoke)
+    def counted(stub, mo, info, args, outerStub=None):
+        VCENTER_CALLS.labels(name=info.wsdlName).inc()
+        return invoke(stub, mo, info, args, outerStub)
+
+    SoapStubAdapter.InvokeMethod = counted
+
+
+@before_task_publish.connect
+def stamp_sent_time(headers=None, **kwargs):
+    """Record when a task was sent, so the worker can tell how long it was queued"""
+    if headers is not None:
+        headers['sent_at'] = time.time()
+
+
+def collect():
+    """Render the metrics of every process, in the Prometheus text format
+
+    :Returns: Tuple (bytes, content type)
+    """
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def start_exporter(port):
+    """Serve the metrics over HTTP from a background thread
+
+    :Returns: None
+
+    :param port: The TCP port to listen on; zero disables the exporter
+    :type port: Integer
+    """
+    if not port:
+        return
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, registry=registry)
+
+
+def process_exited(pid):
+    """Stop reporting the gauges of a process that's gone
+
+    :Returns: None
+
+    :param pid: The process ID
+    :type pid: Integer
+    """
+    multiprocess.mark_process_dead(pid)
+
+
+def time_requests(app):
+    """Record the latency of every request a Flask app handles
+
+    :Returns: None
+
+    :param app: The Flask app
+    :type app: flask.Flask
+    """
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.time()
+
+    @app.after_request
+    def _observe(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            # The rule, not the path, so a task-id doesn't make a new series
+            route = request.url_rule.rule if request.url_rule else 'unknown'
+            REQUEST_SECONDS.labels(route=route,
+                                   method=request.method,
+                                   status=response.status_code).observe(time.time() - started)
+        return response
+
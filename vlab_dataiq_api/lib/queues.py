@@ -0,0 +1,68 @@
+# -*- coding: UTF-8 -*-
+"""
+Which Celery queue each task goes to, and which queues a worker consumes.
+
+Creates can run for hours, so they get their own queue; a listing or a delete
+shouldn't sit behind them. The API and the worker both route with
+``configure``. A worker started with ``VLAB_DATAIQ_WORKER_TYPE`` set to
+``fast`` or ``heavy`` only consumes that queue; ``all`` consumes both.
+"""
+from kombu import Queue
+
+from vlab_dataiq_api.lib import const
+
+
+FAST_TASKS = ('dataiq.show', 'dataiq.image', 'dataiq.delete', 'dataiq.bulk_delete', 'dataiq.resume',
+              'dataiq.bulk_create')
+HEAVY_TASKS = ('dataiq.create', 'dataiq.create_stage', 'dataiq.bake', 'dataiq.refill_pool',
+               'dataiq.index_images')
+WORKER_TYPES = ('all', 'fast', 'heavy')
+
+
+def configure(celery_app):
+    """Route every task to the fast or heavy queue
+
+    :Returns: None
+
+    :param celery_app: The app that sends (or runs) the tasks
+    :type celery_app: celery.Celery
+    """
+    routes = {x: {'queue' : const.VLAB_DATAIQ_FAST_QUEUE} for x in FAST_TASKS}
+    routes.update({x: {'queue' : const.VLAB_DATAIQ_HEAVY_QUEUE} for x in HEAVY_TASKS})
+    celery_app.conf.task_routes = routes
+    # Anything not listed still avoids the heavy queue
+    celery_app.conf.task_default_queue = const.VLAB_DATAIQ_FAST_QUEUE
+
+
+def configure_worker(celery_app, worker_type):
+    """Set the queues, concurrency and prefetch of a worker
+
+    :Returns: None
+
+    :Raises: ValueError
+
+    :param celery_app: The app the worker runs
+    :type celery_app: celery.Celery
+
+    :param worker_type: Which queues to consume; one of ``WORKER_TYPES``
+    :type worker_type: String
+    """
+    if worker_type not in WORKER_TYPES:
+        error = 'Unknown worker type {}, must be one of {}'.format(worker_type, ', '.join(WORKER_TYPES))
+        raise ValueError(error)
+    if worker_type == 'fast':
+        queues = [const.VLAB_DATAIQ_FAST_QUEUE]
+        concurrency = const.VLAB_DATAIQ_FAST_CONCURRENCY
+        prefetch = const.VLAB_DATAIQ_FAST_PREFETCH
+    elif worker_type == 'heavy':
+        queues = [const.VLAB_DATAIQ_HEAVY_QUEUE]
+        concurrency = const.VLAB_DATAIQ_HEAVY_CONCURRENCY
+        prefetch = const.VLAB_DATAIQ_HEAVY_PREFETCH
+    else:
+        queues = [const.VLAB_DATAIQ_FAST_QUEUE, const.VLAB_DATAIQ_HEAVY_QUEUE]
+        concurrency = const.VLAB_DATAIQ_FAST_CONCURRENCY + const.VLAB_DATAIQ_HEAVY_CONCURRENCY
+        # A process that prefetched a create would make a listing wait behind it
+        prefetch = const.VLAB_DATAIQ_HEAVY_PREFETCH
+    celery_app.conf.task_queues = [Queue(x) for x in queues]
+    celery_app.conf.worker_concurrency = concurrency
+    celery_app.conf.worker_prefetch_multiplier = prefetch
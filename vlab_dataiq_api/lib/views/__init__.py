@@ -1,3 +1,4 @@
 # -*- coding: UTF-8 -*-
 from .healthcheck import HealthView
 from .dataiq import DataIQView
+from .metrics import MetricsView
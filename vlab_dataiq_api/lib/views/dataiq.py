@@ -2,16 +2,17 @@
 """
 Defines the RESTful API for deploying/managing a DataIQ instance
 """
+import ipaddress
+
 import ujson
 from flask import current_app
 from flask_classy import request, route, Response
 from vlab_inf_common.views import MachineView
-from vlab_inf_common.vmware import vCenter, vim
 from vlab_inf_common.input_validators import network_config_ok
 from vlab_api_common import describe, get_logger, requires, validate_input
 
 
-from vlab_dataiq_api.lib import const
+from vlab_dataiq_api.lib import const, images
 
 
 logger = get_logger(__name__, loglevel=const.VLAB_DATAIQ_LOG_LEVEL)
@@ -30,7 +31,7 @@ class DataIQView(MachineView):
                             "type": "string"
                         },
                         "image": {
-                            "description": "The image/version of DataIQ to create",
+                            "description": "The image/version of DataIQ to create, or 'latest' for the newest one",
                             "type": "string"
                         },
                         "network": {
@@ -91,19 +92,147 @@ class DataIQView(MachineView):
     GET_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
                   "description": "Display the DataIQ instances you own"
                  }
+    GET_ARGS_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                       "type": "object",
+                       "properties": {
+                          "fresh": {
+                              "description": "Set to true to bypass the cached inventory",
+                              "type": "string",
+                              "enum": ["true", "false"]
+                          }
+                       }
+                      }
+    RESUME_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                     "description": "Finish creating a DataIQ instance, from the first stage that didn't complete",
+                     "type": "object",
+                     "properties": {
+                        "name": {
+                            "description": "The name of the DataIQ instance to finish creating",
+                            "type": "string"
+                        }
+                     },
+                     "required": ["name"]
+                    }
+    BULK_SCHEMA = { "$schema": "http://json-schema.org/draft-04/schema#",
+                    "type": "object",
+                    "description": "Create many identical DataIQ instances, from a list of machines or a range of IPs",
+                    "properties": {
+                        "machines": {
+                            "description": "The name and IPv4 address of every DataIQ instance",
+                            "type": "array",
+                            "minItems": 1,
+                            "maxItems": 50,
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "name": {"type": "string"},
+                                    "static-ip": {"type": "string"}
+                                },
+                                "required": ["name", "static-ip"]
+                            }
+                        },
+                        "ip-range": {
+                            "description": "Name the instances <name-prefix>-1, <name-prefix>-2, etc, with sequential IPs",
+                            "type": "object",
+                            "properties": {
+                                "name-prefix": {"type": "string"},
+                                "start-ip": {"type": "string"},
+                                "count": {"type": "integer", "minimum": 1, "maximum": 50}
+                            },
+                            "required": ["name-prefix", "start-ip", "count"]
+                        },
+                        "image": {
+                            "description": "The image/version of DataIQ to create, or 'latest' for the newest one",
+                            "type": "string"
+                        },
+                        "network": {
+                            "description": "The network to hook the DataIQ instances up to",
+                            "type": "string"
+                        },
+                        "default-gateway": {
+                            "description": "The IPv4 address of the network default gateway",
+                            "type": "string",
+                            "default": "192.168.1.1"
+                        },
+                        "netmask":  {
+                            "description": "The subnet mask for the network",
+                            "type": "string",
+                            "default": "255.255.255.0"
+                        },
+                        "dns": {
+                            "description": "The IPv4 address(es) of DNS servers",
+                            "type": "array",
+                            "default": ["192.168.1.1"]
+                        },
+                        "disk-size": {
+                            "description": "The number of GB for the DataIQ database disk",
+                            "type": "integer",
+                            "default": 250,
+                            "enum": [250, 500, 750]
+                        },
+                        "cpu-count": {
+                            "description": "The number of CPU cores to allocate to each VM",
+                            "type": "integer",
+                            "default": 4,
+                            "enum": [4, 8, 12]
+                        },
+                        "ram": {
+                            "description": "The number of GB of RAM to allocate to each VM",
+                            "type": "integer",
+                            "default": 32,
+                            "enum": [32, 64, 96]
+                        }
+                    },
+                    "oneOf": [{"required": ["machines"]}, {"required": ["ip-range"]}],
+                    "required": ["image", "network"]
+                  }
+    BULK_DELETE_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                          "type": "object",
+                          "description": "Destroy many DataIQ instances at once",
+                          "properties": {
+                              "names": {
+                                  "description": "The names of the DataIQ instances to destroy",
+                                  "type": "array",
+                                  "minItems": 1,
+                                  "maxItems": 50,
+                                  "items": {"type": "string"}
+                              },
+                              "all": {
+                                  "description": "Destroy every DataIQ instance you own",
+                                  "type": "boolean",
+                                  "enum": [True]
+                              }
+                          },
+                          "oneOf": [{"required": ["names"]}, {"required": ["all"]}]
+                         }
     IMAGES_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
-                     "description": "View available versions of DataIQ that can be created"
+                     "description": "View available versions of DataIQ that can be created, oldest first"
                     }
+    IMAGES_ARGS_SCHEMA = {"$schema": "http://json-schema.org/draft-04/schema#",
+                          "type": "object",
+                          "properties": {
+                             "latest": {
+                                 "description": "Set to true to only list the newest version",
+                                 "type": "string",
+                                 "enum": ["true", "false"]
+                             },
+                             "version": {
+                                 "description": "Only list versions that start with this, i.e. 1.2",
+                                 "type": "string"
+                             }
+                          }
+                         }
 
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
-    @describe(post=POST_SCHEMA, delete=DELETE_SCHEMA, get=GET_SCHEMA)
+    @describe(post=POST_SCHEMA, delete=DELETE_SCHEMA, get=GET_SCHEMA, get_args=GET_ARGS_SCHEMA)
     def get(self, *args, **kwargs):
         """Display the DataIQ instances you own"""
         username = kwargs['token']['username']
         resp_data = {'user' : username}
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
-        task = current_app.celery_app.send_task('dataiq.show', [username, txn_id])
+        fresh = request.args.get('fresh', 'false').lower() == 'true'
+        task = current_app.celery_app.send_task('dataiq.show', [username, txn_id, fresh])
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
@@ -169,17 +298,205 @@ class DataIQView(MachineView):
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
         return resp
 
+    @route('/task', methods=["GET"])
+    @route('/task/<tid>', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(get_args=MachineView.TASK_ARGS)
+    def handle_task(self, *args, **kwargs):
+        """Check the status of a task, including the progress of a running create"""
+        task_id = request.args.get('task-id', kwargs.get('tid', None))
+        # MachineView reports every other status, and rejects a bad/missing task id
+        if task_id is not None and not (request.args.get('task-id', None) and kwargs.get('tid', None)):
+            result = current_app.celery_app.AsyncResult(task_id)
+            if result.status == 'PROGRESS':
+                resp = {'user': kwargs['token']['username'],
+                        'content' : {'status' : result.status, 'progress' : result.info}}
+                return ujson.dumps(resp), 202
+        return super().handle_task(*args, **kwargs)
+
+    @route('/bulk', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=BULK_SCHEMA)
+    def bulk(self, *args, **kwargs):
+        """Create many DataIQ instances; poll ``/bulk/<task-id>`` for the progress of them all"""
+        username = kwargs['token']['username']
+        resp_data = {'user' : username}
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        body = kwargs['body']
+        default_gateway = body.get('default-gateway', '192.168.1.1')
+        netmask = body.get('netmask', '255.255.255.0')
+        try:
+            machines = _bulk_machines(body)
+        except ValueError as doh:
+            machines = []
+            config_error = '{}'.format(doh)
+        else:
+            config_error = None
+        for _, static_ip in machines:
+            config_error = network_config_ok(ip=static_ip,
+                                             gateway=default_gateway,
+                                             netmask=netmask)
+            if config_error:
+                break
+        if config_error:
+            resp_data['error'] = config_error
+            resp = Response(ujson.dumps(resp_data))
+            resp.status_code = 400
+            return resp
+        network = '{}_{}'.format(username, body['network'])
+        task = current_app.celery_app.send_task('dataiq.bulk_create', [username,
+                                                                       machines,
+                                                                       body['image'],
+                                                                       network,
+                                                                       default_gateway,
+                                                                       netmask,
+                                                                       body.get('dns', ['192.168.1.1']),
+                                                                       body.get('disk-size', 250),
+                                                                       body.get('cpu-count', 4),
+                                                                       body.get('ram', 32),
+                                                                       txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/bulk/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/bulk/<tid>', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    def bulk_status(self, *args, **kwargs):
+        """Check the progress of a bulk create, as a whole"""
+        result = current_app.celery_app.AsyncResult(kwargs['tid'])
+        if result.status != 'SUCCESS' or result.result['error']:
+            # Still dispatching the creates, or failed to
+            return self.handle_task(*args, **kwargs)
+        progress, machines, errors = _bulk_progress(result.result['content']['tasks'])
+        resp = {'user': kwargs['token']['username'], 'content' : {'progress' : progress}}
+        if progress['running']:
+            resp['content']['status'] = 'PROGRESS'
+            return ujson.dumps(resp), 202
+        resp['content']['status'] = 'SUCCESS'
+        resp['content']['machines'] = machines
+        if errors:
+            resp['error'] = 'Failed to create {} of {} machines: {}'.format(len(errors),
+                                                                         progress['total'],
+                                                                         '; '.join('{}: {}'.format(k, v) for k, v in sorted(errors.items())))
+            return ujson.dumps(resp), 400
+        return ujson.dumps(resp), 200
+
+    @route('/bulk', methods=["DELETE"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=BULK_DELETE_SCHEMA)
+    def bulk_delete(self, *args, **kwargs):
+        """Destroy many DataIQ instances, tracked by a single task"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        # None means every DataIQ the user owns
+        machine_names = kwargs['body'].get('names', None)
+        task = current_app.celery_app.send_task('dataiq.bulk_delete', [username, machine_names, txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
+    @route('/resume', methods=["POST"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @validate_input(schema=RESUME_SCHEMA)
+    def resume(self, *args, **kwargs):
+        """Finish creating a DataIQ that failed part way through"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        resp_data = {'user' : username}
+        machine_name = kwargs['body']['name']
+        task = current_app.celery_app.send_task('dataiq.resume', [username, machine_name, txn_id])
+        resp_data['content'] = {'task-id': task.id}
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
+        return resp
+
     @route('/image', methods=["GET"])
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
-    @describe(get=IMAGES_SCHEMA)
+    @describe(get=IMAGES_SCHEMA, get_args=IMAGES_ARGS_SCHEMA)
     def image(self, *args, **kwargs):
         """Show available versions of DataIQ that can be deployed"""
         username = kwargs['token']['username']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
         resp_data = {'user' : username}
-        task = current_app.celery_app.send_task('dataiq.image', [txn_id])
+        prefix = request.args.get('version')
+        latest = request.args.get('latest', 'false').lower() == 'true'
+        if images.available():
+            # No need to make the client poll a task just to read a directory.
+            # Only stat the OVAs though; describing them is left to the worker
+            listing = images.listing()
+            resp_data['content'] = {'image' : images.select(listing.keys(), prefix=prefix, latest=latest)}
+            resp = Response(ujson.dumps(resp_data))
+            resp.status_code = 200
+            resp.set_etag(images.etag(listing))
+            return resp.make_conditional(request)
+        task = current_app.celery_app.send_task('dataiq.image', [txn_id, prefix, latest])
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
         return resp
+
+
+def _bulk_progress(task_ids):
+    """Sum up the create tasks of a bulk create
+
+    :Returns: Tuple (Dictionary, Dictionary, Dictionary), the progress, the info
+              of every machine that's been created, and the error of every
+              machine that failed
+
+    :param task_ids: The name of every machine -> the id of its create task
+    :type task_ids: Dictionary
+    """
+    progress = {'total' : len(task_ids), 'done' : 0, 'failed' : 0, 'running' : 0, 'tasks' : {}}
+    machines = {}
+    errors = {}
+    for machine_name, task_id in task_ids.items():
+        result = current_app.celery_app.AsyncResult(task_id)
+        progress['tasks'][machine_name] = result.status
+        if result.status == 'SUCCESS' and not result.result['error']:
+            progress['done'] += 1
+            machines.update(result.result['content'])
+        elif result.status == 'SUCCESS':
+            progress['failed'] += 1
+            errors[machine_name] = result.result['error']
+        elif result.status == 'FAILURE':
+            progress['failed'] += 1
+            errors[machine_name] = '{}'.format(result.result)
+        else:
+            progress['running'] += 1
+    return progress, machines, errors
+
+
+def _bulk_machines(body):
+    """Obtain the name and IP of every machine in a bulk create request
+
+    :Returns: List of (name, static IP) pairs
+
+    :Raises: ValueError
+
+    :param body: The body of the bulk create request
+    :type body: Dictionary
+    """
+    if 'machines' in body:
+        machines = [(x['name'], x['static-ip']) for x in body['machines']]
+    else:
+        ip_range = body['ip-range']
+        try:
+            start_ip = ipaddress.IPv4Address(ip_range['start-ip'])
+        except ipaddress.AddressValueError:
+            raise ValueError('Invalid start-ip: {}'.format(ip_range['start-ip']))
+        try:
+            start_ip + (ip_range['count'] - 1)
+        except ipaddress.AddressValueError:
+            raise ValueError('Cannot fit {} IPs after start-ip {}'.format(ip_range['count'], start_ip))
+        machines = [('{}-{}'.format(ip_range['name-prefix'], x + 1), str(start_ip + x)) for x in range(ip_range['count'])]
+    names = [x[0] for x in machines]
+    if len(set(names)) != len(names):
+        raise ValueError('Every machine must have a unique name')
+    return machines
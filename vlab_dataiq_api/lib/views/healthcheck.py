@@ -2,14 +2,10 @@
 """
 Enables Health checks for the power API
 """
-from time import time
 import pkg_resources
 
 import ujson
 from flask_classy import FlaskView, Response
-from vlab_inf_common.vmware import vCenter
-
-from vlab_dataiq_api.lib import const
 
 
 class HealthView(FlaskView):
@@ -0,0 +1,23 @@
+# -*- coding: UTF-8 -*-
+"""
+Exposes the Prometheus metrics of the API
+"""
+from flask_classy import FlaskView, Response
+
+from vlab_dataiq_api.lib import metrics
+
+
+class MetricsView(FlaskView):
+    """
+    End point for Prometheus to scrape
+    """
+    route_base = '/metrics'
+    trailing_slash = False
+
+    def get(self):
+        """Render the metrics in the Prometheus text format"""
+        body, content_type = metrics.collect()
+        response = Response(body)
+        response.status_code = 200
+        response.headers['Content-Type'] = content_type
+        return response
@@ -0,0 +1,161 @@
+# -*- coding: UTF-8 -*-
+"""
+Admission control for deploying DataIQ machines.
+
+Every deploy waits for a slot before it starts, so a burst of creates can't
+swamp vCenter. There are three limits, each of which is off when set to zero:
+
+- ``VLAB_DATAIQ_MAX_DEPLOYS`` deploys at once, in total
+- ``VLAB_DATAIQ_MAX_DEPLOYS_PER_DATASTORE`` deploys at once to the same datastore
+- ``VLAB_DATAIQ_MAX_DEPLOYS_PER_USER`` deploys at once for the same user
+
+Waiting deploys are admitted first come, first served; a deploy that's only
+blocked by its own datastore or user limit doesn't hold up the ones behind it.
+The queue lives in the local cache directory, so it's shared by every Celery
+process on the worker.
+"""
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+import ujson
+
+from vlab_dataiq_api.lib import const
+from vlab_dataiq_api.lib.locks import file_lock, process_alive
+
+
+# How often a waiting deploy checks for a free slot
+POLL_INTERVAL = 2
+
+
+def enabled():
+    """Is any of the limits turned on?
+
+    :Returns: Boolean
+    """
+    return any([const.VLAB_DATAIQ_MAX_DEPLOYS,
+                const.VLAB_DATAIQ_MAX_DEPLOYS_PER_DATASTORE,
+                const.VLAB_DATAIQ_MAX_DEPLOYS_PER_USER])
+
+
+@contextmanager
+def admitted(username, datastore, on_wait=None):
+    """Block until a deploy is allowed to start, holding the slot for the
+    duration of a ``with`` statement.
+
+    :param username: The user the deploy is for
+    :type username: String
+
+    :param datastore: The datastore being deployed to, or None if it's not known
+    :type datastore: String
+
+    :param on_wait: Called with the number of deploys ahead in the queue, every
+                    time it changes
+    :type on_wait: Function
+    """
+    if not enabled():
+        yield
+        return
+    ticket = uuid.uuid4().hex
+    entry = {'ticket' : ticket, 'username' : username, 'datastore' : datastore, 'pid' : os.getpid()}
+    with file_lock('admission'):
+        queue = _load()
+        queue['waiting'].append(entry)
+        _save(queue)
+    try:
+        last_position = None
+        while True:
+            with file_lock('admission'):
+                queue = _load()
+                position = _position(queue, ticket)
+                if position == 0:
+                    queue['waiting'] = [x for x in queue['waiting'] if x['ticket'] != ticket]
+                    queue['running'].append(entry)
+                    _save(queue)
+                    break
+            if position != last_position and on_wait is not None:
+                on_wait(position)
+            last_position = position
+            time.sleep(POLL_INTERVAL)
+        yield
+    finally:
+        with file_lock('admission'):
+            queue = _load()
+            queue['waiting'] = [x for x in queue['waiting'] if x['ticket'] != ticket]
+            queue['running'] = [x for x in queue['running'] if x['ticket'] != ticket]
+            _save(queue)
+
+
+def _position(queue, ticket):
+    """Find how many waiting deploys will be admitted before this one. Zero means
+    it can start now.
+
+    :Returns: Integer
+
+    :param queue: The running and waiting deploys
+    :type queue: Dictionary
+
+    :param ticket: Identifies the deploy
+    :type ticket: String
+    """
+    admitting = list(queue['running'])
+    ahead = 0
+    for entry in queue['waiting']:
+        fits = _fits(entry, admitting)
+        if entry['ticket'] == ticket:
+            return 0 if fits else ahead + 1
+        if fits:
+            # It'll be admitted the next time it checks, so it takes its slot now
+            admitting.append(entry)
+        ahead += 1
+    # Not in the queue; can only happen if the queue file was lost
+    return 0
+
+
+def _fits(entry, running):
+    """Can a deploy start without going over any limit?
+
+    :Returns: Boolean
+    """
+    limits = [(const.VLAB_DATAIQ_MAX_DEPLOYS, running),
+              (const.VLAB_DATAIQ_MAX_DEPLOYS_PER_USER, [x for x in running if x['username'] == entry['username']])]
+    if entry['datastore'] is not None:
+        limits.append((const.VLAB_DATAIQ_MAX_DEPLOYS_PER_DATASTORE,
+                       [x for x in running if x['datastore'] == entry['datastore']]))
+    return all(not limit or len(counted) < limit for limit, counted in limits)
+
+
+def _load():
+    """Read the queue, dropping deploys of processes that are gone. Must be
+    called while holding the ``admission`` lock.
+
+    :Returns: Dictionary
+    """
+    try:
+        with open(_path()) as the_file:
+            queue = ujson.load(the_file)
+    except (OSError, ValueError):
+        return {'waiting' : [], 'running' : []}
+    return {x: [y for y in queue.get(x, []) if process_alive(y['pid'])] for x in ('waiting', 'running')}
+
+
+def _save(queue):
+    """Write the queue. Must be called while holding the ``admission`` lock.
+
+    :Returns: None
+    """
+    tmp_path = '{}.{}'.format(_path(), os.getpid())
+    with open(tmp_path, 'w') as the_file:
+        ujson.dump(queue, the_file)
+    os.replace(tmp_path, _path())
+
+
+def _path():
+    """The file that holds the queue
+
+    :Returns: String
+    """
+    os.makedirs(const.VLAB_DATAIQ_CACHE_DIR, exist_ok=True)
+    return os.path.join(const.VLAB_DATAIQ_CACHE_DIR, 'admission.json')
+
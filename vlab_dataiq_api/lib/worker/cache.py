@@ -0,0 +1,101 @@
+# -*- coding: UTF-8 -*-
+"""
+A short-lived, per-user cache of the DataIQ inventory returned by ``dataiq.show``.
+
+The cache lives on the local filesystem (instead of in memory) so that every
+Celery process on the worker sees the same entries, and an invalidation made
+by the process that ran a create/delete is honored by all the others.
+"""
+import os
+import time
+import hashlib
+
+import ujson
+
+from vlab_dataiq_api.lib import const
+
+
+def get(username):
+    """Obtain the cached inventory of a user.
+
+    :Returns: Dictionary or None when there's no usable entry
+
+    :param username: The user who owns the inventory
+    :type username: String
+    """
+    if not const.VLAB_DATAIQ_SHOW_CACHE_TTL:
+        return None
+    entry = _entry_path(username)
+    try:
+        age = time.time() - os.stat(entry).st_mtime
+        if age > const.VLAB_DATAIQ_SHOW_CACHE_TTL:
+            return None
+        with open(entry) as the_file:
+            return ujson.load(the_file)
+    except (OSError, ValueError):
+        # ValueError -> partially written, or otherwise bogus entry
+        return None
+
+
+def put(username, inventory, started):
+    """Cache the inventory of a user.
+
+    The entry is not saved if the user's inventory was invalidated after the
+    scan that produced it began; it might not include the change.
+
+    :Returns: None
+
+    :param username: The user who owns the inventory
+    :type username: String
+
+    :param inventory: The output from ``vmware.show_dataiq``
+    :type inventory: Dictionary
+
+    :param started: The timestamp of when the inventory scan began
+    :type started: Float
+    """
+    if not const.VLAB_DATAIQ_SHOW_CACHE_TTL:
+        return
+    try:
+        if os.stat(_marker_path(username)).st_mtime >= started:
+            return
+    except FileNotFoundError:
+        pass
+    entry = _entry_path(username)
+    tmp_entry = '{}.{}'.format(entry, os.getpid())
+    os.makedirs(const.VLAB_DATAIQ_CACHE_DIR, exist_ok=True)
+    with open(tmp_entry, 'w') as the_file:
+        ujson.dump(inventory, the_file)
+    os.replace(tmp_entry, entry)
+
+
+def invalidate(username):
+    """Discard the cached inventory of a user.
+
+    :Returns: None
+
+    :param username: The user who owns the inventory
+    :type username: String
+    """
+    os.makedirs(const.VLAB_DATAIQ_CACHE_DIR, exist_ok=True)
+    with open(_marker_path(username), 'w'):
+        pass
+    try:
+        os.remove(_entry_path(username))
+    except FileNotFoundError:
+        pass
+
+
+def _entry_path(username):
+    """The file that holds the cached inventory of a user"""
+    return os.path.join(const.VLAB_DATAIQ_CACHE_DIR, '{}.show.json'.format(_key(username)))
+
+
+def _marker_path(username):
+    """The file whose mtime is the last time a user's inventory was invalidated"""
+    return os.path.join(const.VLAB_DATAIQ_CACHE_DIR, '{}.invalidated'.format(_key(username)))
+
+
+def _key(username):
+    """Usernames come from LDAP; don't trust them to be valid file names"""
+    return hashlib.sha1(username.encode()).hexdigest()
@@ -0,0 +1,209 @@
+# -*- coding: UTF-8 -*-
+"""
+An optional, in-memory index of every DataIQ VM in vLab, kept current by
+following vCenter's change feed (``WaitForUpdatesEx``) instead of polling.
+
+Each worker process runs its own feed in a background thread. Callers must
+treat the index as a hint, and fall back to asking vCenter directly whenever
+``get_inventory`` returns None (i.e. the feed is disabled, still syncing, or
+has stopped hearing from vCenter).
+"""
+import time
+import threading
+
+import ujson
+from vlab_api_common import get_logger
+from vlab_inf_common.vmware import vCenter, vim
+
+from vlab_dataiq_api.lib import const
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_DATAIQ_LOG_LEVEL)
+
+_INVENTORY = None
+_INVENTORY_LOCK = threading.Lock()
+
+
+class LiveInventory(threading.Thread):
+    """Follows property changes of every VM and folder under ``INF_VCENTER_TOP_LVL_DIR``.
+
+    :param wait: The max number of seconds a single ``WaitForUpdatesEx`` call blocks.
+    :type wait: Integer
+    """
+    def __init__(self, wait):
+        super().__init__(daemon=True)
+        self._wait = wait
+        self._lock = threading.Lock()
+        self._vms = {}
+        self._folders = {}
+        self._synced = False
+        self._heartbeat = 0
+        self._keep_running = True
+
+    @property
+    def healthy(self):
+        """True when the index has been fully synced, and vCenter has been heard
+        from recently.
+
+        :Returns: Boolean
+        """
+        recent = (time.time() - self._heartbeat) < (self._wait * 2)
+        return self.is_alive() and self._synced and recent
+
+    def dataiq_vms(self, username):
+        """Obtain the DataIQ VMs owned by a user.
+
+        :Returns: Dictionary - mapping of VM name to moId
+
+        :param username: The user who owns the VMs
+        :type username: String
+        """
+        with self._lock:
+            folders = {x for x, y in self._folders.items() if y.get('name') == username}
+            found = {}
+            for moid, props in self._vms.items():
+                if props.get('parent') in folders and _is_dataiq(props.get('config.annotation')):
+                    found[props.get('name')] = moid
+        return found
+
+    def find(self, username, machine_name):
+        """Lookup the moId of a user's DataIQ VM.
+
+        :Returns: String or None
+
+        :param username: The user who owns the VM
+        :type username: String
+
+        :param machine_name: The name of the VM
+        :type machine_name: String
+        """
+        return self.dataiq_vms(username).get(machine_name)
+
+    def stop(self):
+        """Stop following the change feed"""
+        self._keep_running = False
+
+    def run(self):
+        """Follow the change feed, reconnecting after any failure"""
+        while self._keep_running:
+            try:
+                self._follow()
+            except Exception as doh:
+                logger.error('Live inventory feed failed: %s', doh)
+            self._synced = False
+            if self._keep_running:
+                time.sleep(self._wait)
+
+    def _follow(self):
+        """Sync the whole index, then apply changes as vCenter reports them"""
+        vcenter = vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
+                          password=const.INF_VCENTER_PASSWORD)
+        try:
+            top_dir = vcenter.get_vm_folder(const.INF_VCENTER_TOP_LVL_DIR)
+            # A private collector, so our filter doesn't collide with anyone else's
+            collector = vcenter.content.propertyCollector.CreatePropertyCollector()
+            collector.CreateFilter(_filter_spec(top_dir), partialUpdates=True)
+            options = vim.PropertyCollector.WaitOptions(maxWaitSeconds=self._wait)
+            with self._lock:
+                self._vms = {}
+                self._folders = {}
+            version = ''
+            while self._keep_running:
+                update = collector.WaitForUpdatesEx(version, options)
+                self._heartbeat = time.time()
+                if update is None:
+                    # Nothing changed within maxWaitSeconds
+                    continue
+                self._apply(update)
+                version = update.version
+                if not update.truncated:
+                    self._synced = True
+        finally:
+            vcenter.close()
+
+    def _apply(self, update):
+        """Update the index with the changes reported by vCenter
+
+        :Returns: None
+
+        :param update: The output of ``WaitForUpdatesEx``
+        :type update: vim.UpdateSet
+        """
+        with self._lock:
+            for filter_update in update.filterSet:
+                for obj_update in filter_update.objectSet:
+                    moid = obj_update.obj._moId
+                    if isinstance(obj_update.obj, vim.VirtualMachine):
+                        bucket = self._vms
+                    else:
+                        bucket = self._folders
+                    if obj_update.kind == 'leave':
+                        bucket.pop(moid, None)
+                        continue
+                    props = bucket.setdefault(moid, {})
+                    for change in obj_update.changeSet:
+                        if change.op in ('remove', 'indirectRemove'):
+                            props.pop(change.name, None)
+                        elif change.name == 'parent':
+                            props['parent'] = change.val._moId if change.val else None
+                        else:
+                            props[change.name] = change.val
+
+
+def _filter_spec(top_dir):
+    """Define the VMs and folders to follow; everything under the top level directory.
+
+    :Returns: vim.PropertyCollector.FilterSpec
+
+    :param top_dir: The top level vLab directory
+    :type top_dir: vim.Folder
+    """
+    visit_folders = vim.PropertyCollector.TraversalSpec(name='visitFolders',
+                                                        type=vim.Folder,
+                                                        path='childEntity',
+                                                        skip=False)
+    visit_folders.selectSet = [vim.PropertyCollector.SelectionSpec(name='visitFolders')]
+    obj_spec = vim.PropertyCollector.ObjectSpec(obj=top_dir, skip=False, selectSet=[visit_folders])
+    vm_props = vim.PropertyCollector.PropertySpec(type=vim.VirtualMachine,
+                                                  pathSet=['name', 'parent', 'config.annotation'])
+    folder_props = vim.PropertyCollector.PropertySpec(type=vim.Folder, pathSet=['name'])
+    return vim.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[vm_props, folder_props])
+
+
+def _is_dataiq(annotation):
+    """Check the meta data of a VM to see if it's a DataIQ machine
+
+    :Returns: Boolean
+
+    :param annotation: The raw annotation of the VM
+    :type annotation: String
+    """
+    try:
+        return ujson.loads(annotation).get('component') == 'DataIQ'
+    except (ValueError, TypeError, AttributeError):
+        return False
+
+
+def start():
+    """Start following the change feed in this process, if enabled.
+
+    :Returns: None
+    """
+    global _INVENTORY
+    if not const.VLAB_DATAIQ_LIVE_INVENTORY:
+        return
+    with _INVENTORY_LOCK:
+        if _INVENTORY is None or not _INVENTORY.is_alive():
+            _INVENTORY = LiveInventory(wait=const.VLAB_DATAIQ_INVENTORY_WAIT)
+            _INVENTORY.start()
+
+
+def get_inventory():
+    """Obtain the live inventory, but only if it can be trusted.
+
+    :Returns: LiveInventory or None
+    """
+    live = _INVENTORY
+    if live is not None and live.healthy:
+        return live
+    return None
@@ -0,0 +1,94 @@
+# -*- coding: UTF-8 -*-
+"""
+An index of the folders and networks that tasks look up by name.
+
+``vCenter.get_by_name`` and ``vCenter.get_by_type`` build a container view and
+read the name of every object in it, on every call. This index remembers what
+each name resolved to, so only the first lookup of a name (or a lookup of a
+name that's never been seen) pays for the scan.
+
+The index is kept per vCenter session, since a managed object reference is
+bound to the session that found it. A cached reference can go stale if the
+object is deleted and recreated; ``sessions`` calls ``forget`` on a session
+that raises ``ManagedObjectNotFound``, so the next lookup scans again.
+"""
+import threading
+from weakref import WeakKeyDictionary
+
+from vlab_inf_common.vmware import vim
+
+
+_INDEXES = WeakKeyDictionary()
+_LOCK = threading.Lock()
+
+
+def folder(vcenter, name):
+    """Find a folder under ``INF_VCENTER_TOP_LVL_DIR`` by name
+
+    :Returns: vim.Folder
+
+    :Raises: ValueError
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param name: The name of the folder
+    :type name: String
+    """
+    index = _index(vcenter)
+    with _LOCK:
+        found = index['folders'].get(name)
+    if found is None:
+        found = vcenter.get_by_name(name=name, vimtype=vim.Folder)
+        with _LOCK:
+            index['folders'][name] = found
+    return found
+
+
+def network(vcenter, name):
+    """Find a network by name
+
+    :Returns: vim.Network
+
+    :Raises: ValueError
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param name: The name of the network
+    :type name: String
+    """
+    index = _index(vcenter)
+    with _LOCK:
+        found = index['networks'].get(name)
+    if found is None:
+        # A miss might be a network made since the last scan, so scan again
+        networks = {x.name: x for x in vcenter.get_by_type(vim.Network)}
+        with _LOCK:
+            index['networks'] = networks
+        try:
+            found = networks[name]
+        except KeyError:
+            raise ValueError('No such network named {}'.format(name))
+    return found
+
+
+def forget(vcenter):
+    """Drop everything indexed for a session
+
+    :Returns: None
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    with _LOCK:
+        _INDEXES.pop(vcenter, None)
+
+
+def _index(vcenter):
+    """Obtain the index of a session, creating it if needed
+
+    :Returns: Dictionary
+    """
+    with _LOCK:
+        return _INDEXES.setdefault(vcenter, {'folders' : {}, 'networks' : {}})
@@ -0,0 +1,352 @@
+# -*- coding: UTF-8 -*-
+"""
+A local cache of extracted OVAs.
+
+Opening an OVA walks the whole tar archive, and every deploy then reads the
+VMDKs back out of it. Instead, each OVA is extracted once into its OVF
+descriptor and VMDK files, alongside a small manifest. Deploys stream the
+VMDKs to vCenter straight from ``mmap``'d files, so concurrent deploys share
+the page cache instead of each re-reading the tarball.
+
+An extract is keyed by the mtime and size of the OVA; replacing the OVA
+invalidates the extract made from the old file.
+"""
+import os
+import time
+import mmap
+import shutil
+import tarfile
+from threading import Timer
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen, Request
+
+import ujson
+from pyVmomi import vmodl
+from vlab_inf_common.ssl_context import get_context
+
+from vlab_dataiq_api.lib import const, images
+from vlab_dataiq_api.lib.locks import file_lock
+
+
+MANIFEST = 'manifest.json'
+# How much of a VMDK is handed to the socket at a time
+CHUNK_SIZE = 1024 * 1024
+MB = 1024 * 1024
+# vCenter expires an import lease that doesn't see progress for a few minutes
+PROGRESS_INTERVAL = 5
+
+
+def open_ova(ova_path):
+    """Obtain the extracted copy of an OVA, extracting it if needed.
+
+    :Returns: CachedOva
+
+    :Raises: ValueError
+
+    :param ova_path: The location of the OVA
+    :type ova_path: String
+    """
+    try:
+        info = os.stat(ova_path)
+    except FileNotFoundError:
+        raise ValueError('No such image {}'.format(os.path.basename(ova_path)))
+    source = {'mtime' : int(info.st_mtime), 'size' : info.st_size}
+    name = os.path.basename(ova_path)
+    extract_dir = os.path.join(_cache_root(), '{}-{}-{}'.format(name, source['mtime'], source['size']))
+    manifest_path = os.path.join(extract_dir, MANIFEST)
+    if not os.path.exists(manifest_path):
+        with file_lock('ova-cache-{}'.format(name)):
+            # Another process might have finished the extract while we waited
+            if not os.path.exists(manifest_path):
+                _extract(ova_path, name, source, extract_dir)
+    with open(manifest_path) as the_file:
+        manifest = ujson.load(the_file)
+    return CachedOva(extract_dir, manifest)
+
+
+class CachedOva(object):
+    """An extracted OVA, with the same interface as ``vlab_inf_common.vmware.Ova``
+    that ``deploy_from_ova`` uses.
+
+    :param extract_dir: The directory the OVA was extracted into
+    :type extract_dir: String
+
+    :param manifest: The manifest written when the OVA was extracted
+    :type manifest: Dictionary
+    """
+    def __init__(self, extract_dir, manifest):
+        self._extract_dir = extract_dir
+        self.manifest = manifest
+        self.upload_stats = {}
+        # Optionally called with the percent uploaded, while a deploy is running
+        self.on_progress = None
+        with open(os.path.join(extract_dir, manifest['ovf'])) as the_file:
+            self._ovf = the_file.read()
+
+    @property
+    def ovf(self):
+        """The XML that describes the OVA"""
+        return self._ovf
+
+    @property
+    def networks(self):
+        """The names of the networks the OVA is configured with"""
+        return self.manifest['networks']
+
+    @property
+    def vmdks(self):
+        """The names of the VMDK files within the OVA"""
+        return list(self.manifest['disks'].keys())
+
+    def close(self):
+        """Nothing to do; every deploy opens (and closes) its own file handles"""
+        pass
+
+    def log_upload_stats(self, logger):
+        """Log the throughput of every disk uploaded by the last deploy.
+
+        A slow disk on an otherwise fast host points at the images volume;
+        every disk slow on one host points at that host, or the network to it.
+
+        :Returns: None
+
+        :param logger: An object for logging messages
+        :type logger: logging.LoggerAdapter
+        """
+        for disk, stats in sorted(self.upload_stats.items()):
+            logger.info('Uploaded %s to %s: %s bytes in %ss (%s MB/s)', disk, stats['host'],
+                        stats['bytes'], stats['seconds'], stats['mb_per_sec'])
+
+    def deploy(self, deploy_spec, lease, host):
+        """Upload the disks of a new VM, up to ``VLAB_DATAIQ_UPLOAD_PARALLEL`` at a time.
+        The throughput of every disk is recorded in ``upload_stats``.
+
+        :Returns: None
+
+        :param deploy_spec: The OVA deployment spec
+        :type deploy_spec: vim.OvfManager.CreateImportSpecResult
+
+        :param lease: The vSphere lease that enables VM creation
+        :type lease: vim.HttpNfcLease
+
+        :param host: The FQDN of the ESXi host
+        :type host: String
+        """
+        progress = _Progress(lease, sum(self.manifest['disks'].values()), self.on_progress)
+        try:
+            uploads = [(x.path, _device_url(lease, x)) for x in deploy_spec.fileItem if x.path in self.manifest['disks']]
+            progress.start()
+            with ThreadPoolExecutor(max_workers=const.VLAB_DATAIQ_UPLOAD_PARALLEL) as executor:
+                futures = [executor.submit(self._upload_disk, disk, url, progress) for disk, url in uploads]
+                for future in futures:
+                    disk, seconds = future.result()
+                    size = self.manifest['disks'][disk]
+                    self.upload_stats[disk] = {'host' : host,
+                                               'bytes' : size,
+                                               'seconds' : round(seconds, 1),
+                                               'mb_per_sec' : round(size / MB / max(seconds, 0.001), 1)}
+            lease.Progress(100)
+            lease.Complete()
+        except vmodl.MethodFault as doh:
+            lease.Abort(doh)
+            raise
+        except Exception as doh:
+            lease.Abort(vmodl.fault.SystemError(reason=str(doh)))
+            raise
+        finally:
+            progress.stop()
+
+    def _upload_disk(self, disk, url, progress):
+        """Stream one VMDK to vCenter from a memory map of the extracted file
+
+        :Returns: Tuple (disk, seconds the upload took)
+        """
+        size = self.manifest['disks'][disk]
+        headers = {'Content-length': size,
+                   'Content-Type': 'application/x-vnd.vmware-streamVmdk'}
+        started = time.time()
+        with open(os.path.join(self._extract_dir, disk), 'rb') as the_file:
+            with mmap.mmap(the_file.fileno(), 0, access=mmap.ACCESS_READ) as the_map:
+                chunks = _chunks(the_map, progress, disk)
+                try:
+                    req = Request(url, method='POST', data=chunks, headers=headers)
+                    urlopen(req, context=get_context())
+                finally:
+                    # The map can't be closed while a slice of it still exists
+                    chunks.close()
+        return disk, time.time() - started
+
+
+class _Progress(object):
+    """Keep an import lease alive by reporting how many bytes have been uploaded
+
+    :param lease: The vSphere lease that enables VM creation
+    :type lease: vim.HttpNfcLease
+
+    :param total: The number of bytes that'll be uploaded
+    :type total: Integer
+
+    :param on_progress: Also called with the percent uploaded
+    :type on_progress: Function
+    """
+    def __init__(self, lease, total, on_progress=None):
+        self._lease = lease
+        self._total = max(total, 1)
+        self._on_progress = on_progress
+        self._timer = None
+        self._stopped = False
+        # Bytes sent, by disk. Each disk is only ever updated by the thread uploading it
+        self.sent = {}
+
+    def add(self, disk, sent):
+        """Record that more of a disk has been uploaded"""
+        self.sent[disk] = self.sent.get(disk, 0) + sent
+
+    def start(self):
+        """Begin reporting progress"""
+        self._timer = Timer(PROGRESS_INTERVAL, self._chime)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def stop(self):
+        """Stop reporting progress"""
+        self._stopped = True
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def _chime(self):
+        """Report the progress, and schedule the next report"""
+        if self._stopped:
+            return
+        # 100 means done, and is only sent once every disk is uploaded
+        percent = min(int(sum(self.sent.values()) * 100 / self._total), 99)
+        try:
+            self._lease.Progress(percent)
+        except vmodl.fault.ManagedObjectNotFound:
+            # The upload finished between the check and the report
+            return
+        if self._on_progress is not None:
+            try:
+                self._on_progress(percent)
+            except Exception:
+                # Never let reporting progress stop the lease from being kept alive
+                pass
+        self.start()
+
+
+def _chunks(the_map, progress, disk):
+    """Yield slices of a memory map, without copying the data
+
+    :Returns: Generator
+
+    :param the_map: The memory map of a VMDK
+    :type the_map: mmap.mmap
+
+    :param progress: Tracks how many bytes have been uploaded
+    :type progress: _Progress
+
+    :param disk: The name of the VMDK
+    :type disk: String
+    """
+    with memoryview(the_map) as view:
+        for offset in range(0, len(view), CHUNK_SIZE):
+            with view[offset:offset + CHUNK_SIZE] as chunk:
+                yield chunk
+                progress.add(disk, len(chunk))
+
+
+def _device_url(lease, file_item):
+    """Find the URL to upload a disk to
+
+    :Returns: String
+
+    :Raises: RuntimeError
+
+    :param lease: The vSphere lease that enables VM creation
+    :type lease: vim.HttpNfcLease
+
+    :param file_item: The disk to upload
+    :type file_item: vim.OvfManager.FileItem
+    """
+    for device_url in lease.info.deviceUrl:
+        if device_url.importKey == file_item.deviceId:
+            return device_url.url
+    raise RuntimeError('Failed to find deviceUrl for file {}'.format(file_item.path))
+
+
+def _extract(ova_path, name, source, extract_dir):
+    """Unpack an OVA and write its manifest. Extracts made from an older copy
+    of the same OVA are deleted.
+
+    :Returns: None
+
+    :param ova_path: The location of the OVA
+    :type ova_path: String
+
+    :param name: The file name of the OVA
+    :type name: String
+
+    :param source: The mtime and size of the OVA
+    :type source: Dictionary
+
+    :param extract_dir: Where to extract the OVA
+    :type extract_dir: String
+    """
+    root = _cache_root()
+    for stale in os.listdir(root):
+        if stale.startswith('{}-'.format(name)):
+            shutil.rmtree(os.path.join(root, stale), ignore_errors=True)
+    tmp_dir = '{}.{}'.format(extract_dir, os.getpid())
+    os.makedirs(tmp_dir)
+    manifest = {'source' : source, 'ovf' : None, 'networks' : [], 'disks' : {}}
+    with open(ova_path, 'rb') as raw:
+        # Stream mode reads the archive front-to-back, exactly once
+        with tarfile.open(fileobj=raw, mode='r|') as the_tar:
+            for member in the_tar:
+                file_name = os.path.basename(member.name)
+                if not member.isfile() or not file_name.endswith(('.ovf', '.vmdk')):
+                    continue
+                with open(os.path.join(tmp_dir, file_name), 'wb') as the_file:
+                    shutil.copyfileobj(the_tar.extractfile(member), the_file, CHUNK_SIZE)
+                if file_name.endswith('.ovf'):
+                    manifest['ovf'] = file_name
+                else:
+                    manifest['disks'][file_name] = member.size
+    if manifest['ovf'] is None:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise ValueError('Image {} has no OVF descriptor'.format(name))
+    manifest['sha256'] = _checksum(name, source)
+    with open(os.path.join(tmp_dir, manifest['ovf'])) as the_file:
+        manifest['networks'] = images.parse_networks(the_file.read())
+    with open(os.path.join(tmp_dir, MANIFEST), 'w') as the_file:
+        ujson.dump(manifest, the_file)
+    os.rename(tmp_dir, extract_dir)
+
+
+def _checksum(name, source):
+    """Obtain the SHA256 of an OVA from the image manifest, as a background job
+    last wrote it. Hashing the OVA here would hold up the deploy.
+
+    :Returns: String, or None if the manifest doesn't have this copy of the OVA
+
+    :param name: The file name of the OVA
+    :type name: String
+
+    :param source: The mtime and size of the OVA
+    :type source: Dictionary
+    """
+    description = images.saved().get(images.to_version(name), {})
+    if description.get('mtime') == source['mtime'] and description.get('size') == source['size']:
+        return description.get('sha256')
+    return None
+
+
+def _cache_root():
+    """The directory that holds every extracted OVA
+
+    :Returns: String
+    """
+    root = os.path.join(const.VLAB_DATAIQ_CACHE_DIR, 'ova')
+    os.makedirs(root, exist_ok=True)
+    return root
+
@@ -0,0 +1,220 @@
+# -*- coding: UTF-8 -*-
+"""
+Choose the datastore and ESXi host a new DataIQ machine is deployed to.
+
+Without placement, every deploy lands on ``INF_VCENTER_DATASTORE``. With
+``VLAB_DATAIQ_DATASTORES`` set, each deploy goes to whichever candidate has the
+most room left, is the least overcommitted, and has the fewest deploys already
+running against it. The host is the least busy one that mounts that datastore.
+
+The capacity of every candidate is read from vCenter at most once every
+``VLAB_DATAIQ_PLACEMENT_TTL`` seconds, and kept in the local cache directory.
+Running deploys are tracked there too, so every Celery process on the worker
+sees the deploys every other process has started.
+"""
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+import ujson
+from vlab_inf_common.vmware import vim
+
+from vlab_dataiq_api.lib import const
+from vlab_dataiq_api.lib.locks import file_lock, process_alive
+
+
+GB = 1024 ** 3
+# Never fill a datastore past this fraction of its capacity
+FREE_SPACE_FLOOR = 0.05
+# A deploy that's been "running" this long crashed without cleaning up
+STALE_DEPLOY = 4 * 60 * 60
+
+
+def enabled():
+    """Is there more than one place a DataIQ machine could be deployed to?
+
+    :Returns: Boolean
+    """
+    return bool(const.VLAB_DATAIQ_DATASTORES)
+
+
+@contextmanager
+def placed(vcenter, disk_size, logger):
+    """Pick where to deploy a new DataIQ machine, counting it against that
+    datastore and host for the duration of a ``with`` statement. Yields None
+    when placement isn't enabled.
+
+    :Raises: RuntimeError
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param disk_size: The number of GB the DataIQ database disk will be
+    :type disk_size: Integer
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    if not enabled():
+        yield None
+        return
+    snapshot = _snapshot(vcenter)
+    token = uuid.uuid4().hex
+    with file_lock('placement'):
+        deploys = _load_deploys()
+        decision = choose(snapshot, deploys, disk_size * GB)
+        deploys[token] = {'datastore' : decision['datastore'],
+                          'host' : decision['host'],
+                          'bytes' : disk_size * GB,
+                          'pid' : os.getpid(),
+                          'started' : time.time()}
+        _save_deploys(deploys)
+    logger.info('Placing on datastore %s and host %s (score %s)', decision['datastore'],
+                decision['host'], decision['score'])
+    try:
+        yield decision
+    finally:
+        with file_lock('placement'):
+            deploys = _load_deploys()
+            deploys.pop(token, None)
+            _save_deploys(deploys)
+
+
+def choose(snapshot, deploys, needed):
+    """Score every candidate datastore, and pick the best datastore and host.
+
+    A datastore is skipped if the new VM would push it past ``FREE_SPACE_FLOOR``
+    or past ``VLAB_DATAIQ_MAX_PROVISIONED``. The rest are scored by the fraction
+    of space left over, divided by how overcommitted they'd be, and by one plus
+    the number of deploys already running against them.
+
+    :Returns: Dictionary
+
+    :Raises: RuntimeError
+
+    :param snapshot: The capacity of every candidate, from ``_snapshot``
+    :type snapshot: Dictionary
+
+    :param deploys: The deploys that are running, from ``_load_deploys``
+    :type deploys: Dictionary
+
+    :param needed: The number of bytes the new VM needs
+    :type needed: Integer
+    """
+    best = None
+    for name, store in snapshot['datastores'].items():
+        running = [x for x in deploys.values() if x['datastore'] == name]
+        capacity = max(store['capacity'], 1)
+        free_after = store['free'] - sum(x['bytes'] for x in running) - needed
+        if free_after < capacity * FREE_SPACE_FLOOR:
+            continue
+        provisioned = (capacity - free_after + store['uncommitted']) / capacity
+        if provisioned > const.VLAB_DATAIQ_MAX_PROVISIONED:
+            continue
+        host = _choose_host(snapshot['hosts'], store['hosts'], deploys)
+        if host is None:
+            continue
+        score = round((free_after / capacity) / (max(provisioned, 0.01) * (1 + len(running))), 4)
+        if best is None or score > best['score']:
+            best = {'datastore' : name,
+                    'host' : host,
+                    'score' : score,
+                    'free_gb' : int(free_after / GB),
+                    'provisioned_ratio' : round(provisioned, 2),
+                    'deploys' : len(running)}
+    if best is None:
+        error = 'No datastore has room for {} GB more'.format(int(needed / GB))
+        raise RuntimeError(error)
+    return best
+
+
+def _choose_host(hosts, mounted_by, deploys):
+    """Pick the host with the fewest running deploys, then the most free RAM
+
+    :Returns: String or None if no usable host mounts the datastore
+    """
+    usable = [x for x in mounted_by if hosts.get(x, {}).get('usable')]
+    if not usable:
+        return None
+    running = lambda host: len([x for x in deploys.values() if x['host'] == host])
+    return min(usable, key=lambda x: (running(x), hosts[x]['memory_used'], x))
+
+
+def _snapshot(vcenter):
+    """Obtain the capacity of every candidate datastore, and the state of every
+    host; reading it from vCenter if the cached copy is too old.
+
+    :Returns: Dictionary
+    """
+    path = os.path.join(const.VLAB_DATAIQ_CACHE_DIR, 'placement.json')
+    try:
+        if time.time() - os.stat(path).st_mtime < const.VLAB_DATAIQ_PLACEMENT_TTL:
+            with open(path) as the_file:
+                return ujson.load(the_file)
+    except (OSError, ValueError):
+        pass
+    snapshot = {'datastores' : {}, 'hosts' : {}}
+    candidates = set(const.VLAB_DATAIQ_DATASTORES)
+    # A candidate can be a datastore cluster, which means every datastore in it
+    for pod in vcenter.get_by_type(vim.StoragePod):
+        if pod.name in candidates:
+            candidates.update(x.name for x in pod.childEntity)
+    for datastore in vcenter.get_by_type(vim.Datastore):
+        if datastore.name not in candidates:
+            continue
+        summary = datastore.summary
+        if not summary.accessible or summary.maintenanceMode not in (None, 'normal'):
+            continue
+        snapshot['datastores'][datastore.name] = {'capacity' : summary.capacity,
+                                                  'free' : summary.freeSpace,
+                                                  'uncommitted' : summary.uncommitted or 0,
+                                                  'hosts' : [x.key.name for x in datastore.host if x.mountInfo.accessible]}
+    for host in vcenter.get_by_type(vim.HostSystem):
+        summary = host.summary
+        memory_mb = max(summary.hardware.memorySize / 1024 / 1024, 1)
+        snapshot['hosts'][host.name] = {'usable' : summary.runtime.connectionState == 'connected' and not summary.runtime.inMaintenanceMode,
+                                        'memory_used' : round(summary.quickStats.overallMemoryUsage / memory_mb, 3)}
+    os.makedirs(const.VLAB_DATAIQ_CACHE_DIR, exist_ok=True)
+    tmp_path = '{}.{}'.format(path, os.getpid())
+    with open(tmp_path, 'w') as the_file:
+        ujson.dump(snapshot, the_file)
+    os.replace(tmp_path, path)
+    return snapshot
+
+
+def _load_deploys():
+    """Read the deploys that are running, dropping any left behind by a crash.
+    Must be called while holding the ``placement`` lock.
+
+    :Returns: Dictionary
+    """
+    try:
+        with open(_deploys_path()) as the_file:
+            deploys = ujson.load(the_file)
+    except (OSError, ValueError):
+        return {}
+    now = time.time()
+    return {k: v for k, v in deploys.items() if now - v['started'] < STALE_DEPLOY and process_alive(v['pid'])}
+
+
+def _save_deploys(deploys):
+    """Write the deploys that are running. Must be called while holding the
+    ``placement`` lock.
+
+    :Returns: None
+    """
+    tmp_path = '{}.{}'.format(_deploys_path(), os.getpid())
+    with open(tmp_path, 'w') as the_file:
+        ujson.dump(deploys, the_file)
+    os.replace(tmp_path, _deploys_path())
+
+
+def _deploys_path():
+    """The file that tracks running deploys
+
+    :Returns: String
+    """
+    os.makedirs(const.VLAB_DATAIQ_CACHE_DIR, exist_ok=True)
+    return os.path.join(const.VLAB_DATAIQ_CACHE_DIR, 'placement-deploys.json')
+
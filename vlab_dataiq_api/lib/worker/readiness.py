@@ -0,0 +1,144 @@
+# -*- coding: UTF-8 -*-
+"""
+Block until the guest OS of a VM can be used (or has an IP), by following
+property updates from vCenter instead of sleeping for a fixed amount of time.
+"""
+import time
+
+from vlab_inf_common.vmware import vim
+
+
+GUEST_PROPERTIES = ['guest.toolsRunningStatus', 'guest.guestOperationsReady']
+# The longest a single WaitForUpdatesEx call blocks before the deadline is checked again
+MAX_WAIT_SECONDS = 30
+
+
+def wait_for_guest(vcenter, the_vm, timeout=1200, rebooted=None):
+    """Block until VMware Tools is running and guest operations are available.
+
+    Watching for the guest to go down isn't a reliable sign of a reboot; a
+    fast reboot can finish between updates, and ``runtime.bootTime`` only
+    changes when the VM is powered on. So after a reboot, the caller supplies
+    ``rebooted`` to check from inside the guest (i.e. for a marker file).
+
+    :Returns: None
+
+    :Raises: RuntimeError
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_vm: The VM to wait on
+    :type the_vm: vim.VirtualMachine
+
+    :param timeout: How many seconds to wait for the guest
+    :type timeout: Integer
+
+    :param rebooted: After telling the guest to reboot, a function that's
+                     called whenever the guest looks ready, and returns True
+                     once the guest has come back up.
+    :type rebooted: Function
+    """
+    def done(state):
+        if not _is_ready(state):
+            return False
+        return rebooted is None or rebooted()
+
+    error = 'Guest OS of VM {} not ready within {} seconds'.format(the_vm._moId, timeout)
+    _wait(vcenter, the_vm, GUEST_PROPERTIES, done, timeout, error)
+
+
+def wait_for_ip(vcenter, the_vm, timeout=600):
+    """Block until the guest OS reports an IP that isn't IPv6 link local.
+
+    :Returns: None
+
+    :Raises: RuntimeError
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_vm: The VM to wait on
+    :type the_vm: vim.VirtualMachine
+
+    :param timeout: How many seconds to wait for an IP
+    :type timeout: Integer
+    """
+    def done(state):
+        ips = [x for nic in state.get('guest.net') or [] for x in nic.ipAddress]
+        return any(not x.startswith('fe80::') for x in ips)
+
+    error = 'Unable to obtain an IP within {} seconds'.format(timeout)
+    _wait(vcenter, the_vm, ['guest.net'], done, timeout, error)
+
+
+def _wait(vcenter, the_vm, properties, done, timeout, error):
+    """Follow changes to the properties of a VM until ``done`` says to stop.
+
+    :Returns: None
+
+    :Raises: RuntimeError
+
+    :param properties: The properties to follow
+    :type properties: List
+
+    :param done: Called with the latest value of every property after each
+                 change, and every ``MAX_WAIT_SECONDS`` without a change;
+                 returns True once there's nothing left to wait for
+    :type done: Function
+
+    :param error: The message to raise if the timeout expires
+    :type error: String
+    """
+    deadline = time.time() + timeout
+    # A private collector, so our filter doesn't collide with anyone else's
+    collector = vcenter.content.propertyCollector.CreatePropertyCollector()
+    try:
+        obj_spec = vim.PropertyCollector.ObjectSpec(obj=the_vm, skip=False)
+        prop_spec = vim.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=properties)
+        filter_spec = vim.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+        collector.CreateFilter(filter_spec, partialUpdates=False)
+        state = {}
+        version = ''
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise RuntimeError(error)
+            options = vim.PropertyCollector.WaitOptions(maxWaitSeconds=int(min(remaining, MAX_WAIT_SECONDS)) or 1)
+            update = collector.WaitForUpdatesEx(version, options)
+            # None means nothing changed within maxWaitSeconds; ``done`` might
+            # depend on more than the properties, so it's still checked
+            if update is not None:
+                version = update.version
+                state.update(_changes(update))
+            if state and done(state):
+                return
+    finally:
+        collector.DestroyPropertyCollector()
+
+
+def _changes(update):
+    """Flatten a ``WaitForUpdatesEx`` response into property names and values.
+
+    :Returns: Dictionary
+
+    :param update: The response from ``WaitForUpdatesEx``
+    :type update: vmodl.query.PropertyCollector.UpdateSet
+    """
+    changes = {}
+    for filter_update in update.filterSet:
+        for obj_update in filter_update.objectSet:
+            for change in obj_update.changeSet:
+                changes[change.name] = change.val
+    return changes
+
+
+def _is_ready(state):
+    """Check if the guest can be used, based on the latest property values.
+
+    :Returns: Boolean
+
+    :param state: The latest value of every property in ``GUEST_PROPERTIES``
+    :type state: Dictionary
+    """
+    return state.get('guest.toolsRunningStatus') == 'guestToolsRunning' and bool(state.get('guest.guestOperationsReady'))
@@ -0,0 +1,212 @@
+# -*- coding: UTF-8 -*-
+"""
+A per-process pool of authenticated vCenter sessions.
+
+Logging into vCenter is a handful of SOAP round trips, which dwarfs the work
+done by short tasks like ``dataiq.show``. Pooling the sessions lets every task
+after the first one reuse an already-authenticated connection.
+"""
+import os
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+
+from vlab_api_common import get_logger
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vCenter, vim
+
+from vlab_dataiq_api.lib import const, metrics
+from vlab_dataiq_api.lib.worker import lookups
+
+
+logger = get_logger(__name__, loglevel=const.VLAB_DATAIQ_LOG_LEVEL)
+
+_POOL = None
+_POOL_PID = None
+_POOL_LOCK = threading.Lock()
+
+
+class SessionPool(object):
+    """Hands out connections to vCenter, logging in only when there's no idle
+    session to reuse.
+
+    :param max_sessions: The most sessions this process can have open at once.
+    :type max_sessions: Integer
+
+    :param keepalive: How many seconds a session can sit idle before the background
+                      keepalive thread pings vCenter, so vCenter doesn't expire it.
+                      Set to zero to disable the keepalive thread.
+    :type keepalive: Integer
+    """
+    def __init__(self, max_sessions, keepalive):
+        self._keepalive = keepalive
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_sessions)
+        self._closed = False
+        self.stats = {'hits': 0, 'misses': 0, 'relogins': 0, 'discards': 0}
+        if keepalive:
+            self._chime_keepalive()
+
+    @contextmanager
+    def connection(self):
+        """Check out a session for the duration of a ``with`` statement.
+
+        A session that raises ``NotAuthenticated`` is thrown away instead of being
+        returned to the pool, so the next checkout logs in again.
+        """
+        self._slots.acquire()
+        try:
+            vcenter = self._checkout()
+            healthy = True
+            try:
+                yield vcenter
+            except vim.fault.NotAuthenticated:
+                healthy = False
+                raise
+            except vmodl.fault.ManagedObjectNotFound:
+                # Something looked up by name was deleted; look it up again next time
+                lookups.forget(vcenter)
+                raise
+            finally:
+                if healthy:
+                    self._checkin(vcenter)
+                else:
+                    self._discard(vcenter)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Logout of every idle session."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for vcenter, _ in idle:
+            self._logout(vcenter)
+
+    def _checkout(self):
+        """Obtain an authenticated session, logging in only if needed. An idle
+        session is always checked first; vCenter can end a session at any time,
+        i.e. when it restarts, and a task shouldn't fail with NotAuthenticated
+        just because it was handed a dead session.
+
+        :Returns: vlab_inf_common.vmware.vCenter
+        """
+        with self._lock:
+            vcenter, _ = self._idle.pop() if self._idle else (None, 0)
+        if vcenter is None:
+            self._count('misses')
+            return _login()
+        if not _is_alive(vcenter):
+            self._count('relogins')
+            self._logout(vcenter)
+            return _login()
+        self._count('hits')
+        return vcenter
+
+    def _checkin(self, vcenter):
+        """Return a session to the pool"""
+        with self._lock:
+            if not self._closed:
+                self._idle.append((vcenter, time.time()))
+                return
+        self._logout(vcenter)
+
+    def _discard(self, vcenter):
+        """Throw away a session that's no longer usable"""
+        self._count('discards')
+        self._logout(vcenter)
+
+    def _count(self, event):
+        """Record a hit, miss, relogin or discard, for the logs and for Prometheus"""
+        self.stats[event] += 1
+        metrics.SESSION_POOL_EVENTS.labels(event=event).inc()
+        logger.debug('Session pool %s: %s', event, self.stats)
+
+    def _logout(self, vcenter):
+        """Close a session, ignoring errors from an already-dead session"""
+        try:
+            vcenter.close()
+        except Exception as doh:
+            logger.debug('Ignoring error while closing session: %s', doh)
+
+    def _chime_keepalive(self):
+        """Schedule the next keepalive"""
+        timer = threading.Timer(self._keepalive, self._timer)
+        timer.daemon = True
+        timer.start()
+
+    def _timer(self):
+        """Ping the idle sessions so vCenter doesn't expire them, dropping any
+        session that's already dead.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            idle, self._idle = self._idle, []
+        now = time.time()
+        alive = []
+        for vcenter, last_used in idle:
+            if now - last_used < self._keepalive:
+                alive.append((vcenter, last_used))
+            elif _is_alive(vcenter):
+                alive.append((vcenter, now))
+            else:
+                self._discard(vcenter)
+        with self._lock:
+            self._idle.extend(alive)
+        self._chime_keepalive()
+
+
+def _login():
+    """Create a new session to vCenter
+
+    :Returns: vlab_inf_common.vmware.vCenter
+    """
+    return vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
+                   password=const.INF_VCENTER_PASSWORD)
+
+
+def _is_alive(vcenter):
+    """Check (and refresh the idle timer of) a session
+
+    :Returns: Boolean
+
+    :param vcenter: The session to check
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    try:
+        return vcenter.content.sessionManager.currentSession is not None
+    except vim.fault.NotAuthenticated:
+        return False
+    except Exception as doh:
+        logger.debug('Session health check failed: %s', doh)
+        return False
+
+
+def get_pool():
+    """Obtain the session pool for the current process.
+
+    Celery forks its worker processes, and a SOAP connection cannot be shared
+    between processes, so every process gets its own pool.
+
+    :Returns: SessionPool
+    """
+    global _POOL, _POOL_PID
+    with _POOL_LOCK:
+        if _POOL is None or _POOL_PID != os.getpid():
+            _POOL = SessionPool(max_sessions=const.VLAB_DATAIQ_MAX_SESSIONS,
+                                keepalive=const.VLAB_DATAIQ_SESSION_KEEPALIVE)
+            _POOL_PID = os.getpid()
+            atexit.register(_POOL.close)
+        return _POOL
+
+
+def vcenter_session():
+    """Check out a pooled session to vCenter. Use it in a ``with`` statement,
+    just like ``vlab_inf_common.vmware.vCenter``.
+
+    :Returns: contextlib.GeneratorContextManager
+    """
+    return get_pool().connection()
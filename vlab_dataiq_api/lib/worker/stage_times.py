@@ -0,0 +1,82 @@
+# -*- coding: UTF-8 -*-
+"""
+How long each stage of creating DataIQ usually takes, for estimating how long
+a create has left.
+
+The durations are a moving average kept in the local cache directory, so every
+Celery process on the worker learns from every create.
+"""
+import os
+
+import ujson
+
+from vlab_dataiq_api.lib import const
+from vlab_dataiq_api.lib.locks import file_lock
+
+
+# How much the latest duration counts toward the average
+WEIGHT = 0.3
+
+
+def record(stage, seconds):
+    """Update the average duration of a stage.
+
+    :Returns: None
+
+    :param stage: The name of the stage
+    :type stage: String
+
+    :param seconds: How long the stage took
+    :type seconds: Float
+    """
+    with file_lock('stage-times'):
+        durations = _load()
+        average = durations.get(stage)
+        if average is None:
+            durations[stage] = seconds
+        else:
+            durations[stage] = (WEIGHT * seconds) + ((1 - WEIGHT) * average)
+        tmp_path = '{}.{}'.format(_path(), os.getpid())
+        with open(tmp_path, 'w') as the_file:
+            ujson.dump(durations, the_file)
+        os.replace(tmp_path, _path())
+
+
+def estimate(stages, in_stage=0):
+    """Estimate how many seconds are left, given the stages that haven't finished.
+
+    :Returns: Integer or None if there's no history for one of the stages
+
+    :param stages: The current stage, followed by every stage after it
+    :type stages: List
+
+    :param in_stage: How many seconds have been spent in the current stage
+    :type in_stage: Float
+    """
+    durations = _load()
+    try:
+        current = max(durations[stages[0]] - in_stage, 0)
+        return int(current + sum(durations[x] for x in stages[1:]))
+    except (KeyError, IndexError):
+        return None
+
+
+def _load():
+    """Read the average duration of every stage
+
+    :Returns: Dictionary
+    """
+    try:
+        with open(_path()) as the_file:
+            return ujson.load(the_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _path():
+    """The file that stores the durations
+
+    :Returns: String
+    """
+    os.makedirs(const.VLAB_DATAIQ_CACHE_DIR, exist_ok=True)
+    return os.path.join(const.VLAB_DATAIQ_CACHE_DIR, 'stage-times.json')
@@ -2,17 +2,77 @@
 """
 Entry point logic for available backend worker tasks
 """
-from celery import Celery
+import os
+import time
+
+from celery import Celery, chain, group
+from celery.app.task import Context
+from celery.utils import uuid
+from celery.signals import (worker_init, worker_process_init, worker_process_shutdown,
+                            task_prerun, task_postrun)
 from vlab_api_common import get_task_logger
 
-from vlab_dataiq_api.lib import const
-from vlab_dataiq_api.lib.worker import vmware
+from vlab_dataiq_api.lib import const, images, metrics, queues
+from vlab_dataiq_api.lib.worker import vmware, cache, inventory, warm_pool
 
 app = Celery('dataiq', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+queues.configure(app)
+queues.configure_worker(app, const.VLAB_DATAIQ_WORKER_TYPE)
+# Tops up the warm pools, and keeps the image manifest up to date, when running
+# a worker with ``celery beat`` (i.e. ``-B``)
+app.conf.beat_schedule = {'refill-pool-{}'.format(x): {'task': 'dataiq.refill_pool',
+                                                       'schedule': 600,
+                                                       'args': (x, 'beat')}
+                          for x in const.VLAB_DATAIQ_WARM_POOL_IMAGES if const.VLAB_DATAIQ_WARM_POOL_SIZE}
+app.conf.beat_schedule['index-images'] = {'task': 'dataiq.index_images',
+                                          'schedule': const.VLAB_DATAIQ_IMAGE_MANIFEST_TTL,
+                                          'args': ('beat',)}
+
+
+@worker_process_init.connect
+def start_live_inventory(**kwargs):
+    """Threads don't survive a fork, so every worker process starts its own feed"""
+    inventory.start()
+
+
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    """The main worker process serves the metrics of every pool process"""
+    metrics.setup()
+    # Before the pool processes are forked, so they all count their calls
+    metrics.count_vcenter_calls()
+    metrics.start_exporter(const.VLAB_DATAIQ_METRICS_PORT)
+
+
+@worker_process_shutdown.connect
+def forget_process_metrics(**kwargs):
+    """Discard the live samples of a pool process that's exiting"""
+    metrics.process_exited(os.getpid())
+
+
+# When each running task started, by task id
+_STARTED = {}
+
+
+@task_prerun.connect
+def start_task_timer(task_id=None, task=None, **kwargs):
+    """Record how long a task was queued, and start timing it"""
+    _STARTED[task_id] = time.time()
+    sent_at = getattr(task.request, 'sent_at', None)
+    if sent_at is not None:
+        metrics.QUEUE_WAIT_SECONDS.labels(task=task.name).observe(max(_STARTED[task_id] - sent_at, 0))
+
+
+@task_postrun.connect
+def observe_task_time(task_id=None, task=None, state=None, **kwargs):
+    """Record how long a task ran"""
+    started = _STARTED.pop(task_id, None)
+    if started is not None:
+        metrics.TASK_SECONDS.labels(task=task.name, state=state).observe(time.time() - started)
 
 
 @app.task(name='dataiq.show', bind=True)
-def show(self, username, txn_id):
+def show(self, username, txn_id, fresh=False):
     """Obtain basic information about DataIQ
 
     :Returns: Dictionary
@@ -22,12 +82,21 @@ def show(self, username, txn_id):
 
     :param txn_id: A unique string supplied by the client to track the call through logs
     :type txn_id: String
+
+    :param fresh: Set to True to ignore the cached inventory and scan vCenter
+    :type fresh: Boolean
     """
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_DATAIQ_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        info = vmware.show_dataiq(username)
+        info = None if fresh else cache.get(username)
+        if info is None:
+            started = time.time()
+            info = vmware.show_dataiq(username)
+            cache.put(username, info, started)
+        else:
+            logger.debug('Using cached inventory')
     except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
@@ -50,7 +119,7 @@ def create(self, username, machine_name, image, network, static_ip, default_gate
     :param machine_name: The name of the new instance of DataIQ
     :type machine_name: String
 
-    :param image: The image/version of DataIQ to create
+    :param image: The image/version of DataIQ to create, or ``latest``
     :type image: String
 
     :param network: The name of the network to connect the new DataIQ instance up to
@@ -77,6 +146,73 @@ def create(self, username, machine_name, image, network, static_ip, default_gate
     :param ram: The number of GB of RAM to allocate to the VM
     :type ram: Integer
 
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_DATAIQ_LOG_LEVEL.upper())
+    logger.info('Task starting')
+    try:
+        # Resolved once, so every stage deploys and records the same version
+        image = images.resolve(image)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        return {'content' : {}, 'error': '{}'.format(doh), 'params': {}}
+    spec = {'username' : username,
+            'machine_name' : machine_name,
+            'image' : image,
+            'network' : network,
+            'static_ip' : static_ip,
+            'default_gateway' : default_gateway,
+            'netmask' : netmask,
+            'dns' : dns,
+            'disk_size' : disk_size,
+            'cpu_count' : cpu_count,
+            'ram' : ram}
+    # So a client polling the task sees it's been picked up
+    self.update_state(state='PROGRESS', meta={'stage': 'queued'})
+    # The last stage inherits the task id, so the caller gets the result of the whole chain
+    return self.replace(_create_chain(self, spec, vmware.CREATE_STAGES, txn_id))
+
+
+@app.task(name='dataiq.bulk_create', bind=True)
+def bulk_create(self, username, machines, image, network, default_gateway, netmask,
+                dns, disk_size, cpu_count, ram, txn_id):
+    """Deploy many identical instances of DataIQ, as a group of ``dataiq.create``
+    tasks. The machines are split into ``VLAB_DATAIQ_BULK_PARALLEL`` chains, so
+    at most that many are created at the same time.
+
+    :Returns: Dictionary, with the task id of every machine
+
+    :param username: The name of the user who wants to create the DataIQ machines
+    :type username: String
+
+    :param machines: The name and IPv4 address of every new machine
+    :type machines: List of (name, static IP) pairs
+
+    :param image: The image/version of DataIQ to create, or ``latest``
+    :type image: String
+
+    :param network: The name of the network to connect the new DataIQ machines up to
+    :type network: String
+
+    :param default_gateway: The IPv4 address of the network gateway
+    :type default_gateway: String
+
+    :param netmask: The subnet mask of the network, i.e. 255.255.255.0
+    :type netmask: String
+
+    :param dns: A list of DNS servers to use.
+    :type dns: List
+
+    :param disk_size: The number of GB to allocate for the DataIQ database
+    :type disk_size: Integer
+
+    :param cpu_count: The number of CPU cores to allocate to each machine
+    :type cpu_count: Integer
+
+    :param ram: The number of GB of RAM to allocate to each machine
+    :type ram: Integer
+
     :param txn_id: A unique string supplied by the client to track the call through logs
     :type txn_id: String
     """
@@ -84,25 +220,183 @@ def create(self, username, machine_name, image, network, static_ip, default_gate
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
     try:
-        resp['content'] = vmware.create_dataiq(username,
-                                               machine_name,
-                                               image,
-                                               network,
-                                               static_ip,
-                                               default_gateway,
-                                               netmask,
-                                               dns,
-                                               disk_size,
-                                               cpu_count,
-                                               ram,
-                                               logger)
-    except (ValueError, RuntimeError) as doh:
+        # Resolved once, so every machine is the same version
+        image = images.resolve(image)
+        vmware.check_image(image)
+    except ValueError as doh:
         logger.error('Task failed: {}'.format(doh))
         resp['error'] = '{}'.format(doh)
+        return resp
+    task_ids = {}
+    lanes = []
+    for lane in _bulk_lanes(machines, const.VLAB_DATAIQ_BULK_PARALLEL):
+        signatures = []
+        for machine_name, static_ip in lane:
+            task_ids[machine_name] = uuid()
+            signature = create.si(username, machine_name, image, network, static_ip, default_gateway,
+                                  netmask, dns, disk_size, cpu_count, ram, txn_id)
+            # With the rpc:// backend, results go to whoever is waiting on them
+            signature.set(task_id=task_ids[machine_name], reply_to=self.request.reply_to)
+            signatures.append(signature)
+        lanes.append(chain(*signatures))
+    # The rpc:// backend can't save a group, so the API tracks the machines by their task ids
+    group(lanes).apply_async()
+    logger.info('Dispatched %s creates in %s chains', len(task_ids), len(lanes))
+    resp['content'] = {'tasks': task_ids}
     logger.info('Task complete')
     return resp
 
 
+def _bulk_lanes(machines, parallel):
+    """Split the machines of a bulk create into chains that run side by side
+
+    :Returns: List of lists
+
+    :param machines: The name and IPv4 address of every new machine
+    :type machines: List of (name, static IP) pairs
+
+    :param parallel: The most machines to create at the same time
+    :type parallel: Integer
+    """
+    parallel = max(parallel, 1)
+    return [machines[x::parallel] for x in range(min(parallel, len(machines)))]
+
+
+@app.task(name='dataiq.resume', bind=True)
+def resume(self, username, machine_name, txn_id):
+    """Finish creating a DataIQ machine, starting from the first stage that didn't complete
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who owns the DataIQ machine
+    :type username: String
+
+    :param machine_name: The name of the DataIQ machine
+    :type machine_name: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_DATAIQ_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        spec, stages = vmware.resume_plan(username, machine_name)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+        return resp
+    logger.info('Resuming at stage %s', stages[0])
+    return self.replace(_create_chain(self, spec, stages, txn_id))
+
+
+@app.task(name='dataiq.create_stage', bind=True)
+def create_stage(self, resp, stage, spec, txn_id, status_id):
+    """Run one stage of creating DataIQ, as part of a chain. Once a stage fails,
+    the stages after it just pass the error along.
+
+    While running, the stage reports its progress as the ``PROGRESS`` state of
+    the task the client is polling, ``status_id``.
+
+    :Returns: Dictionary
+
+    :param resp: The result of the previous stage
+    :type resp: Dictionary
+
+    :param stage: The name of the stage to run
+    :type stage: String
+
+    :param spec: The parameters of the create
+    :type spec: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+
+    :param status_id: The id of the ``dataiq.create`` task the chain replaced
+    :type status_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_DATAIQ_LOG_LEVEL.upper())
+    if resp['error'] is None:
+        logger.info('Stage %s starting', stage)
+        # The rpc backend routes a state update by the correlation id of the
+        # request, and uploads report progress from a thread that has no request.
+        # Not the root id; in a bulk create, that's the ``dataiq.bulk_create`` task.
+        status_request = Context(reply_to=self.request.reply_to, correlation_id=status_id)
+
+        def progress(info):
+            self.backend.store_result(status_request.correlation_id, info, 'PROGRESS', request=status_request)
+
+        try:
+            info = vmware.create_stage(stage, spec, logger, progress=progress)
+        # Any exception would break the chain, and the caller would never get a result
+        except Exception as doh:
+            logger.error('Task failed: {}'.format(doh))
+            resp['error'] = '{}'.format(doh)
+        else:
+            if info:
+                resp['content'] = info
+            logger.info('Stage %s complete', stage)
+    if stage == vmware.CREATE_STAGES[-1]:
+        # Even a failed create can leave a VM behind
+        cache.invalidate(spec['username'])
+        if warm_pool.enabled(spec['image']):
+            refill_pool.delay(spec['image'], txn_id)
+        logger.info('Task complete')
+    return resp
+
+
+def _create_chain(task, spec, stages, txn_id):
+    """Build the chain of stage tasks that creates DataIQ
+
+    :Returns: celery.canvas.chain
+
+    :param task: The task being replaced by the chain
+    :type task: celery.Task
+
+    :param spec: The parameters of the create
+    :type spec: Dictionary
+
+    :param stages: The stages to run, in order
+    :type stages: List
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    signatures = [create_stage.s(resp, stages[0], spec, txn_id, task.request.id)]
+    # Every stage after the first gets the result of the stage before it
+    signatures += [create_stage.s(x, spec, txn_id, task.request.id) for x in stages[1:]]
+    for signature in signatures:
+        # With the rpc:// backend, results go to whoever is waiting on them
+        signature.set(reply_to=task.request.reply_to)
+    return chain(*signatures)
+
+
+@app.task(name='dataiq.refill_pool', bind=True, ignore_result=True)
+def refill_pool(self, image, txn_id):
+    """Provision DataIQ machines until the warm pool of an image is full
+
+    :Returns: Dictionary
+
+    :param image: The image/version of DataIQ
+    :type image: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_DATAIQ_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        resp['content'] = {'provisioned': vmware.refill_warm_pool(image, logger)}
+    except (ValueError, RuntimeError) as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        logger.info('Task complete')
+    return resp
+
+
 @app.task(name='dataiq.delete', bind=True)
 def delete(self, username, machine_name, txn_id):
     """Destroy an instance of DataIQ
@@ -128,21 +422,114 @@ def delete(self, username, machine_name, txn_id):
         resp['error'] = '{}'.format(doh)
     else:
         logger.info('Task complete')
+    finally:
+        cache.invalidate(username)
+    return resp
+
+
+@app.task(name='dataiq.bulk_delete', bind=True)
+def bulk_delete(self, username, machine_names, txn_id):
+    """Destroy many instances of DataIQ at once
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to delete the DataIQ machines
+    :type username: String
+
+    :param machine_names: The machines to delete, or None to delete all of the user's DataIQ machines
+    :type machine_names: List
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_DATAIQ_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        deleted, errors = vmware.delete_many(username, machine_names, logger)
+    except ValueError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        resp['content'] = {'deleted' : deleted}
+        if errors:
+            failures = ', '.join('{}: {}'.format(x, errors[x]) for x in sorted(errors))
+            resp['error'] = 'Failed to delete {} machines; {}'.format(len(errors), failures)
+        logger.info('Task complete')
+    finally:
+        cache.invalidate(username)
     return resp
 
 
 @app.task(name='dataiq.image', bind=True)
-def image(self, txn_id):
+def image(self, txn_id, prefix=None, latest=False):
     """Obtain a list of available images/versions of DataIQ that can be created
 
     :Returns: Dictionary
 
     :param txn_id: A unique string supplied by the client to track the call through logs
     :type txn_id: String
+
+    :param prefix: Only list versions that start with this, i.e. ``1.2``
+    :type prefix: String
+
+    :param latest: Set to True to only list the newest version
+    :type latest: Boolean
     """
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_DATAIQ_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error': None, 'params': {}}
     logger.info('Task starting')
-    resp['content'] = {'image': vmware.list_images()}
+    resp['content'] = {'image': vmware.list_images(prefix=prefix, latest=latest)}
     logger.info('Task complete')
     return resp
+
+
+@app.task(name='dataiq.index_images', bind=True, ignore_result=True)
+def index_images(self, txn_id):
+    """Refresh the image manifest, describing any OVA that's new or changed.
+    That means hashing the whole OVA, so it's only done in the background.
+
+    :Returns: Dictionary
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_DATAIQ_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        resp['content'] = {'image': images.select(images.manifest().keys())}
+    except OSError as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        logger.info('Task complete')
+    return resp
+
+
+@app.task(name='dataiq.bake', bind=True)
+def bake(self, image, txn_id):
+    """Create a new image of DataIQ with the GUI and RDP already installed.
+
+    Bake an image from the worker with:
+    ``celery -A tasks call dataiq.bake --args='["1.0.0", "some-txn-id"]'``
+
+    :Returns: Dictionary
+
+    :param image: The image/version of DataIQ to bake
+    :type image: String
+
+    :param txn_id: A unique string supplied by the client to track the call through logs
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_DATAIQ_LOG_LEVEL.upper())
+    resp = {'content' : {}, 'error': None, 'params': {}}
+    logger.info('Task starting')
+    try:
+        resp['content'] = {'image': vmware.bake_image(image, logger)}
+    except (ValueError, RuntimeError, OSError) as doh:
+        logger.error('Task failed: {}'.format(doh))
+        resp['error'] = '{}'.format(doh)
+    else:
+        logger.info('Task complete')
+    return resp
@@ -0,0 +1,317 @@
+# -*- coding: UTF-8 -*-
+"""
+Linked-clone deployments of DataIQ.
+
+The first create of an image deploys the OVA once into a template VM and
+snapshots it. Every create after that is a linked clone of the snapshot, which
+takes seconds instead of the many minutes it takes to upload the OVA.
+"""
+import os
+import re
+import time
+
+import ujson
+from vlab_inf_common.vmware import vim, virtual_machine, consume_task
+
+from vlab_dataiq_api.lib import const
+from vlab_dataiq_api.lib.locks import file_lock
+from vlab_dataiq_api.lib.worker import lookups, ova_cache
+
+
+SNAPSHOT_NAME = 'linked-clone-base'
+# A template is renamed to <name>-retired-<timestamp> when its OVA changes
+RETIRED_MARK = '-retired-'
+# How many seconds a retired template is kept, at least
+RETIRED_GRACE = 60 * 60
+# The kinds of files in vim.vm.FileLayoutEx that hold the contents of a disk
+DISK_FILE_TYPES = ('diskDescriptor', 'diskExtent')
+# Same rule deploy_from_ova enforces; the name becomes the hostname
+HOSTNAME_REGEX = r'^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])$'
+
+
+def clone_from_template(vcenter, image, ova_path, network, username, machine_name, logger, location=None):
+    """Create a new, powered off, DataIQ machine as a linked clone of the image's template.
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of DataIQ to create
+    :type image: String
+
+    :param ova_path: The location of the OVA for the image
+    :type ova_path: String
+
+    :param network: The network to connect the new DataIQ instance up to
+    :type network: vim.Network
+
+    :param username: The name of the user who wants to create a new DataIQ
+    :type username: String
+
+    :param machine_name: The name of the new instance of DataIQ
+    :type machine_name: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param location: The datastore and host picked by ``placement.placed``
+    :type location: Dictionary
+    """
+    check_machine_name(machine_name)
+    template = get_template(vcenter, image, ova_path, logger)
+    folder = lookups.folder(vcenter, username)
+    relocate_spec = vim.vm.RelocateSpec()
+    relocate_spec.pool = vcenter.resource_pools[const.INF_VCENTER_RESORUCE_POOL]
+    relocate_spec.diskMoveType = 'createNewChildDiskBacking'
+    if location is not None:
+        # Only the child disk moves; it still reads from the template's disks
+        relocate_spec.datastore = vcenter.get_by_name(name=location['datastore'], vimtype=vim.Datastore)
+        relocate_spec.host = vcenter.host_systems[location['host']]
+    clone_spec = vim.vm.CloneSpec(location=relocate_spec,
+                                  snapshot=template.snapshot.currentSnapshot,
+                                  powerOn=False,
+                                  template=False)
+    logger.info('Cloning %s from template %s', machine_name, template.name)
+    the_vm = consume_task(template.CloneVM_Task(folder=folder, name=machine_name, spec=clone_spec))
+    virtual_machine.change_network(the_vm, network)
+    return the_vm
+
+
+def check_machine_name(machine_name):
+    """Make sure the name of a new DataIQ machine is a valid hostname, which is
+    what the name becomes in the guest.
+
+    :Returns: None
+
+    :Raises: ValueError
+
+    :param machine_name: The name of the new instance of DataIQ
+    :type machine_name: String
+    """
+    if not re.match(HOSTNAME_REGEX, machine_name):
+        error = 'Invalid machine name. Names can only contain characters a-z, A-Z, 0-9, periods (".") and dashes ("-"). Supplied: {}'.format(machine_name)
+        raise ValueError(error)
+
+
+def get_template(vcenter, image, ova_path, logger):
+    """Find the template for an image, (re)creating it if it doesn't exist or
+    the OVA has changed since the template was made. Every user's clones share
+    the template, so it's connected to ``VLAB_DATAIQ_PROVISION_NETWORK`` and
+    not to any user's network.
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of DataIQ
+    :type image: String
+
+    :param ova_path: The location of the OVA for the image
+    :type ova_path: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    source = _ova_signature(ova_path)
+    template_name = 'dataiq-template-{}'.format(image)
+    # Without the lock, concurrent creates would all deploy the same template
+    with file_lock(template_name):
+        folder = get_folder(vcenter, const.VLAB_DATAIQ_TEMPLATE_FOLDER)
+        for entity in folder.childEntity:
+            if entity.name == template_name:
+                if not _has_snapshot(entity):
+                    # Making the template died part way; nothing can be cloned from it
+                    logger.info('Template %s has no snapshot, recreating it', template_name)
+                    consume_task(entity.Destroy_Task())
+                    break
+                if _template_source(entity) == source:
+                    return entity
+                logger.info('OVA for %s changed, refreshing template', image)
+                # Existing linked clones still depend on the old template's disks,
+                # so it's renamed out of the way instead of being destroyed.
+                retired_name = '{}{}{}'.format(template_name, RETIRED_MARK, int(time.time()))
+                consume_task(entity.Rename_Task(newName=retired_name))
+                # Older retired templates might not have any clones left by now
+                purge_retired(vcenter, logger)
+                break
+        return _make_template(vcenter, image, ova_path, template_name, source, logger)
+
+
+def purge_retired(vcenter, logger):
+    """Destroy the retired templates that no linked clone depends on anymore.
+
+    :Returns: List, the names of the templates destroyed
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    folder = get_folder(vcenter, const.VLAB_DATAIQ_TEMPLATE_FOLDER)
+    now = time.time()
+    retired = []
+    for entity in folder.childEntity:
+        if not isinstance(entity, vim.VirtualMachine) or RETIRED_MARK not in entity.name:
+            continue
+        retired_at = entity.name.rsplit(RETIRED_MARK, 1)[-1]
+        # A clone started just before the template was retired might not show up yet
+        if retired_at.isdigit() and now - int(retired_at) > RETIRED_GRACE:
+            retired.append(entity)
+    if not retired:
+        return []
+    in_use = _disks_in_use(vcenter, exclude={x._moId for x in retired})
+    destroyed = []
+    for template in retired:
+        if _disk_files(template.layoutEx) & in_use:
+            continue
+        logger.info('Destroying retired template %s', template.name)
+        destroyed.append(template.name)
+        consume_task(template.Destroy_Task())
+    return destroyed
+
+
+def _make_template(vcenter, image, ova_path, template_name, source, logger):
+    """Deploy the OVA, and snapshot it so it can be linked-cloned.
+
+    :Returns: vim.VirtualMachine
+    """
+    logger.info('Creating template %s', template_name)
+    ova = ova_cache.open_ova(ova_path)
+    try:
+        network_map = vim.OvfManager.NetworkMapping()
+        network_map.name = ova.networks[0]
+        network_map.network = lookups.network(vcenter, const.VLAB_DATAIQ_PROVISION_NETWORK)
+        template = virtual_machine.deploy_from_ova(vcenter=vcenter,
+                                                   ova=ova,
+                                                   network_map=[network_map],
+                                                   username=const.VLAB_DATAIQ_TEMPLATE_FOLDER,
+                                                   machine_name=template_name,
+                                                   logger=logger,
+                                                   power_on=False)
+        ova.log_upload_stats(logger)
+    finally:
+        ova.close()
+    meta_data = {'component' : "DataIQTemplate",
+                 'created' : time.time(),
+                 'version' : image,
+                 'configured' : False,
+                 'generation' : 1,
+                 'source' : source}
+    virtual_machine.set_meta(template, meta_data)
+    consume_task(template.CreateSnapshot_Task(name=SNAPSHOT_NAME,
+                                              description='Base for linked clones',
+                                              memory=False,
+                                              quiesce=False))
+    return template
+
+
+def get_folder(vcenter, folder_name):
+    """Find a folder directly under ``INF_VCENTER_TOP_LVL_DIR``, creating it if needed.
+
+    :Returns: vim.Folder
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param folder_name: The name of the folder
+    :type folder_name: String
+    """
+    try:
+        return lookups.folder(vcenter, folder_name)
+    except ValueError:
+        path = '{}/{}'.format(const.INF_VCENTER_TOP_LVL_DIR, folder_name)
+        vcenter.create_vm_folder(path)
+        return lookups.folder(vcenter, folder_name)
+
+
+def _ova_signature(ova_path):
+    """Identify a specific copy of an OVA file, so a changed file can be detected.
+
+    :Returns: Dictionary
+
+    :param ova_path: The location of the OVA
+    :type ova_path: String
+    """
+    try:
+        info = os.stat(ova_path)
+    except FileNotFoundError:
+        raise ValueError('No such image {}'.format(os.path.basename(ova_path)))
+    return {'mtime' : int(info.st_mtime), 'size' : info.st_size}
+
+
+def _has_snapshot(template):
+    """Check that a template has the snapshot linked clones are made from.
+
+    :Returns: Boolean
+
+    :param template: The template VM
+    :type template: vim.VirtualMachine
+    """
+    return getattr(template.snapshot, 'currentSnapshot', None) is not None
+
+
+def _disk_files(layout):
+    """Obtain the names of the disk files in the layout of a VM. For a linked
+    clone, that includes the disks of the template it was cloned from.
+
+    :Returns: Set
+
+    :param layout: The ``layoutEx`` of a VM
+    :type layout: vim.vm.FileLayoutEx
+    """
+    files = getattr(layout, 'file', None) or []
+    return {x.name for x in files if x.type in DISK_FILE_TYPES}
+
+
+def _disks_in_use(vcenter, exclude):
+    """Find every disk file used by any VM, with a single PropertyCollector query.
+
+    :Returns: Set
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param exclude: The moIds of the VMs to ignore
+    :type exclude: Set
+    """
+    content = vcenter.content
+    view = content.viewManager.CreateContainerView(content.rootFolder, [vim.VirtualMachine], True)
+    try:
+        traversal = vim.PropertyCollector.TraversalSpec(name='viewToVm', type=vim.view.ContainerView,
+                                                        path='view', skip=False)
+        obj_spec = vim.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+        prop_spec = vim.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=['layoutEx.file'])
+        filter_spec = vim.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+        collector = content.propertyCollector
+        result = collector.RetrievePropertiesEx([filter_spec], vim.PropertyCollector.RetrieveOptions())
+        in_use = set()
+        while result:
+            for obj in result.objects:
+                if obj.obj._moId in exclude:
+                    continue
+                for prop in obj.propSet:
+                    in_use.update(x.name for x in prop.val if x.type in DISK_FILE_TYPES)
+            if result.token:
+                result = collector.ContinueRetrievePropertiesEx(result.token)
+            else:
+                break
+    finally:
+        view.Destroy()
+    return in_use
+
+
+def _template_source(template):
+    """Obtain the signature of the OVA that a template was made from.
+
+    :Returns: Dictionary or None
+
+    :param template: The template VM
+    :type template: vim.VirtualMachine
+    """
+    try:
+        return ujson.loads(template.config.annotation).get('source')
+    except (ValueError, TypeError, AttributeError):
+        return None
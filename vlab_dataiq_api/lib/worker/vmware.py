@@ -1,19 +1,56 @@
 # -*- coding: UTF-8 -*-
 """Business logic for backend worker tasks"""
+import ssl
+import stat
 import time
-import random
+import uuid
+import shlex
+import shutil
+import hashlib
 import os.path
 import textwrap
 from io import BytesIO
 
+import ujson
 import requests
+from pyVmomi import vmodl
 from urllib3.exceptions import InsecureRequestWarning
-from vlab_inf_common.vmware import vCenter, Ova, vim, virtual_machine, consume_task
+from vlab_inf_common.vmware import vim, virtual_machine, consume_task
 
-from vlab_dataiq_api.lib import const
+from vlab_dataiq_api.lib import const, images, metrics
+from vlab_dataiq_api.lib.worker import admission, inventory, lookups, ova_cache, placement, readiness, stage_times, templates, warm_pool
+from vlab_dataiq_api.lib.worker.sessions import vcenter_session
 
 requests.packages.urllib3.disable_warnings(category=InsecureRequestWarning)
 
+# The VM properties show_dataiq needs, fetched in bulk via the PropertyCollector
+VM_PROPERTIES = ['name', 'runtime.powerState', 'config.annotation', 'guest.net', 'network']
+# What get_info reports when a VM has no (valid) annotation
+UNKNOWN_META = {'component': 'Unknown',
+                'created': 0,
+                'version': "Unknown",
+                'generation': 0,
+                'configured': False}
+# The stages of creating DataIQ, in order. A create can be resumed from any of them
+CREATE_STAGES = ['deploy', 'size', 'network', 'gui', 'rdp', 'info']
+# How often to check if a provisioning script has finished; the wait doubles
+# between checks, from the min up to the max
+PROVISION_POLL_MIN = 1
+PROVISION_POLL_MAX = 30
+# The last line a provisioning script writes to its results file
+RESULTS_DONE = '__done__'
+GUI_STEPS = [('install GNOME', 'yum -y groupinstall "GNOME Desktop" "Graphical Administration Tools"'),
+             ('boot to GUI', 'ln -sf /lib/systemd/system/runlevel5.target /etc/systemd/system/default.target'),
+             ('install epel', 'yum -y install epel-release'),
+             ('disable libvirtd', 'systemctl disable libvirtd')]
+RDP_STEPS = [('install xrdp', 'yum -y install xrdp tigervnc-server'),
+             ('enable xrdp', 'systemctl enable xrdp'),
+             ('start xrdp', 'systemctl start xrdp'),
+             ('open RDP port', 'firewall-cmd --permanent --add-port=3389/tcp'),
+             ('reload firewall', 'firewall-cmd --reload'),
+             ('label xrdp', 'chcon --type=bin_t /usr/sbin/xrdp'),
+             ('label xrdp-sesman', 'chcon --type=bin_t /usr/sbin/xrdp-sesman')]
+
 
 def show_dataiq(username):
     """Obtain basic information about DataIQ
@@ -23,15 +60,35 @@ def show_dataiq(username):
     :param username: The user requesting info about their DataIQ
     :type username: String
     """
-    info = {}
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
+    live = inventory.get_inventory()
+    if live is not None:
+        moids = list(live.dataiq_vms(username).values())
+        if not moids:
+            return {}
+    with vcenter_session() as vcenter:
+        vms = None
+        if live is not None:
+            the_vms = [_to_vm(vcenter, x) for x in moids]
+            try:
+                vms, network_names = _retrieve_vm_properties(vcenter, the_vms=the_vms)
+            except vmodl.fault.ManagedObjectNotFound:
+                # A VM was deleted before the feed caught up
+                vms = None
+        if vms is None:
+            folder = lookups.folder(vcenter, username)
+            vms, network_names = _retrieve_vm_properties(vcenter, folder=folder)
         dataiq_vms = {}
-        for vm in folder.childEntity:
-            info = virtual_machine.get_info(vcenter, vm, username)
-            if info['meta']['component'] == 'DataIQ':
-                dataiq_vms[vm.name] = info
+        console_params = None
+        for the_vm, props in vms:
+            meta = _parse_meta(props.get('config.annotation'))
+            if meta['component'] != 'DataIQ':
+                continue
+            if console_params is None:
+                # Only pay for the TLS handshake if the user has a DataIQ VM
+                console_params = _get_console_params(vcenter)
+            dataiq_vms[props['name']] = _format_info(the_vm, props, meta,
+                                                     network_names, console_params,
+                                                     username)
     return dataiq_vms
 
 
@@ -49,115 +106,323 @@ def delete_dataiq(username, machine_name, logger):
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        folder = vcenter.get_by_name(name=username, vimtype=vim.Folder)
-        for entity in folder.childEntity:
-            if entity.name == machine_name:
-                info = virtual_machine.get_info(vcenter, entity, username)
-                if info['meta']['component'] == 'DataIQ':
-                    logger.debug('powering off VM')
-                    virtual_machine.power(entity, state='off')
-                    delete_task = entity.Destroy_Task()
-                    logger.debug('blocking while VM is being destroyed')
-                    consume_task(delete_task)
-                    break
-        else:
+    with vcenter_session() as vcenter:
+        live = inventory.get_inventory()
+        moid = live.find(username, machine_name) if live is not None else None
+        if moid is not None:
+            try:
+                _destroy(_to_vm(vcenter, moid), logger)
+            except vmodl.fault.ManagedObjectNotFound:
+                logger.debug('Live inventory was stale, scanning folder instead')
+            else:
+                return
+        folder = lookups.folder(vcenter, username)
+        entity = vcenter.content.searchIndex.FindChild(entity=folder, name=machine_name)
+        if not _is_dataiq(entity):
             raise ValueError('No {} named {} found'.format('dataiq', machine_name))
+        _destroy(entity, logger)
 
 
-def create_dataiq(username, machine_name, image, network, static_ip,
-                  default_gateway, netmask, dns, disk_size, cpu_count, ram, logger):
-    """Deploy a new instance of DataIQ
+def delete_many(username, machine_names, logger):
+    """Destroy many of a user's DataIQ machines at once. Every VM is powered
+    off at the same time, then every VM is destroyed at the same time.
 
-    :Returns: Dictionary
+    :Returns: Tuple (names deleted, Dictionary of name -> error)
 
-    :param username: The name of the user who wants to create a new DataIQ
+    :param username: The user who owns the DataIQ machines
     :type username: String
 
-    :param machine_name: The name of the new instance of DataIQ
-    :type machine_name: String
+    :param machine_names: The machines to delete, or None to delete every DataIQ the user has
+    :type machine_names: List
 
-    :param image: The image/version of DataIQ to create
-    :type image: String
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    errors = {}
+    with vcenter_session() as vcenter:
+        folder = lookups.folder(vcenter, username)
+        if machine_names is None:
+            vms, _ = _retrieve_vm_properties(vcenter, folder=folder)
+        else:
+            found = []
+            for machine_name in machine_names:
+                # Asks vCenter for the one child, instead of walking the whole folder
+                entity = vcenter.content.searchIndex.FindChild(entity=folder, name=machine_name)
+                # FindChild matches any child, i.e. a sub-folder with the same name
+                if not isinstance(entity, vim.VirtualMachine):
+                    errors[machine_name] = 'No {} named {} found'.format('dataiq', machine_name)
+                else:
+                    found.append(entity)
+            vms = _retrieve_vm_properties(vcenter, the_vms=found)[0] if found else []
+        targets = {}
+        powered_on = {}
+        for the_vm, props in vms:
+            if _parse_meta(props.get('config.annotation'))['component'] == 'DataIQ':
+                targets[props['name']] = the_vm
+                if props.get('runtime.powerState') == 'poweredOn':
+                    powered_on[props['name']] = the_vm
+            elif machine_names is not None:
+                errors[props['name']] = 'No {} named {} found'.format('dataiq', props['name'])
+        logger.info('Powering off %s VMs', len(powered_on))
+        _run_tasks(powered_on, 'PowerOffVM_Task', errors, logger)
+        logger.info('Destroying %s VMs', len([x for x in targets if x not in errors]))
+        _run_tasks({x: targets[x] for x in targets if x not in errors}, 'Destroy_Task', errors, logger)
+    deleted = sorted(x for x in targets if x not in errors)
+    return deleted, errors
+
+
+def _run_tasks(the_vms, method, errors, logger):
+    """Start the same vCenter task on many VMs, then wait for all of them
 
-    :param network: The name of the network to connect the new DataIQ instance up to
-    :type network: String
+    :Returns: None
 
-    :param static_ip: The IPv4 address to assign to the VM
-    :type static_ip: String
+    :param the_vms: The VMs, by name
+    :type the_vms: Dictionary
 
-    :param default_gateway: The IPv4 address of the network gateway
-    :type default_gateway: String
+    :param method: The name of the method that starts the task, i.e. ``Destroy_Task``
+    :type method: String
 
-    :param netmask: The subnet mask of the network, i.e. 255.255.255.0
-    :type netmask: String
+    :param errors: Updated with the error of every VM whose task failed
+    :type errors: Dictionary
 
-    :param dns: A list of DNS servers to use.
-    :type dns: List
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    running = {}
+    for name, the_vm in the_vms.items():
+        try:
+            running[name] = getattr(the_vm, method)()
+        except vmodl.MethodFault as doh:
+            errors[name] = doh.msg
+    # The tasks all run at once, so waiting on them in turn takes as long as the slowest one
+    for name, the_task in running.items():
+        try:
+            consume_task(the_task)
+        except RuntimeError as doh:
+            logger.error('%s failed on %s: %s', method, name, doh)
+            errors[name] = '{}'.format(doh)
 
-    :param disk_size: The number of GB to allocate for the DataIQ database
-    :type disk_size: Integer
 
-    :param cpu_count: Thenumber of CPU cores to allocate to the DataIQ machine
-    :type cpu_count: Integer
+def create_stage(stage, spec, logger, progress=None):
+    """Run a single stage of creating DataIQ. Stages already recorded in the
+    meta data of the VM are skipped, except for ``info``.
 
-    :param ram: The number of GB of RAM to allocate to the VM
-    :type ram: Integer
+    :Returns: Dictionary
+
+    :Raises: ValueError
+
+    :param stage: The name of the stage to run; one of ``CREATE_STAGES``
+    :type stage: String
+
+    :param spec: The parameters of the create, i.e. the args of the ``dataiq.create`` task
+    :type spec: Dictionary
 
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
+
+    :param progress: Called with the output of ``stage_progress`` as the stage runs
+    :type progress: Function
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,
-                 password=const.INF_VCENTER_PASSWORD) as vcenter:
-        image_name = convert_name(image)
-        logger.info(image)
-        ova = Ova(os.path.join(const.VLAB_DATAIQ_IMAGES_DIR, image_name))
-        try:
-            network_map = vim.OvfManager.NetworkMapping()
-            network_map.name = ova.networks[0]
+    with vcenter_session() as vcenter:
+        the_vm, meta = None, None
+        if stage != 'deploy':
+            the_vm = _find_vm(vcenter, spec['username'], spec['machine_name'])
+            if the_vm is None:
+                raise ValueError('No {} named {} found'.format('dataiq', spec['machine_name']))
+            meta = _parse_meta(the_vm.config.annotation)
+        _, _, info = _run_stage(vcenter, the_vm, meta, stage, spec, logger, progress=progress)
+    return info
+
+
+def stage_progress(stage, meta, started, upload_percent=None, queue_position=None):
+    """Describe how far along a create is, for reporting as the state of a task
+
+    :Returns: Dictionary
+
+    :param stage: The stage that's running
+    :type stage: String
+
+    :param meta: The meta data of the VM, or None if it's not deployed yet
+    :type meta: Dictionary
+
+    :param started: When the stage started, as a timestamp
+    :type started: Float
+
+    :param upload_percent: How much of the OVA has been uploaded, if it's being uploaded
+    :type upload_percent: Integer
+
+    :param queue_position: How many deploys are ahead of this one, if it's waiting to start
+    :type queue_position: Integer
+    """
+    in_stage = time.time() - started
+    index = CREATE_STAGES.index(stage)
+    return {'stage' : stage,
+            'stage_number' : index + 1,
+            'stages' : len(CREATE_STAGES),
+            'stage_elapsed' : int(in_stage),
+            'elapsed' : (meta or {}).get('timings', {}),
+            'upload_percent' : upload_percent,
+            'queue_position' : queue_position,
+            'eta' : stage_times.estimate(CREATE_STAGES[index:], in_stage)}
+
+
+def resume_plan(username, machine_name):
+    """Find what's needed to finish creating a DataIQ machine.
+
+    :Returns: Tuple (spec, remaining stages)
+
+    :Raises: ValueError
+
+    :param username: The name of the user who owns the DataIQ machine
+    :type username: String
+
+    :param machine_name: The name of the DataIQ machine
+    :type machine_name: String
+    """
+    with vcenter_session() as vcenter:
+        the_vm = _find_vm(vcenter, username, machine_name)
+        if the_vm is None:
+            raise ValueError('No {} named {} found'.format('dataiq', machine_name))
+        meta = _parse_meta(the_vm.config.annotation)
+    if 'create' not in meta:
+        raise ValueError('Unable to resume {}; it has no record of how it was created'.format(machine_name))
+    done = meta.get('stages', [])
+    # Always finish with "info", so the caller gets the machine info
+    remaining = [x for x in CREATE_STAGES if x not in done] or ['info']
+    return meta['create'], remaining
+
+
+def refill_warm_pool(image, logger):
+    """Provision new DataIQ machines until the warm pool of an image is full
+
+    :Returns: Integer
+
+    :param image: The image/version of DataIQ
+    :type image: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    provisioned = 0
+    if not warm_pool.enabled(image):
+        return provisioned
+    with warm_pool.refill_lock(image) as acquired:
+        if not acquired:
+            # Refills can take a long time; don't tie up a worker waiting on one
+            logger.info('Warm pool for %s is already being refilled', image)
+            return provisioned
+        with vcenter_session() as vcenter:
+            # Runs on a schedule, so it's a good time to clean up old templates too
+            templates.purge_retired(vcenter, logger)
+            needed = warm_pool.shortfall(vcenter, image, logger)
+            logger.info('Warm pool for %s needs %s VMs', image, needed)
+            for _ in range(needed):
+                _provision_pool_vm(vcenter, image, logger)
+                provisioned += 1
+    return provisioned
+
+
+def bake_image(image, logger):
+    """Create a new image with the GUI and RDP already installed, so creating
+    DataIQ from it skips the slow, in-guest installs.
+
+    The new image is named ``<image>-gui``.
+
+    :Returns: String
+
+    :param image: The image/version of DataIQ to bake
+    :type image: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    if image_meta(image).get('baked'):
+        raise ValueError('Image {} is already baked'.format(image))
+    baked_image = '{}-gui'.format(image)
+    if baked_image in list_images():
+        raise ValueError('Image {} already exists'.format(baked_image))
+    # Fail before deploying anything, instead of after a long export
+    if not os.access(const.VLAB_DATAIQ_IMAGES_DIR, os.W_OK):
+        raise RuntimeError('Unable to bake, the worker cannot write to {}'.format(const.VLAB_DATAIQ_IMAGES_DIR))
+    # make_ova writes a lot of files; only the finished OVA should ever be in the images dir
+    staging_dir = os.path.join(const.VLAB_DATAIQ_CACHE_DIR, 'bake-{}'.format(image))
+    os.makedirs(staging_dir, exist_ok=True)
+    try:
+        with vcenter_session() as vcenter:
+            templates.get_folder(vcenter, const.VLAB_DATAIQ_TEMPLATE_FOLDER)
+            machine_name = 'dataiq-bake-{}'.format(image)
+            logger.info('Deploying %s to bake', image)
+            the_vm = _deploy(vcenter, image, const.VLAB_DATAIQ_PROVISION_NETWORK,
+                             const.VLAB_DATAIQ_TEMPLATE_FOLDER, machine_name, logger)
             try:
-                network_map.network = vcenter.networks[network]
-            except KeyError:
-                raise ValueError('No such network named {}'.format(network))
-            the_vm = virtual_machine.deploy_from_ova(vcenter=vcenter,
-                                                     ova=ova,
-                                                     network_map=[network_map],
-                                                     username=username,
-                                                     machine_name=machine_name,
-                                                     logger=logger,
-                                                     power_on=False)
-        finally:
-            ova.close()
-        mb_of_ram = ram * 1024
-        virtual_machine.adjust_ram(the_vm, mb_of_ram)
-        virtual_machine.adjust_cpu(the_vm, cpu_count)
-        virtual_machine.power(the_vm, state='on')
-        meta_data = {'component' : "DataIQ",
-                     'created' : time.time(),
-                     'version' : image,
-                     'configured' : False,
-                     'generation' : 1}
-        virtual_machine.set_meta(the_vm, meta_data)
-        logger.info("Adding DB VMDK")
-        _add_database_disk(the_vm, disk_size)
-        logger.info("Configuring network")
-        _config_network(vcenter, the_vm, static_ip, default_gateway, netmask, dns, logger)
-        logger.info("Adding GUI")
-        _add_gui(vcenter, the_vm, logger)
-        logger.info("Acquiring machine info")
-        info = virtual_machine.get_info(vcenter, the_vm, username, ensure_ip=True)
-        return  {the_vm.name: info}
+                virtual_machine.set_meta(the_vm, {'component' : "DataIQBake",
+                                                  'created' : time.time(),
+                                                  'version' : image,
+                                                  'configured' : False,
+                                                  'generation' : 1})
+                virtual_machine.power(the_vm, state='on')
+                _add_gui(vcenter, the_vm, logger)
+                _shutdown(the_vm, logger)
+                logger.info('Exporting %s', baked_image)
+                ova_path = virtual_machine.make_ova(vcenter, the_vm, staging_dir, logger,
+                                                    ova_name=convert_name(baked_image))
+            finally:
+                _destroy(the_vm, logger)
+        _publish_image(baked_image, ova_path, {'baked' : True, 'source' : image, 'created' : time.time()})
+        # Describe (and hash) the new image now, instead of on some request
+        images.manifest()
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+    return baked_image
+
+
+def image_meta(image):
+    """Obtain the meta data of an image. Only baked images have meta data.
+
+    :Returns: Dictionary
+
+    :param image: The image/version of DataIQ
+    :type image: String
+    """
+    try:
+        with open(_image_meta_path(image)) as the_file:
+            return ujson.load(the_file)
+    except (FileNotFoundError, ValueError):
+        return {}
 
 
-def list_images():
-    """Obtain a list of available versions of DataIQ that can be created
+def list_images(prefix=None, latest=False):
+    """Obtain a list of available versions of DataIQ that can be created, oldest first
 
     :Returns: List
+
+    :param prefix: Only list versions that start with this, i.e. ``1.2``
+    :type prefix: String
+
+    :param latest: Set to True to only list the newest version
+    :type latest: Boolean
     """
-    images = os.listdir(const.VLAB_DATAIQ_IMAGES_DIR)
-    images = [convert_name(x, to_version=True) for x in images]
-    return images
+    return images.select(images.listing().keys(), prefix=prefix, latest=latest)
+
+
+def check_image(image):
+    """Make sure the OVA of an image exists. Only the file is stat'ed; reading
+    the whole OVA is left to the deploy.
+
+    :Returns: None
+
+    :Raises: ValueError
+
+    :param image: The image/version of DataIQ
+    :type image: String
+    """
+    ova_path = os.path.join(const.VLAB_DATAIQ_IMAGES_DIR, convert_name(image))
+    try:
+        info = os.stat(ova_path)
+    except FileNotFoundError:
+        raise ValueError('No such image {}'.format(image))
+    if not stat.S_ISREG(info.st_mode) or not info.st_size:
+        raise ValueError('Image {} is not a valid OVA'.format(image))
 
 
 def convert_name(name, to_version=False):
@@ -174,9 +439,626 @@ def convert_name(name, to_version=False):
     :type to_version: Boolean
     """
     if to_version:
-        return name.split('-')[-1].replace('.ova', '')
+        return images.to_version(name)
+    else:
+        return images.to_file_name(name)
+
+
+def _publish_image(image, ova_path, meta):
+    """Move a new OVA, and its meta data, into the images directory.
+
+    The cache and images directories are usually different file systems, so the
+    OVA is copied under a dot file name (which ``images`` skips) and
+    then renamed into place.
+
+    :Returns: None
+
+    :param image: The image/version of DataIQ
+    :type image: String
+
+    :param ova_path: The location of the new OVA
+    :type ova_path: String
+
+    :param meta: The meta data of the new image
+    :type meta: Dictionary
+    """
+    meta_path = _image_meta_path(image)
+    tmp_meta = os.path.join(os.path.dirname(meta_path), '.{}'.format(os.path.basename(meta_path)))
+    with open(tmp_meta, 'w') as the_file:
+        ujson.dump(meta, the_file)
+    os.replace(tmp_meta, meta_path)
+    final_path = os.path.join(const.VLAB_DATAIQ_IMAGES_DIR, convert_name(image))
+    tmp_path = os.path.join(const.VLAB_DATAIQ_IMAGES_DIR, '.{}'.format(convert_name(image)))
+    shutil.move(ova_path, tmp_path)
+    os.replace(tmp_path, final_path)
+
+
+def _image_meta_path(image):
+    """The meta data of an image is stored next to the OVA, in a JSON file
+
+    :Returns: String
+
+    :param image: The image/version of DataIQ
+    :type image: String
+    """
+    return os.path.join(const.VLAB_DATAIQ_IMAGES_DIR, convert_name(image).replace('.ova', '.json'))
+
+
+def _retrieve_vm_properties(vcenter, folder=None, the_vms=None):
+    """Fetch the properties of every VM in a folder (or a specific set of VMs),
+    and the names of the networks those VMs are connected to, with a single
+    PropertyCollector query.
+
+    :Returns: Tuple (List of (vim.VirtualMachine, Dictionary), Dictionary)
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param folder: The folder that contains the VMs
+    :type folder: vim.Folder
+
+    :param the_vms: Retrieve these VMs instead of the VMs in a folder
+    :type the_vms: List
+    """
+    vm_to_network = vim.PropertyCollector.TraversalSpec(name='vmToNetwork',
+                                                        type=vim.VirtualMachine,
+                                                        path='network',
+                                                        skip=False)
+    folder_to_vm = vim.PropertyCollector.TraversalSpec(name='folderToChildEntity',
+                                                       type=vim.Folder,
+                                                       path='childEntity',
+                                                       skip=False,
+                                                       selectSet=[vm_to_network])
+    if the_vms is None:
+        obj_specs = [vim.PropertyCollector.ObjectSpec(obj=folder, skip=True, selectSet=[folder_to_vm])]
     else:
-        return 'dataiq-{}.ova'.format(name)
+        obj_specs = [vim.PropertyCollector.ObjectSpec(obj=x, skip=False, selectSet=[vm_to_network]) for x in the_vms]
+    vm_props = vim.PropertyCollector.PropertySpec(type=vim.VirtualMachine, pathSet=VM_PROPERTIES)
+    net_props = vim.PropertyCollector.PropertySpec(type=vim.Network, pathSet=['name'])
+    filter_spec = vim.PropertyCollector.FilterSpec(objectSet=obj_specs, propSet=[vm_props, net_props])
+
+    collector = vcenter.content.propertyCollector
+    result = collector.RetrievePropertiesEx([filter_spec], vim.PropertyCollector.RetrieveOptions())
+    vms = []
+    network_names = {}
+    while result:
+        for obj in result.objects:
+            props = {x.name: x.val for x in obj.propSet}
+            if isinstance(obj.obj, vim.VirtualMachine):
+                vms.append((obj.obj, props))
+            elif isinstance(obj.obj, vim.Network):
+                network_names[obj.obj._moId] = props['name']
+        if result.token:
+            result = collector.ContinueRetrievePropertiesEx(result.token)
+        else:
+            break
+    return vms, network_names
+
+
+def _get_network(vcenter, network):
+    """Lookup a network by name
+
+    :Returns: vim.Network
+
+    :Raises: ValueError
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param network: The name of the network
+    :type network: String
+    """
+    return lookups.network(vcenter, network)
+
+
+def _deploy(vcenter, image, network, folder_name, machine_name, logger, linked_clone=None, on_upload=None,
+            location=None):
+    """Create a new, powered off, DataIQ machine from an image
+
+    :Returns: vim.VirtualMachine
+
+    :Raises: ValueError
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of DataIQ to create
+    :type image: String
+
+    :param network: The name of the network to connect the new DataIQ instance up to
+    :type network: String
+
+    :param folder_name: The name of the folder to create the VM in
+    :type folder_name: String
+
+    :param machine_name: The name of the new instance of DataIQ
+    :type machine_name: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param linked_clone: Override ``VLAB_DATAIQ_LINKED_CLONE``
+    :type linked_clone: Boolean
+
+    :param on_upload: Called with the percent of the OVA uploaded, while it's uploading
+    :type on_upload: Function
+
+    :param location: The datastore and host picked by ``placement.placed``; None
+                     leaves it to ``INF_VCENTER_DATASTORE``
+    :type location: Dictionary
+    """
+    # The name becomes the hostname of the guest, however the VM is made
+    templates.check_machine_name(machine_name)
+    ova_path = os.path.join(const.VLAB_DATAIQ_IMAGES_DIR, convert_name(image))
+    if linked_clone is None:
+        linked_clone = const.VLAB_DATAIQ_LINKED_CLONE
+    if linked_clone:
+        return templates.clone_from_template(vcenter=vcenter,
+                                             image=image,
+                                             ova_path=ova_path,
+                                             network=_get_network(vcenter, network),
+                                             username=folder_name,
+                                             machine_name=machine_name,
+                                             logger=logger,
+                                             location=location)
+    ova = ova_cache.open_ova(ova_path)
+    ova.on_progress = on_upload
+    try:
+        network_map = vim.OvfManager.NetworkMapping()
+        network_map.name = ova.networks[0]
+        network_map.network = _get_network(vcenter, network)
+        if location is None:
+            the_vm = virtual_machine.deploy_from_ova(vcenter=vcenter,
+                                                     ova=ova,
+                                                     network_map=[network_map],
+                                                     username=folder_name,
+                                                     machine_name=machine_name,
+                                                     logger=logger,
+                                                     power_on=False)
+        else:
+            the_vm = _deploy_placed(vcenter, ova, network_map, folder_name, machine_name, location, logger)
+        ova.log_upload_stats(logger)
+        return the_vm
+    finally:
+        ova.close()
+
+
+def _deploy_placed(vcenter, ova, network_map, folder_name, machine_name, location, logger):
+    """Upload an OVA to a specific datastore and host. The same as
+    ``virtual_machine.deploy_from_ova``, which picks the datastore and host at random.
+
+    :Returns: vim.VirtualMachine
+
+    :Raises: RuntimeError
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param ova: The OVA to deploy
+    :type ova: vlab_dataiq_api.lib.worker.ova_cache.CachedOva
+
+    :param network_map: The mapping of the OVA's network to a vCenter network
+    :type network_map: vim.OvfManager.NetworkMapping
+
+    :param folder_name: The name of the folder to create the VM in
+    :type folder_name: String
+
+    :param machine_name: The name of the new instance of DataIQ
+    :type machine_name: String
+
+    :param location: The datastore and host picked by ``placement.placed``
+    :type location: Dictionary
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    folder = lookups.folder(vcenter, folder_name)
+    resource_pool = vcenter.resource_pools[const.INF_VCENTER_RESORUCE_POOL]
+    datastore = vcenter.get_by_name(name=location['datastore'], vimtype=vim.Datastore)
+    host = vcenter.host_systems[location['host']]
+    spec_params = vim.OvfManager.CreateImportSpecParams(entityName=machine_name,
+                                                        diskProvisioning='thin',
+                                                        networkMapping=[network_map])
+    spec = vcenter.ovf_manager.CreateImportSpec(ovfDescriptor=ova.ovf,
+                                                resourcePool=resource_pool,
+                                                datastore=datastore,
+                                                cisp=spec_params)
+    lease = resource_pool.ImportVApp(spec.importSpec, folder=folder, host=host)
+    _wait_for_lease(lease)
+    logger.debug('Uploading OVA to %s on %s', location['datastore'], location['host'])
+    ova.deploy(spec, lease, host.name)
+    for entity in folder.childEntity:
+        if entity.name == machine_name:
+            return entity
+    error = 'Unable to find newly created VM by name {}'.format(machine_name)
+    raise RuntimeError(error)
+
+
+def _wait_for_lease(lease, timeout=300):
+    """Block until an import lease is ready to upload the VMDKs to
+
+    :Returns: None
+
+    :Raises: RuntimeError
+
+    :param lease: The lease from ``ImportVApp``
+    :type lease: vim.HttpNfcLease
+
+    :param timeout: How many seconds to wait for the lease
+    :type timeout: Integer
+    """
+    for _ in range(timeout):
+        if lease.error:
+            raise RuntimeError('Unable to deploy OVA: {}'.format(lease.error.msg))
+        elif lease.state == vim.HttpNfcLease.State.ready:
+            return
+        time.sleep(1)
+    raise RuntimeError('Deploy lease not usable after {} seconds'.format(timeout))
+
+
+def _provision_pool_vm(vcenter, image, logger):
+    """Deploy a DataIQ machine into the warm pool, install the GUI and power it off
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of DataIQ
+    :type image: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    # The folder must exist before anything can be deployed into it
+    templates.get_folder(vcenter, const.VLAB_DATAIQ_WARM_POOL_FOLDER)
+    machine_name = warm_pool.new_name(image)
+    logger.info('Provisioning %s for the warm pool', machine_name)
+    the_vm = _deploy(vcenter, image, const.VLAB_DATAIQ_PROVISION_NETWORK,
+                     const.VLAB_DATAIQ_WARM_POOL_FOLDER, machine_name, logger)
+    virtual_machine.set_meta(the_vm, warm_pool.pool_meta(image, ready=False))
+    virtual_machine.power(the_vm, state='on')
+    if not image_meta(image).get('baked'):
+        _add_gui(vcenter, the_vm, logger)
+    _shutdown(the_vm, logger)
+    virtual_machine.set_meta(the_vm, warm_pool.pool_meta(image, ready=True))
+    return the_vm
+
+
+def _shutdown(the_vm, logger, timeout=300):
+    """Cleanly shutdown the guest OS, falling back to a hard power off
+
+    :Returns: None
+
+    :param the_vm: The VM to shutdown
+    :type the_vm: vim.VirtualMachine
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param timeout: How many seconds to wait for the guest to shutdown
+    :type timeout: Integer
+    """
+    the_vm.ShutdownGuest()
+    for _ in range(timeout):
+        if the_vm.runtime.powerState == 'poweredOff':
+            return
+        time.sleep(1)
+    logger.info('Guest shutdown of %s timed out, powering off', the_vm.name)
+    virtual_machine.power(the_vm, state='off')
+
+
+def _run_stage(vcenter, the_vm, meta, stage, spec, logger, progress=None):
+    """Run a stage of creating DataIQ, and record it (and how long it took) in
+    the meta data of the VM
+
+    :Returns: Tuple (vim.VirtualMachine, meta data, machine info)
+    """
+    started = time.time()
+    if stage == 'deploy':
+        if progress is not None:
+            progress(stage_progress(stage, None, started))
+        the_vm, meta = _stage_deploy(vcenter, spec, logger, progress=progress)
+        stage_times.record(stage, meta['timings'][stage])
+        metrics.STAGE_SECONDS.labels(stage=stage).observe(meta['timings'][stage])
+        return the_vm, meta, {}
+    if stage in meta.get('stages', []) and stage != 'info':
+        logger.info('Stage %s already done', stage)
+        return the_vm, meta, {}
+    logger.info('Running stage %s', stage)
+    if progress is not None:
+        progress(stage_progress(stage, meta, started))
+    info = _STAGES[stage](vcenter, the_vm, meta, spec, logger)
+    elapsed = round(time.time() - started, 1)
+    stage_times.record(stage, elapsed)
+    metrics.STAGE_SECONDS.labels(stage=stage).observe(elapsed)
+    if stage not in meta.get('stages', []):
+        meta.setdefault('stages', []).append(stage)
+        meta.setdefault('timings', {})[stage] = elapsed
+        virtual_machine.set_meta(the_vm, meta)
+    return the_vm, meta, info
+
+
+def _stage_deploy(vcenter, spec, logger, progress=None):
+    """Create the VM, from the warm pool or the image, and record how it was created
+
+    :Returns: Tuple (vim.VirtualMachine, meta data)
+    """
+    started = time.time()
+    image = spec['image']
+    logger.info(image)
+    check_image(image)
+    the_vm = None
+    location = None
+    if warm_pool.enabled(image):
+        the_vm = warm_pool.claim(vcenter, image, spec['username'], spec['machine_name'], logger)
+    from_pool = the_vm is not None
+    if from_pool:
+        virtual_machine.change_network(the_vm, _get_network(vcenter, spec['network']))
+    else:
+        on_upload, on_wait = None, None
+        if progress is not None:
+            on_upload = lambda percent: progress(stage_progress('deploy', None, started, upload_percent=percent))
+            on_wait = lambda position: progress(stage_progress('deploy', None, started, queue_position=position))
+        with placement.placed(vcenter, spec['disk_size'], logger) as location:
+            with admission.admitted(spec['username'], (location or {}).get('datastore'), on_wait=on_wait):
+                # Time spent queued isn't part of how long a deploy takes
+                started = time.time()
+                the_vm = _deploy(vcenter, image, spec['network'], spec['username'], spec['machine_name'],
+                                 logger, linked_clone=spec.get('linked_clone'), on_upload=on_upload,
+                                 location=location)
+    meta = {'component' : "DataIQ",
+            'created' : time.time(),
+            'version' : image,
+            'configured' : False,
+            'generation' : 1,
+            # Pool VMs and baked images already have the GUI
+            'has_gui' : from_pool or bool(image_meta(image).get('baked')),
+            # So a resumed create can tell if the DB disk was already added
+            'disks' : _count_disks(the_vm),
+            'create' : spec,
+            'stages' : ['deploy'],
+            'timings' : {'deploy' : round(time.time() - started, 1)}}
+    if location is not None:
+        meta['placement'] = location
+    virtual_machine.set_meta(the_vm, meta)
+    return the_vm, meta
+
+
+def _stage_size(vcenter, the_vm, meta, spec, logger):
+    """Set the CPU, RAM and DB disk; and the network too if using guest customization"""
+    logger.info("Sizing CPU, RAM and DB VMDK")
+    # A create that died after the reconfigure, but before recording the stage, already has the DB disk
+    add_disk = meta.get('disks') is None or _count_disks(the_vm) <= meta['disks']
+    if not add_disk:
+        logger.info("DB VMDK already exists, not adding another")
+    _resize(the_vm, spec['cpu_count'], spec['ram'], spec['disk_size'], add_disk=add_disk)
+    if const.VLAB_DATAIQ_CUSTOMIZE_NETWORK:
+        logger.info("Customizing network")
+        _customize_network(the_vm, spec['static_ip'], spec['default_gateway'], spec['netmask'], spec['dns'])
+
+
+def _stage_network(vcenter, the_vm, meta, spec, logger):
+    """Power on the VM, and configure the network"""
+    _power_on(the_vm)
+    if not const.VLAB_DATAIQ_CUSTOMIZE_NETWORK:
+        logger.info("Configuring network")
+        _config_network(vcenter, the_vm, spec['static_ip'], spec['default_gateway'],
+                        spec['netmask'], spec['dns'], logger)
+
+
+def _stage_gui(vcenter, the_vm, meta, spec, logger):
+    """Install the GUI, unless the VM already has it"""
+    if not meta.get('has_gui'):
+        _power_on(the_vm)
+        _install_gui(vcenter, the_vm, logger)
+
+
+def _stage_rdp(vcenter, the_vm, meta, spec, logger):
+    """Install the RDP server, unless the VM already has it"""
+    if not meta.get('has_gui'):
+        _power_on(the_vm)
+        _install_rdp(vcenter, the_vm, logger)
+
+
+def _stage_info(vcenter, the_vm, meta, spec, logger):
+    """Obtain the info about the new DataIQ machine"""
+    _power_on(the_vm)
+    logger.info("Acquiring machine info")
+    info = _vm_info(vcenter, the_vm, spec['username'])
+    return {the_vm.name: info}
+
+
+def _vm_info(vcenter, the_vm, username):
+    """Wait for a VM to get an IP, then describe it the same way ``show_dataiq`` does.
+
+    Unlike ``virtual_machine.get_info``, this doesn't depend on the network
+    names cached by a (pooled, possibly long lived) vCenter session.
+
+    :Returns: Dictionary
+    """
+    readiness.wait_for_ip(vcenter, the_vm)
+    vms, network_names = _retrieve_vm_properties(vcenter, the_vms=[the_vm])
+    _, props = vms[0]
+    meta = _parse_meta(props.get('config.annotation'))
+    return _format_info(the_vm, props, meta, network_names, _get_console_params(vcenter), username)
+
+
+_STAGES = {'size' : _stage_size,
+           'network' : _stage_network,
+           'gui' : _stage_gui,
+           'rdp' : _stage_rdp,
+           'info' : _stage_info}
+
+
+def _power_on(the_vm):
+    """Power on a VM, if it isn't already
+
+    :Returns: None
+
+    :param the_vm: The VM to power on
+    :type the_vm: vim.VirtualMachine
+    """
+    if the_vm.runtime.powerState != 'poweredOn':
+        virtual_machine.power(the_vm, state='on')
+
+
+def _find_vm(vcenter, username, machine_name):
+    """Locate a user's DataIQ machine by name
+
+    :Returns: vim.VirtualMachine or None
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param username: The name of the user who owns the VM
+    :type username: String
+
+    :param machine_name: The name of the VM
+    :type machine_name: String
+    """
+    live = inventory.get_inventory()
+    moid = live.find(username, machine_name) if live is not None else None
+    if moid is not None:
+        # The live inventory only tracks DataIQ machines
+        return _to_vm(vcenter, moid)
+    folder = lookups.folder(vcenter, username)
+    for entity in folder.childEntity:
+        if entity.name == machine_name and _is_dataiq(entity):
+            return entity
+    return None
+
+
+def _is_dataiq(entity):
+    """Check if an entity from a folder is a DataIQ machine. A folder can hold
+    other folders, and a VM that's still being created has no config yet.
+
+    :Returns: Boolean
+
+    :param entity: A child of a folder, or None
+    :type entity: vim.ManagedEntity
+    """
+    if not isinstance(entity, vim.VirtualMachine):
+        return False
+    return _parse_meta(getattr(entity.config, 'annotation', None)).get('component') == 'DataIQ'
+
+
+def _to_vm(vcenter, moid):
+    """Create a usable reference to a VM from its moId, without searching for it
+
+    :Returns: vim.VirtualMachine
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param moid: The managed object ID of the VM
+    :type moid: String
+    """
+    return vim.VirtualMachine(moid, stub=vcenter._conn._stub)
+
+
+def _destroy(the_vm, logger):
+    """Power off and delete a VM
+
+    :Returns: None
+
+    :param the_vm: The VM to destroy
+    :type the_vm: vim.VirtualMachine
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    logger.debug('powering off VM')
+    virtual_machine.power(the_vm, state='off')
+    delete_task = the_vm.Destroy_Task()
+    logger.debug('blocking while VM is being destroyed')
+    consume_task(delete_task)
+
+
+def _parse_meta(annotation):
+    """Convert the notes/annotation of a VM into the vLab meta data.
+
+    :Returns: Dictionary
+
+    :param annotation: The raw annotation of the VM
+    :type annotation: String
+    """
+    try:
+        return ujson.loads(annotation)
+    except (ValueError, TypeError):
+        # ValueError -> VM created, but notes not updated
+        # TypeError  -> VM failed to be created; notes are None
+        return dict(UNKNOWN_META)
+
+
+def _get_console_params(vcenter):
+    """Obtain the parts of the HTML console URL that are the same for every VM.
+
+    :Returns: Dictionary
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+    """
+    vcenter_cert = ssl.get_server_certificate((const.INF_VCENTER_SERVER, const.INF_VCENTER_PORT))
+    digest = hashlib.sha1(ssl.PEM_cert_to_DER_cert(vcenter_cert)).digest()
+    thumbprint = ':'.join('{:02X}'.format(x) for x in digest)
+    # vcenter.content is a round trip to vCenter, so only access it once
+    content = vcenter.content
+    return {'thumbprint' : thumbprint,
+            'server_guid' : content.about.instanceUuid,
+            'session_manager' : content.sessionManager}
+
+
+def _format_info(the_vm, props, meta, network_names, console_params, username):
+    """Build the same dictionary that ``virtual_machine.get_info`` returns from
+    properties that have already been retrieved.
+
+    :Returns: Dictionary
+
+    :param the_vm: The VM the properties belong to
+    :type the_vm: vim.VirtualMachine
+
+    :param props: The retrieved properties of the VM
+    :type props: Dictionary
+
+    :param meta: The parsed meta data of the VM
+    :type meta: Dictionary
+
+    :param network_names: Mapping of network moId to network name
+    :type network_names: Dictionary
+
+    :param console_params: The output from ``_get_console_params``
+    :type console_params: Dictionary
+
+    :param username: The user who owns the VM
+    :type username: String
+    """
+    ips = []
+    for nic in props.get('guest.net', []):
+        ips += nic.ipAddress
+    # No point is showing the IPv6 link local addrs if a firewall wont forward them
+    ips = [x for x in ips if not x.startswith('fe80::')]
+    networks = []
+    user_prefix = '{}_'.format(username)
+    for network in props.get('network', []):
+        net_name = network_names.get(network._moId, '')
+        if net_name.startswith(username):
+            networks.append(net_name.replace(user_prefix, ''))
+    ticket = console_params['session_manager'].AcquireCloneTicket()
+    console = 'https://{0}/ui/webconsole.html?vmId={1}&vmName={2}&serverGuid={3}&' \
+              'locale=en_US&host={0}&sessionTicket={4}&thumbprint={5}'.format(const.INF_VCENTER_SERVER,
+                                                                              the_vm._moId,
+                                                                              props['name'],
+                                                                              console_params['server_guid'],
+                                                                              ticket,
+                                                                              console_params['thumbprint'])
+    info = {'state' : props.get('runtime.powerState'),
+            'console' : console,
+            'ips' : ips,
+            'networks' : networks,
+            'moid' : the_vm._moId,
+            'meta' : meta}
+    return info
 
 
 def _config_network(vcenter, the_vm, static_ip, default_gateway, netmask, dns, logger):
@@ -206,7 +1088,6 @@ def _config_network(vcenter, the_vm, static_ip, default_gateway, netmask, dns, l
     :type logger: logging.LoggerAdapter
     """
     nic_config_file = '/etc/sysconfig/network-scripts/ifcfg-eth0'
-    cmd = '/bin/echo'
     config = """\
     TYPE=Ethernet
     ONBOOT=yes
@@ -219,11 +1100,48 @@ def _config_network(vcenter, the_vm, static_ip, default_gateway, netmask, dns, l
     NETMASK={}
     """.format(static_ip, default_gateway, netmask)
     nic_config = '{}\n{}'.format(textwrap.dedent(config), _format_dns(dns))
-    _upload_nic_config(vcenter, the_vm, nic_config, os.path.basename(nic_config_file), logger)
+    steps = [('write NIC config', "/bin/cat > {} <<'EOF'\n{}\nEOF".format(nic_config_file, nic_config)),
+             ('restart network', '/bin/systemctl restart network'),
+             ('set hostname', '/bin/hostnamectl set-hostname {}'.format(the_vm.name))]
+    _provision(vcenter, the_vm, steps, logger)
+
+
+def _customize_network(the_vm, static_ip, default_gateway, netmask, dns):
+    """Set the static network and hostname of a powered off VM via guest
+    customization. The guest is configured as it boots, so unlike
+    ``_config_network`` there's no waiting on VMware Tools.
+
+    :Returns: None
+
+    :param the_vm: The new DataIQ machine
+    :type the_vm: vim.VirtualMachine
 
-    _run_cmd(vcenter, the_vm, '/bin/mv', '-f /home/administrator/{} {}'.format(os.path.basename(nic_config_file), nic_config_file), logger)
-    _run_cmd(vcenter, the_vm, '/bin/systemctl', 'restart network', logger)
-    _run_cmd(vcenter, the_vm, '/bin/hostnamectl', 'set-hostname {}'.format(the_vm.name), logger)
+    :param static_ip: The IPv4 address to assign to the VM
+    :type static_ip: String
+
+    :param default_gateway: The IPv4 address of the network gateway
+    :type default_gateway: String
+
+    :param netmask: The subnet mask of the network, i.e. 255.255.255.0
+    :type netmask: String
+
+    :param dns: A list of DNS servers to use.
+    :type dns: List
+    """
+    ip_settings = vim.vm.customization.IPSettings()
+    ip_settings.ip = vim.vm.customization.FixedIp(ipAddress=static_ip)
+    ip_settings.subnetMask = netmask
+    ip_settings.gateway = [default_gateway]
+    ip_settings.dnsServerList = dns
+    identity = vim.vm.customization.LinuxPrep()
+    identity.hostName = vim.vm.customization.FixedName(name=the_vm.name)
+    identity.domain = 'localdomain'
+    identity.hwClockUTC = True
+    spec = vim.vm.customization.Specification()
+    spec.identity = identity
+    spec.globalIPSettings = vim.vm.customization.GlobalIPSettings(dnsServerList=dns)
+    spec.nicSettingMap = [vim.vm.customization.AdapterMapping(adapter=ip_settings)]
+    consume_task(the_vm.CustomizeVM_Task(spec=spec))
 
 
 def _format_dns(dns):
@@ -245,22 +1163,166 @@ def _format_dns(dns):
 def _run_cmd(vcenter, the_vm, cmd, args, logger, timeout=600, one_shot=False):
     shell = '/bin/bash'
     the_args = "-c '/bin/echo {} | /bin/sudo -S {} {}'".format(const.VLAB_DATAIQ_ADMIN_PW, cmd, args)
-    result = virtual_machine.run_command(vcenter,
-                                         the_vm,
-                                         shell,
-                                         user=const.VLAB_DATAIQ_ADMIN,
-                                         password=const.VLAB_DATAIQ_ADMIN_PW,
-                                         arguments=the_args,
-                                         timeout=timeout,
-                                         one_shot=one_shot,
-                                         init_timeout=1200)
+    with metrics.GUEST_COMMAND_SECONDS.labels(command=os.path.basename(cmd)).time():
+        result = virtual_machine.run_command(vcenter,
+                                             the_vm,
+                                             shell,
+                                             user=const.VLAB_DATAIQ_ADMIN,
+                                             password=const.VLAB_DATAIQ_ADMIN_PW,
+                                             arguments=the_args,
+                                             timeout=timeout,
+                                             one_shot=one_shot,
+                                             init_timeout=1200)
     if result.exitCode:
         logger.error("failed to execute: {} {}".format(shell, the_args))
+    return result
 
 
-def _upload_nic_config(vcenter, the_vm, nic_config, config_name, logger):
-    """Upload the NIC config file to the new DataIQ machine. Works even if the
-    machine has no external network configured.
+def _provision(vcenter, the_vm, steps, logger, timeout=3600):
+    """Run a series of shell commands as root in the guest, in a single script.
+
+    One upload and one ``StartProgramInGuest`` replace a guest-ops call (plus
+    process polling) per command. The script records the exit code and timing
+    of every step in a results file, so a failure is still attributed to the
+    exact step that failed. The results file is only read once the script has
+    exited.
+
+    :Returns: List
+
+    :Raises: RuntimeError
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_vm: The new DataIQ machine
+    :type the_vm: vim.VirtualMachine
+
+    :param steps: The (name, command) pairs to run, in order
+    :type steps: List
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param timeout: How many seconds to wait for every step to finish
+    :type timeout: Integer
+    """
+    run_id = uuid.uuid4().hex
+    script_path = '/home/administrator/provision-{}.sh'.format(run_id)
+    results_path = '/home/administrator/provision-{}.results'.format(run_id)
+    log_path = '/home/administrator/provision-{}.log'.format(run_id)
+    script = _render_script(steps, results_path, log_path)
+    logger.info('Running %s provisioning steps', len(steps))
+    _upload_file(vcenter, the_vm, script, script_path, logger)
+    process = _run_cmd(vcenter, the_vm, '/bin/bash', script_path, logger, one_shot=True)
+    exit_code = _wait_for_process(vcenter, the_vm, process.pid, timeout)
+    results = _download_file(vcenter, the_vm, results_path)
+    if results is None or RESULTS_DONE not in results.splitlines():
+        error = 'Provisioning exited {} before finishing. See {} in the guest'.format(exit_code, log_path)
+        raise RuntimeError(error)
+    step_results = _parse_results(results)
+    for result in step_results:
+        logger.debug('Step "%s" exited %s after %.1f seconds', result['step'], result['exit_code'], result['duration'])
+        metrics.GUEST_COMMAND_SECONDS.labels(command=result['step']).observe(result['duration'])
+        if result['exit_code']:
+            error = 'Provisioning step "{}" failed with exit code {}. See {} in the guest'.format(result['step'],
+                                                                                              result['exit_code'],
+                                                                                              log_path)
+            raise RuntimeError(error)
+    return step_results
+
+
+def _wait_for_process(vcenter, the_vm, pid, timeout):
+    """Block until a process in the guest exits, checking less often the longer it runs
+
+    :Returns: Integer, the exit code of the process
+
+    :Raises: RuntimeError
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_vm: The new DataIQ machine
+    :type the_vm: vim.VirtualMachine
+
+    :param pid: The process ID in the guest
+    :type pid: Integer
+
+    :param timeout: How many seconds to wait for the process to exit
+    :type timeout: Integer
+    """
+    waited = 0
+    interval = PROVISION_POLL_MIN
+    while waited < timeout:
+        time.sleep(interval)
+        waited += interval
+        info = virtual_machine.get_process_info(vcenter,
+                                                the_vm,
+                                                const.VLAB_DATAIQ_ADMIN,
+                                                const.VLAB_DATAIQ_ADMIN_PW,
+                                                pid)
+        if info.endTime:
+            return info.exitCode
+        interval = min(interval * 2, PROVISION_POLL_MAX)
+    raise RuntimeError('Provisioning did not finish within {} seconds'.format(timeout))
+
+
+def _render_script(steps, results_path, log_path):
+    """Create the shell script that runs every provisioning step
+
+    :Returns: String
+
+    :param steps: The (name, command) pairs to run, in order
+    :type steps: List
+
+    :param results_path: Where in the guest to write the outcome of each step
+    :type results_path: String
+
+    :param log_path: Where in the guest to write the output of each step
+    :type log_path: String
+    """
+    lines = ['#!/bin/bash',
+             'RESULTS={}'.format(shlex.quote(results_path)),
+             'LOG={}'.format(shlex.quote(log_path)),
+             'step() {',
+             '    local start=$(/bin/date +%s.%N)',
+             '    /bin/echo "### $1" >> "$LOG"',
+             '    /bin/bash -c "$2" >> "$LOG" 2>&1',
+             '    local rc=$?',
+             '    local end=$(/bin/date +%s.%N)',
+             '    /bin/printf \'{"step": "%s", "exit_code": %d, "start": %s, "end": %s}\\n\' "$1" "$rc" "$start" "$end" >> "$RESULTS"',
+             '    return $rc',
+             '}']
+    for name, command in steps:
+        # Later steps depend on earlier ones, so stop at the first failure
+        lines.append('step {} {} || {{ /bin/echo {} >> "$RESULTS"; exit 1; }}'.format(shlex.quote(name),
+                                                                                    shlex.quote(command),
+                                                                                    RESULTS_DONE))
+    lines.append('/bin/echo {} >> "$RESULTS"'.format(RESULTS_DONE))
+    return '\n'.join(lines) + '\n'
+
+
+def _parse_results(results):
+    """Convert the results file written by a provisioning script into a list of steps
+
+    :Returns: List
+
+    :param results: The contents of the results file
+    :type results: String
+    """
+    step_results = []
+    for line in results.splitlines():
+        if not line or line == RESULTS_DONE:
+            continue
+        result = ujson.loads(line)
+        step_results.append({'step' : result['step'],
+                             'exit_code' : result['exit_code'],
+                             'duration' : result['end'] - result['start']})
+    return step_results
+
+
+def _upload_file(vcenter, the_vm, content, upload_path, logger):
+    """Upload a file to the new DataIQ machine. Works even if the machine has
+    no external network configured.
 
     :Returns: None
 
@@ -270,25 +1332,21 @@ def _upload_nic_config(vcenter, the_vm, nic_config, config_name, logger):
     :param the_vm: The new DataIQ machine
     :type the_vm: vim.VirtualMachine
 
-    :param nic_config: The network configuration file contents
-    :param nic_config: String
+    :param content: The contents of the file
+    :type content: String
 
-    :param config_name: The name of the config file
-    :type config_name: String
+    :param upload_path: Where in the guest to write the file
+    :type upload_path: String
 
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    nic_config_bytes = nic_config.encode()
-    file_size = len(nic_config_bytes)
-    logger.debug("Generating creds")
+    content_bytes = content.encode()
+    file_size = len(content_bytes)
     creds = vim.vm.guest.NamePasswordAuthentication(username=const.VLAB_DATAIQ_ADMIN,
                                                      password=const.VLAB_DATAIQ_ADMIN_PW)
-    logger.debug("Creating file attributes object")
     file_attributes = vim.vm.guest.FileManager.FileAttributes()
-    logger.debug("Obtaining URL for uploading NIC config to new VM")
-    upload_path = '/home/administrator/{}'.format(config_name)
-    logger.info('Uploading NIC config: %s', upload_path)
+    logger.info('Uploading file: %s', upload_path)
     logger.debug('Uploading %s bytes', file_size)
     url = _get_upload_url(vcenter=vcenter,
                           the_vm=the_vm,
@@ -296,12 +1354,37 @@ def _upload_nic_config(vcenter, the_vm, nic_config, config_name, logger):
                           upload_path=upload_path,
                           file_attributes=file_attributes,
                           file_size=file_size)
-    logger.info('Uploading to URL %s', url)
-    resp = requests.put(url, data=BytesIO(nic_config_bytes), verify=False)
+    resp = requests.put(url, data=BytesIO(content_bytes), verify=False)
     resp.raise_for_status()
 
 
-def _get_upload_url(vcenter, the_vm, creds, upload_path, file_size, file_attributes, overwrite=True):
+def _download_file(vcenter, the_vm, guest_path):
+    """Read a file from the DataIQ machine
+
+    :Returns: String, or None if the file doesn't exist (yet)
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_vm: The new DataIQ machine
+    :type the_vm: vim.VirtualMachine
+
+    :param guest_path: The location of the file in the guest
+    :type guest_path: String
+    """
+    creds = vim.vm.guest.NamePasswordAuthentication(username=const.VLAB_DATAIQ_ADMIN,
+                                                     password=const.VLAB_DATAIQ_ADMIN_PW)
+    file_manager = vcenter.content.guestOperationsManager.fileManager
+    try:
+        info = file_manager.InitiateFileTransferFromGuest(vm=the_vm, auth=creds, guestFilePath=guest_path)
+    except vim.fault.FileNotFound:
+        return None
+    resp = requests.get(info.url, verify=False)
+    resp.raise_for_status()
+    return resp.text
+
+
+def _get_upload_url(vcenter, the_vm, creds, upload_path, file_size, file_attributes, overwrite=True, timeout=1200):
     """Mostly to deal with race between the VM power on, and all of VMwareTools being ready.
 
     :Returns: String
@@ -323,9 +1406,14 @@ def _get_upload_url(vcenter, the_vm, creds, upload_path, file_size, file_attribu
 
     :param overwrite: If the file already exists, write over the existing content.
     :type overwrite: Boolean
+
+    :param timeout: How many seconds to wait for GuestOperations to become available
+    :type timeout: Integer
     """
-    # The VM just booted, this service can take some time to be ready
-    for retry_sleep in range(10):
+    deadline = time.time() + timeout
+    while True:
+        # The VM just booted, this service can take some time to be ready
+        readiness.wait_for_guest(vcenter, the_vm, timeout=max(int(deadline - time.time()), 1))
         try:
             url = vcenter.content.guestOperationsManager.fileManager.InitiateFileTransferToGuest(vm=the_vm,
                                                                                                  auth=creds,
@@ -334,16 +1422,18 @@ def _get_upload_url(vcenter, the_vm, creds, upload_path, file_size, file_attribu
                                                                                                  fileSize=file_size,
                                                                                                  overwrite=overwrite)
         except vim.fault.GuestOperationsUnavailable:
-            time.sleep(retry_sleep)
+            # vCenter can report the guest as ready a moment before it really is
+            if time.time() >= deadline:
+                error = 'Unable to upload DataIQ install script. Timed out waiting on GuestOperations to become available.'
+                raise ValueError(error)
+            time.sleep(1)
         else:
             return url
-    else:
-        error = 'Unable to upload DataIQ install script. Timed out waiting on GuestOperations to become available.'
-        raise ValueError(error)
 
 
-def _add_database_disk(the_vm, disk_size):
-    """Add a VMDK to the new DataIQ instance to store it's database.
+def _resize(the_vm, cpu_count, ram, disk_size, add_disk=True):
+    """Set the CPU and RAM of the new DataIQ instance, and add a VMDK to store
+    it's database. It's all one reconfigure, so the VM must be powered off.
 
     :Returns: None
 
@@ -352,10 +1442,39 @@ def _add_database_disk(the_vm, disk_size):
     :param the_vm: The new DataIQ machine
     :type the_vm: vim.VirtualMachine
 
+    :param cpu_count: The number of CPU cores to allocate to the VM
+    :type cpu_count: Integer
+
+    :param ram: The number of GB of RAM to allocate to the VM
+    :type ram: Integer
+
     :param disk_size: The number of GB to make the disk
     :type disk_size: Integer
+
+    :param add_disk: Set to False to only set the CPU and RAM
+    :type add_disk: Boolean
     """
     spec = vim.vm.ConfigSpec()
+    spec.memoryMB = ram * 1024
+    spec.numCPUs = cpu_count
+    if add_disk:
+        spec.deviceChange = [_db_disk_spec(the_vm, disk_size)]
+    consume_task(the_vm.ReconfigVM_Task(spec=spec))
+
+
+def _db_disk_spec(the_vm, disk_size):
+    """Create the spec for adding the DB VMDK, after the VM's other VMDKs
+
+    :Returns: vim.vm.device.VirtualDeviceSpec
+
+    :Rasies: RuntimeError
+
+    :param the_vm: The new DataIQ machine
+    :type the_vm: vim.VirtualMachine
+
+    :param disk_size: The number of GB to make the disk
+    :type disk_size: Integer
+    """
     unit_number = 0
     for dev in the_vm.config.hardware.device:
         if hasattr(dev.backing, 'fileName'):
@@ -368,7 +1487,6 @@ def _add_database_disk(the_vm, disk_size):
     if unit_number == 0:
         raise RuntimeError('Unable to find any VMDKs for VM')
 
-    dev_changes = []
     disk_spec = vim.vm.device.VirtualDeviceSpec()
     disk_spec.fileOperation = "create"
     disk_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
@@ -379,9 +1497,19 @@ def _add_database_disk(the_vm, disk_size):
     disk_spec.device.unitNumber = unit_number
     disk_spec.device.capacityInKB = int(disk_size) * 1024 * 1024
     disk_spec.device.controllerKey = 1000
-    dev_changes.append(disk_spec)
-    spec.deviceChange = dev_changes
-    consume_task(the_vm.ReconfigVM_Task(spec=spec))
+    return disk_spec
+
+
+def _count_disks(the_vm):
+    """Obtain how many VMDKs a VM has
+
+    :Returns: Integer
+
+    :param the_vm: The DataIQ machine
+    :type the_vm: vim.VirtualMachine
+    """
+    return len([x for x in the_vm.config.hardware.device if isinstance(x, vim.vm.device.VirtualDisk)])
+
 
 def _add_gui(vcenter, the_vm, logger):
     """Adds a GUI and RDP to the DataIQ machine
@@ -397,48 +1525,69 @@ def _add_gui(vcenter, the_vm, logger):
     :param logger: An object for logging messages
     :type logger: logging.LoggerAdapter
     """
-    cmd = '/bin/echo {} | sudo -S'.format(const.VLAB_DATAIQ_ADMIN_PW)
-    args1 = 'yum -y groupinstall "GNOME Desktop" "Graphical Administration Tools"'
-    args2 = 'ln -sf /lib/systemd/system/runlevel5.target /etc/systemd/system/default.target'
-    args3 = 'yum -y install epel-release'
-    args4 = 'systemctl disable libvirtd'
+    _install_gui(vcenter, the_vm, logger)
+    _install_rdp(vcenter, the_vm, logger)
+
 
-    _handle_gui(vcenter, the_vm, cmd, args1, logger)
+def _install_gui(vcenter, the_vm, logger):
+    """Install GNOME, and reboot the DataIQ machine into it
 
-    most_args = [args2, args3, args4]
-    for arg in most_args:
-        logger.debug("Running: %s", arg)
-        _run_cmd(vcenter, the_vm, cmd, arg, logger, timeout=1800)
+    :Returns: None
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_vm: The new DataIQ machine
+    :type the_vm: vim.VirtualMachine
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    logger.info("Installing GUI")
+    # /run is a tmpfs, so the marker only exists until the guest reboots
+    marker = '/run/dataiq-boot-{}'.format(uuid.uuid4().hex)
+    _provision(vcenter, the_vm, GUI_STEPS + [('mark boot', '/bin/touch {}'.format(marker))], logger)
 
     logger.info("Rebooting machine to enable GUI")
     _run_cmd(vcenter, the_vm, 'reboot', '', logger, one_shot=True)
-    logger.info("Waiting 60 seconds for the machine to shutdown")
-    time.sleep(60)
-
-    rdp_args1 = 'yum -y install xrdp tigervnc-server'
-    rdp_args2 = 'systemctl enable xrdp'
-    rdp_args3 = 'systemctl start xrdp'
-    rdp_args4 = 'firewall-cmd --permanent --add-port=3389/tcp'
-    rdp_args5 = 'firewall-cmd --reload'
-    rdp_args6 = 'chcon --type=bin_t /usr/sbin/xrdp'
-    rdp_args7 = 'chcon --type=bin_t /usr/sbin/xrdp-sesman'
-    rdp_args = [rdp_args1, rdp_args2, rdp_args3, rdp_args4, rdp_args5, rdp_args6, rdp_args7]
-    logger.info("Adding RDP server")
-    for rdp_arg in rdp_args:
-        logger.debug("Running: %s", rdp_arg)
-        _run_cmd(vcenter, the_vm, cmd, rdp_arg, logger, timeout=1800)
+    logger.info("Waiting for the machine to come back up")
+    readiness.wait_for_guest(vcenter, the_vm, rebooted=lambda: _rebooted(vcenter, the_vm, marker))
+
+
+def _rebooted(vcenter, the_vm, marker):
+    """Check if the guest has rebooted since the marker file was written
 
+    :Returns: Boolean
 
-def _handle_gui(vcenter, the_vm, cmd, arg, logger):
-    """No clue why, but PyVmomi poops the bed and loses the PID when installing
-    the GUI. So manually check if the group got installed...
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_vm: The DataIQ machine
+    :type the_vm: vim.VirtualMachine
+
+    :param marker: A file in the guest that doesn't survive a reboot
+    :type marker: String
     """
     try:
-        _run_cmd(vcenter, the_vm, cmd, arg, logger, timeout=1800)
-    except IndexError:
-        pass
-
-    check_gnome = 'group list ids | grep "Installed Environment" | grep "GNOME Desktop"'
-    check_admin_tools = 'group list ids | grep "Installed Groups" | grep "Graphfical Administration Tools"'
-    _run_cmd(vcenter, the_vm, '/bin/yum', check_gnome, logger)
-    _run_cmd(vcenter, the_vm, '/bin/yum', check_admin_tools, logger)
+        return _download_file(vcenter, the_vm, marker) is None
+    except (vim.fault.GuestOperationsUnavailable, vim.fault.InvalidState, requests.RequestException):
+        # The guest is going down, or isn't all the way up yet
+        return False
+
+
+def _install_rdp(vcenter, the_vm, logger):
+    """Install and start an RDP server on the DataIQ machine
+
+    :Returns: None
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param the_vm: The new DataIQ machine
+    :type the_vm: vim.VirtualMachine
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    logger.info("Adding RDP server")
+    _provision(vcenter, the_vm, RDP_STEPS, logger)
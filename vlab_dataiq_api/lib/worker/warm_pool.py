@@ -0,0 +1,186 @@
+# -*- coding: UTF-8 -*-
+"""
+Bookkeeping for the warm pool of fully provisioned, powered off, DataIQ machines.
+
+Pool VMs live in the ``VLAB_DATAIQ_WARM_POOL_FOLDER`` folder, and are tracked by
+their meta data. A create claims a pool VM by renaming it and moving it into
+the user's folder, which is a few seconds of work instead of the many minutes
+it takes to deploy and provision a new VM.
+
+.. note::
+    Claims are serialized with a lock that's local to the worker host. Running
+    the pool with multiple worker hosts is safe only if each host manages
+    different images.
+"""
+import time
+import uuid
+from contextlib import contextmanager
+
+import ujson
+from vlab_inf_common.vmware import vim, consume_task
+
+from vlab_dataiq_api.lib import const
+from vlab_dataiq_api.lib.locks import file_lock
+from vlab_dataiq_api.lib.worker import lookups
+from vlab_dataiq_api.lib.worker.templates import check_machine_name, get_folder
+
+
+COMPONENT = 'DataIQPool'
+# A pool VM that's been provisioning longer than this is assumed to be abandoned
+PROVISION_TIMEOUT = 4 * 60 * 60
+
+
+def enabled(image):
+    """Check if a warm pool is kept for an image.
+
+    :Returns: Boolean
+
+    :param image: The image/version of DataIQ
+    :type image: String
+    """
+    return const.VLAB_DATAIQ_WARM_POOL_SIZE > 0 and image in const.VLAB_DATAIQ_WARM_POOL_IMAGES
+
+
+def new_name(image):
+    """Generate a unique name for a new pool VM.
+
+    :Returns: String
+
+    :param image: The image/version of DataIQ
+    :type image: String
+    """
+    return 'dataiq-pool-{}-{}'.format(image, uuid.uuid4().hex[:8])
+
+
+def pool_meta(image, ready):
+    """Create the meta data for a pool VM
+
+    :Returns: Dictionary
+
+    :param image: The image/version of DataIQ
+    :type image: String
+
+    :param ready: Set to True once the VM is fully provisioned and powered off
+    :type ready: Boolean
+    """
+    return {'component' : COMPONENT,
+            'created' : time.time(),
+            'version' : image,
+            'configured' : False,
+            'generation' : 1,
+            'ready' : ready}
+
+
+def claim(vcenter, image, username, machine_name, logger):
+    """Take a ready VM out of the pool, move it into the user's folder and rename it.
+
+    :Returns: vim.VirtualMachine or None if the pool is empty
+
+    :Raises: ValueError
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of DataIQ to create
+    :type image: String
+
+    :param username: The name of the user who wants to create a new DataIQ
+    :type username: String
+
+    :param machine_name: The name of the new instance of DataIQ
+    :type machine_name: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    # The name becomes the hostname of the guest
+    check_machine_name(machine_name)
+    with file_lock('warm-pool-claim-{}'.format(image)):
+        pool_folder = get_folder(vcenter, const.VLAB_DATAIQ_WARM_POOL_FOLDER)
+        ready, _ = _pool_vms(pool_folder, image)
+        if not ready:
+            logger.info('Warm pool for %s is empty', image)
+            return None
+        the_vm = ready[0]
+        logger.info('Claiming %s from the warm pool', the_vm.name)
+        user_folder = lookups.folder(vcenter, username)
+        # Moved first, so a failed move leaves the VM in the pool, untouched
+        consume_task(user_folder.MoveIntoFolder_Task([the_vm]))
+        try:
+            consume_task(the_vm.Rename_Task(newName=machine_name))
+        except Exception:
+            # i.e. the user already has a VM with that name; give the VM back to the pool
+            consume_task(pool_folder.MoveIntoFolder_Task([the_vm]))
+            raise
+    return the_vm
+
+
+def shortfall(vcenter, image, logger):
+    """Find how many VMs need to be provisioned to fill the pool, destroying
+    any VM whose provisioning was abandoned.
+
+    :Returns: Integer
+
+    :param vcenter: The instantiated connection to vCenter
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param image: The image/version of DataIQ
+    :type image: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    pool_folder = get_folder(vcenter, const.VLAB_DATAIQ_WARM_POOL_FOLDER)
+    ready, provisioning = _pool_vms(pool_folder, image)
+    in_progress = 0
+    for the_vm, created in provisioning:
+        if time.time() - created > PROVISION_TIMEOUT:
+            logger.info('Destroying abandoned pool VM %s', the_vm.name)
+            if the_vm.runtime.powerState != 'poweredOff':
+                consume_task(the_vm.PowerOffVM_Task())
+            consume_task(the_vm.Destroy_Task())
+        else:
+            in_progress += 1
+    return max(const.VLAB_DATAIQ_WARM_POOL_SIZE - len(ready) - in_progress, 0)
+
+
+@contextmanager
+def refill_lock(image):
+    """Only one process at a time should provision VMs for the pool of an image.
+    The lock isn't waited on; the ``with`` statement gets False if another
+    process is already refilling the pool, since that process will fill it.
+
+    :param image: The image/version of DataIQ
+    :type image: String
+    """
+    with file_lock('warm-pool-refill-{}'.format(image), blocking=False) as acquired:
+        yield acquired
+
+
+def _pool_vms(pool_folder, image):
+    """Find the pool VMs of an image.
+
+    :Returns: Tuple (List of ready VMs, List of (VM, created) still being provisioned)
+
+    :param pool_folder: The folder that holds the pool VMs
+    :type pool_folder: vim.Folder
+
+    :param image: The image/version of DataIQ
+    :type image: String
+    """
+    ready = []
+    provisioning = []
+    for entity in pool_folder.childEntity:
+        if not isinstance(entity, vim.VirtualMachine):
+            continue
+        try:
+            meta = ujson.loads(entity.config.annotation)
+        except (ValueError, TypeError, AttributeError):
+            continue
+        if meta.get('component') != COMPONENT or meta.get('version') != image:
+            continue
+        if meta.get('ready') and entity.runtime.powerState == 'poweredOff':
+            ready.append(entity)
+        else:
+            provisioning.append((entity, meta.get('created', 0)))
+    return ready, provisioning